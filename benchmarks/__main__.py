@@ -0,0 +1,79 @@
+# Runs benchmark suite and saves results as JSON to compare between versions.
+# Run with: python -m benchmarks [-o results.json] [--compare old.json] [module ...]
+from __future__ import annotations
+
+import argparse
+import importlib
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+from typing import Any
+
+from benchmarks._utils import report
+
+MODULES = ("parse", "photos", "media", "render", "storage", "pipeline")
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ("git", "rev-parse", "--short", "HEAD"),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(modules: list[str]) -> dict[str, Any]:
+    results: dict[str, float] = {}
+    for name in modules:
+        module = importlib.import_module(f"benchmarks.{name}")
+        module_results: dict[str, float] = module.run()
+        report(module_results)
+        results.update(module_results)
+    return {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "results": results,
+    }
+
+
+def compare(old: dict[str, float], new: dict[str, float]):
+    print(f"\n{'':<50} {'old':>10} {'new':>10} {'change':>8}")
+    for name, seconds in new.items():
+        if (old_seconds := old.get(name)) is None:
+            continue
+        change = (seconds - old_seconds) / old_seconds * 100
+        print(
+            f"{name:<50} {old_seconds * 1000:>7.3f} ms {seconds * 1000:>7.3f} ms"
+            f" {change:>+7.1f}%"
+        )
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("modules", nargs="*", help=f"Any of: {', '.join(MODULES)}")
+    parser.add_argument("-o", "--output", help="Path to save results to")
+    parser.add_argument("--compare", help="Path to results of previous run")
+    args = parser.parse_args(argv)
+    if unknown := set(args.modules) - set(MODULES):
+        parser.error(f"unknown modules: {', '.join(sorted(unknown))}")
+
+    data = run(args.modules or list(MODULES))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(data, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f)["results"], data["results"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
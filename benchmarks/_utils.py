@@ -0,0 +1,15 @@
+from __future__ import annotations
+
+import timeit
+from collections.abc import Callable
+from typing import Any
+
+
+def bench(func: Callable[[], Any], *, repeat: int = 5, number: int = 1) -> float:
+    # Best time of one call in seconds
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def report(results: dict[str, float]):
+    for name, seconds in results.items():
+        print(f"{name:<50} {seconds * 1000:>10.3f} ms")
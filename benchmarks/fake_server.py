@@ -0,0 +1,297 @@
+# Local stand-in for VK, Telegram and S3 APIs, so whole runs can be measured
+# offline over real HTTP. Serves on one port:
+#   /method/wall.get, /method/execute    VK
+#   /bot<token>/<method>                 Telegram
+#   /photo/...                           photos from generated posts
+#   /<bucket>/<key>                      S3 GetObject and conditional PutObject
+# Every post text starts with "wall<owner_id>_<id>", which is how delivered
+# posts are recognized in Telegram requests.
+# Run with: python -m benchmarks.fake_server [--port 8080]
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from urllib.parse import parse_qs, urlsplit
+
+from pydantic import BaseModel
+
+_EXECUTE_CALL_RE = re.compile(r"API\.wall\.get\((\{.*?\})\)")
+_MARKER_RE = re.compile(rb"wall(-?\d+)_(\d+)")
+_FORM_CHAT_ID_RE = re.compile(rb'name="chat_id"\r\n\r\n(-?\d+)')
+_PHOTO = b"\xff\xd8\xff\xe0" + b"\0" * 20 * 1024  # Only looks like JPEG
+
+
+class FakeConfig(BaseModel):
+    walls: int = 10  # Owner ids are -1, -2, ...
+    wall_size: int = 100  # Posts on every wall at start
+    photos: int = 2  # Max photos in a post
+    latency: float = 0  # Seconds added to every response
+    error_rate: float = 0  # Share of VK and Telegram calls that fail
+    flood_rate: float = 0  # Share of Telegram calls answered with 429
+    retry_after: int = 1
+    seed: int = 0
+
+
+class FakeState:
+    def __init__(self, config: FakeConfig, base_url: str) -> None:
+        self.config = config
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.random = random.Random(config.seed)
+        self.walls: dict[int, list[dict[str, Any]]] = {
+            -idx: [] for idx in range(1, config.walls + 1)
+        }
+        self.created: dict[tuple[int, int], float] = {}
+        # (chat_id, owner_id, post_id) -> seconds from creation to first request
+        self.delivered: dict[tuple[int, int, int], float] = {}
+        self.requests: Counter[str] = Counter()
+        self.objects: dict[str, tuple[bytes, str]] = {}
+        self.add_posts(config.wall_size)
+
+    def _make_post(self, owner_id: int, id: int) -> dict[str, Any]:
+        photos = [
+            {
+                "type": "photo",
+                "photo": {
+                    "id": idx,
+                    "owner_id": owner_id,
+                    "sizes": [
+                        {
+                            "type": type,
+                            "width": width,
+                            "height": width * 2 // 3,
+                            "url": f"{self.base_url}/photo/{owner_id}/{id}/{idx}/{type}.jpg",
+                        }
+                        for type, width in (("x", 604), ("z", 1280))
+                    ],
+                },
+            }
+            for idx in range(self.random.randint(0, self.config.photos))
+        ]
+        words = " ".join(f"word{idx}" for idx in range(self.random.randint(0, 50)))
+        return {
+            "id": id,
+            "owner_id": owner_id,
+            "date": int(time.time()),
+            "text": f"wall{owner_id}_{id} {words}",
+            "attachments": photos,
+        }
+
+    def add_posts(self, count: int):
+        now = time.monotonic()
+        with self.lock:
+            for owner_id, wall in self.walls.items():
+                last_id = wall[0]["id"] if wall else 0
+                for id in range(last_id + 1, last_id + count + 1):
+                    wall.insert(0, self._make_post(owner_id, id))
+                    self.created[(owner_id, id)] = now
+
+    def get_wall(self, owner_id: int, offset: int, count: int) -> Any:
+        wall = self.walls.get(owner_id)
+        if wall is None or self.random.random() < self.config.error_rate:
+            return None
+        return {"count": len(wall), "items": wall[offset : offset + count]}
+
+    def record_delivery(self, chat_id: int, body: bytes):
+        if not (match := _MARKER_RE.search(body)):
+            return
+        owner_id, id = int(match[1]), int(match[2])
+        key = (chat_id, owner_id, id)
+        if key not in self.delivered and (owner_id, id) in self.created:
+            self.delivered[key] = time.monotonic() - self.created[(owner_id, id)]
+
+
+def _vk_error(code: int = 10, msg: str = "Internal server error"):
+    return {"error_code": code, "error_msg": msg}
+
+
+def _wall_params(params: dict[str, Any]):
+    return int(params["owner_id"]), int(params["offset"]), int(params["count"])
+
+
+def _make_handler(state: FakeState) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive, like real APIs
+
+        def log_message(self, format: str, *args: Any):
+            pass
+
+        def _reply(
+            self,
+            status: int,
+            body: bytes = b"",
+            headers: dict[str, str] | None = None,
+        ):
+            if state.config.latency:
+                time.sleep(state.config.latency)
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _reply_json(self, data: Any, status: int = 200):
+            self._reply(
+                status, json.dumps(data).encode(), {"Content-Type": "application/json"}
+            )
+
+        def _read_body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path.startswith("/method/"):
+                return self._vk(url.path, parse_qs(url.query))
+            if url.path.startswith("/photo/"):
+                with state.lock:
+                    state.requests["photo"] += 1
+                return self._reply(200, _PHOTO, {"Content-Type": "image/jpeg"})
+            return self._s3_get(url.path)
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            body = self._read_body()
+            if url.path.startswith("/method/"):
+                return self._vk(url.path, parse_qs(body.decode()))
+            if url.path.startswith("/bot"):
+                return self._tg(url.path, body)
+            self._reply(404)
+
+        def do_PUT(self):
+            body = self._read_body()
+            path = urlsplit(self.path).path
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            with state.lock:
+                state.requests["s3.put"] += 1
+                current = state.objects.get(path)
+                if_match = self.headers.get("If-Match")
+                if_none_match = self.headers.get("If-None-Match")
+                if (if_match and (current is None or current[1] != if_match)) or (
+                    if_none_match == "*" and current is not None
+                ):
+                    state.requests["s3.conflict"] += 1
+                    conflict = True
+                else:
+                    state.objects[path] = (body, etag)
+                    conflict = False
+            if conflict:
+                body = b"<Error><Code>PreconditionFailed</Code></Error>"
+                return self._reply(412, body, {"Content-Type": "application/xml"})
+            self._reply(200, headers={"ETag": etag})
+
+        def _vk(self, path: str, query: dict[str, list[str]]):
+            params = {key: values[0] for key, values in query.items()}
+            with state.lock:
+                state.requests["vk"] += 1
+                if path == "/method/wall.get":
+                    wall = state.get_wall(*_wall_params(params))
+                    data = (
+                        {"error": _vk_error()} if wall is None else {"response": wall}
+                    )
+                elif path == "/method/execute":
+                    calls = [
+                        json.loads(call)
+                        for call in _EXECUTE_CALL_RE.findall(params["code"])
+                    ]
+                    walls = [state.get_wall(*_wall_params(call)) for call in calls]
+                    data = {"response": [False if w is None else w for w in walls]}
+                    if errors := [_vk_error() for w in walls if w is None]:
+                        data["execute_errors"] = errors
+                else:
+                    data = {"error": _vk_error(3, "Unknown method passed")}
+            self._reply_json(data)
+
+        def _tg(self, path: str, body: bytes):
+            with state.lock:
+                state.requests["tg"] += 1
+                status, data = self._tg_result(path, body)
+            self._reply_json(data, status)
+
+        def _tg_result(self, path: str, body: bytes) -> tuple[int, Any]:
+            roll = state.random.random()
+            if roll < state.config.flood_rate:
+                state.requests["tg.429"] += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry later",
+                    "parameters": {"retry_after": state.config.retry_after},
+                }
+            if roll < state.config.flood_rate + state.config.error_rate:
+                state.requests["tg.error"] += 1
+                return 500, {
+                    "ok": False,
+                    "error_code": 500,
+                    "description": "Internal Server Error",
+                }
+            if self.headers.get("Content-Type") == "application/json":
+                chat_id = int(json.loads(body)["chat_id"])
+            elif match := _FORM_CHAT_ID_RE.search(body):
+                chat_id = int(match[1])
+            else:
+                return 400, {"ok": False, "description": "Bad Request"}
+            state.record_delivery(chat_id, body)
+            result: Any = [] if path.endswith("/sendMediaGroup") else {"message_id": 1}
+            return 200, {"ok": True, "result": result}
+
+        def _s3_get(self, path: str):
+            with state.lock:
+                state.requests["s3.get"] += 1
+                obj = state.objects.get(path)
+            if obj is None:
+                body = b"<Error><Code>NoSuchKey</Code></Error>"
+                return self._reply(404, body, {"Content-Type": "application/xml"})
+            content, etag = obj
+            if self.headers.get("If-None-Match") == etag:
+                return self._reply(304, headers={"ETag": etag})
+            self._reply(200, content, {"ETag": etag})
+
+    return Handler
+
+
+class FakeServer:
+    def __init__(self, config: FakeConfig, *, port: int = 0) -> None:
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), BaseHTTPRequestHandler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+        self.state = FakeState(config, self.url)
+        self._server.RequestHandlerClass = _make_handler(self.state)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: Any):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.fake_server")
+    parser.add_argument("--port", type=int, default=8080)
+    for name, field in FakeConfig.__fields__.items():
+        parser.add_argument(
+            f"--{name.replace('_', '-')}", type=field.type_, default=field.default
+        )
+    args = parser.parse_args(argv)
+    config = FakeConfig(**{name: getattr(args, name) for name in FakeConfig.__fields__})
+    with FakeServer(config, port=args.port) as server:
+        print(f"Serving on {server.url}, walls {list(server.state.walls)}")
+        try:
+            server._thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
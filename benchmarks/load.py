@@ -0,0 +1,170 @@
+# Load test: runs flow against the fake server (benchmarks/fake_server.py)
+# over real HTTP and reports throughput and delivery latency, that is time
+# from a post appearing on the wall to its first Telegram request.
+# First run publishes the initial walls, every next one adds new posts first.
+# Run with: python -m benchmarks.load [--mode lambda] [--flood-rate 0.05] ...
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from typing import Any
+
+from benchmarks.fake_server import FakeConfig, FakeServer
+
+
+def _percentile(values: list[float], percent: int) -> float | None:
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+@contextmanager
+def _environ(env: dict[str, str]) -> Generator[None, None, None]:
+    # Settings are read from environment in both modes, like in production
+    old = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for name, value in old.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _make_env(server: FakeServer, args: argparse.Namespace, db_path: str):
+    routes = [
+        {"vk_owner_id": owner_id, "tg_chat_ids": list(range(1, args.chats + 1))}
+        for owner_id in server.state.walls
+    ]
+    return {
+        "VK_TOKEN": "token",
+        "TG_TOKEN": "token",
+        "ROUTES": json.dumps(routes),
+        "VK_ENDPOINT": server.url,
+        "TG_ENDPOINT": server.url,
+        "TG_RATE_LIMIT": str(args.tg_rate_limit),
+        "TG_CHAT_RATE_LIMIT": str(args.tg_chat_rate_limit),
+        "PUBLISH_LIMIT": "0",
+        "DB_PATH": db_path,
+        "DB_BACKEND": args.db_backend,
+        "EMIT_METRICS": "false",
+        "S3_BUCKET": "bucket",
+        "S3_KEY": "database.db",
+        "S3_ENDPOINT": server.url,
+        "AWS_ACCESS_KEY_ID": "key",
+        "AWS_SECRET_ACCESS_KEY": "secret",
+        "AWS_DEFAULT_REGION": "us-east-1",
+    }
+
+
+def _run_once(mode: str):
+    if mode == "lambda":
+        from flow.main import lambda_handler
+
+        lambda_handler(None, None)
+    else:
+        from flow.main import main
+        from flow.models import Settings
+
+        main(Settings())  # type: ignore
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+    config = FakeConfig(
+        walls=args.walls,
+        wall_size=args.wall_size,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        flood_rate=args.flood_rate,
+        retry_after=args.retry_after,
+    )
+    durations: list[float] = []
+    failed_runs = 0
+    with tempfile.TemporaryDirectory() as tmpdir, FakeServer(config) as server:
+        db_path = os.path.join(tmpdir, "database.db")
+        with _environ(_make_env(server, args, db_path)):
+            for idx in range(args.runs):
+                if idx:
+                    server.state.add_posts(args.new_posts)
+                start = time.perf_counter()
+                try:
+                    _run_once(args.mode)
+                except Exception as exc:
+                    # Failed walls and posts are expected with error rate set
+                    print(f"Run {idx} failed: {exc!r}")
+                    failed_runs += 1
+                durations.append(time.perf_counter() - start)
+
+        latencies = list(server.state.delivered.values())
+        total = sum(durations)
+        return {
+            "config": {**config.dict(), **vars(args)},
+            "runs": len(durations),
+            "failed_runs": failed_runs,
+            "posts": len(latencies),
+            "seconds": round(total, 3),
+            "posts_per_second": round(len(latencies) / total, 2) if total else None,
+            "latency_p50": _percentile(latencies, 50),
+            "latency_p99": _percentile(latencies, 99),
+            "run_p50": _percentile(durations, 50),
+            "run_p99": _percentile(durations, 99),
+            "requests": dict(server.state.requests),
+        }
+
+
+def report(result: dict[str, Any]):
+    def ms(seconds: float | None):
+        return "-" if seconds is None else f"{seconds * 1000:.1f} ms"
+
+    print(
+        f"{result['posts']} posts in {result['runs']} runs"
+        f" ({result['failed_runs']} failed), {result['seconds']} s:"
+        f" {result['posts_per_second']} posts/s"
+    )
+    print(
+        f"delivery latency p50 {ms(result['latency_p50'])}, p99 {ms(result['latency_p99'])}"
+    )
+    print(f"run time p50 {ms(result['run_p50'])}, p99 {ms(result['run_p99'])}")
+    print(
+        "requests:",
+        ", ".join(f"{k} {v}" for k, v in sorted(result["requests"].items())),
+    )
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load")
+    parser.add_argument("--mode", choices=("main", "lambda"), default="main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--walls", type=int, default=10)
+    parser.add_argument("--chats", type=int, default=3)
+    parser.add_argument("--wall-size", type=int, default=20)
+    parser.add_argument("--new-posts", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--flood-rate", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--tg-rate-limit", type=float, default=30)
+    parser.add_argument("--tg-chat-rate-limit", type=float, default=1)
+    parser.add_argument("--db-backend", choices=("sqlite", "compact"), default="sqlite")
+    parser.add_argument("-o", "--output", help="Write results to JSON file")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Photo recompression of a large original, sequential and in process pool.
+# Run with: python -m benchmarks.media
+from __future__ import annotations
+
+import asyncio
+import io
+import tempfile
+
+from benchmarks._utils import bench, report
+from flow.media import PhotoProcessor, recompress
+
+_PHOTOS = 8
+
+
+def make_photo(size: tuple[int, int] = (5000, 3500)) -> bytes:
+    from PIL import Image, ImageDraw
+
+    # Gradient with shapes: compresses like a photo, unlike noise
+    # Pillow annotates sizes with NumPy types, unknown without NumPy
+    image = Image.linear_gradient("L").resize(size).convert("RGB")  # type: ignore
+    draw = ImageDraw.Draw(image)
+    for idx in range(0, size[0], 250):
+        draw.ellipse(
+            (idx, idx // 2, idx + 400, idx // 2 + 300), fill=(idx % 255, 90, 40)
+        )
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=95)
+    return buffer.getvalue()
+
+
+def _process_all(processor: PhotoProcessor, photo: bytes):
+    async def download():
+        return photo
+
+    async def run():
+        # Unique URLs: cache is not hit
+        await asyncio.gather(
+            *(processor.get(f"{id(run)}/{idx}", download) for idx in range(_PHOTOS))
+        )
+
+    asyncio.run(run())
+
+
+def run() -> dict[str, float]:
+    photo = make_photo()
+    results = {
+        "media.recompress": bench(
+            lambda: recompress(photo, max_side=2560, max_bytes=5 * 1024 * 1024),
+            repeat=3,
+        ),
+    }
+    with tempfile.TemporaryDirectory() as tmp, PhotoProcessor(
+        max_side=2560, max_bytes=5 * 1024 * 1024, cache_dir=tmp
+    ) as processor:
+        results[f"media.processor[{_PHOTOS} photos]"] = bench(
+            lambda: _process_all(processor, photo), repeat=3
+        )
+    return results
+
+
+if __name__ == "__main__":
+    report(run())
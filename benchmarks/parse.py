@@ -0,0 +1,95 @@
+# wall.get parsing on synthetic walls: pydantic models vs lean parser.
+# Run with: python -m benchmarks.parse
+from __future__ import annotations
+
+import json
+import random
+from typing import Any
+
+from benchmarks._utils import bench, report
+from flow.models import PhotoSizePolicy
+from flow.vk import WallGetResponse, _loads, _parse_wall, _WallCollector
+
+
+def make_wall_item(id: int, rnd: random.Random) -> dict[str, Any]:
+    attachments: list[dict[str, Any]] = []
+    for photo_id in range(rnd.randint(0, 4)):
+        attachments.append(
+            {
+                "type": "photo",
+                "photo": {
+                    "id": photo_id,
+                    "owner_id": -1,
+                    "sizes": [
+                        {
+                            "type": type,
+                            "width": width,
+                            "height": width * 2 // 3,
+                            "url": f"https://sun9-1.userapi.com/{id}/{photo_id}/{type}.jpg",
+                        }
+                        for type, width in (
+                            ("s", 75),
+                            ("m", 130),
+                            ("x", 604),
+                            ("y", 807),
+                            ("z", 1280),
+                            ("w", 2560),
+                        )
+                    ],
+                },
+            }
+        )
+    attachments.append(
+        {"type": "link", "link": {"url": "https://vk.com", "title": "VK"}}
+    )
+    return {
+        "id": id,
+        "from_id": -1,
+        "owner_id": -1,
+        "date": 1_600_000_000 + id * 60,
+        "marked_as_ads": int(rnd.random() < 0.05),
+        "post_type": "post",
+        "text": " ".join(f"word{idx}" for idx in range(rnd.randint(0, 100))),
+        "attachments": attachments,
+        "comments": {"can_post": 1, "count": 0},
+        "likes": {"can_like": 1, "count": 1, "user_likes": 0},
+        "reposts": {"count": 25, "user_reposted": 0},
+        "views": {"count": 42178},
+    }
+
+
+def make_wall(count: int, seed: int = 0) -> bytes:
+    rnd = random.Random(seed)
+    items = [make_wall_item(id, rnd) for id in range(count, 0, -1)]
+    return json.dumps({"response": {"count": count, "items": items}}).encode()
+
+
+def legacy_parse(content: bytes):
+    response = WallGetResponse(**json.loads(content)["response"])
+    return _parse_wall(response)
+
+
+def lean_parse(content: bytes, page_size: int, since_id: int | None = None):
+    collector = _WallCollector(
+        since_id=since_id, page_size=page_size, photo_policy=PhotoSizePolicy()
+    )
+    collector.add(_loads(content)["response"])
+    return collector.get_posts()
+
+
+def run() -> dict[str, float]:
+    results: dict[str, float] = {}
+    for count in (100, 10_000):  # One page and a long backfill
+        content = make_wall(count)
+        results[f"parse.legacy[{count} items]"] = bench(lambda: legacy_parse(content))
+        results[f"parse.lean[{count} items]"] = bench(
+            lambda: lean_parse(content, count)
+        )
+        results[f"parse.lean[{count} items, half seen]"] = bench(
+            lambda: lean_parse(content, count, since_id=count // 2)
+        )
+    return results
+
+
+if __name__ == "__main__":
+    report(run())
@@ -0,0 +1,63 @@
+# Photo size selection on typical VK size lists.
+# Run with: python -m benchmarks.photos
+from __future__ import annotations
+
+from typing import Any
+
+from benchmarks._utils import bench, report
+from flow.models import PhotoSizePolicy
+from flow.vk import (
+    WallItemAttachmentPhoto,
+    _get_photo_with_highest_quality,
+    _select_photo_url,
+)
+
+_SIZES = (
+    ("s", 75, 50),
+    ("m", 130, 87),
+    ("o", 10000, 173),  # Violates Telegram limits
+    ("p", 200, 133),
+    ("q", 320, 213),
+    ("r", 510, 340),
+    ("x", 604, 403),
+    ("y", 807, 538),
+    ("z", 1280, 853),
+    ("w", 2560, 1707),
+)
+
+
+def make_sizes(count: int = len(_SIZES)) -> list[dict[str, Any]]:
+    return [
+        {
+            "type": type,
+            "width": width,
+            "height": height,
+            "url": f"https://vk.com/{type}.jpg",
+        }
+        for type, width, height in _SIZES[:count]
+    ]
+
+
+POLICIES = {
+    "default": PhotoSizePolicy(),
+    "max_pixels": PhotoSizePolicy(max_pixels=1280 * 1280),
+    "preferred_types": PhotoSizePolicy(preferred_types=["z", "y", "x"]),
+}
+
+
+def run() -> dict[str, float]:
+    results: dict[str, float] = {}
+    sizes = make_sizes()
+    photo = WallItemAttachmentPhoto.parse_obj({"sizes": sizes})
+    for name, policy in POLICIES.items():
+        results[f"photos.select_raw[{name}]"] = bench(
+            lambda: _select_photo_url(sizes, policy), number=10_000
+        )
+        results[f"photos.select_model[{name}]"] = bench(
+            lambda: _get_photo_with_highest_quality(photo, policy), number=1_000
+        )
+    return results
+
+
+if __name__ == "__main__":
+    report(run())
@@ -0,0 +1,82 @@
+# Whole run from fetching walls to publishing posts with stubbed VK and Telegram.
+# Run with: python -m benchmarks.pipeline
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import tempfile
+
+import httpx
+
+from benchmarks._utils import bench, report
+from benchmarks.parse import make_wall_item
+from flow.db import open_storage
+from flow.main import _main
+from flow.models import Route, Settings
+
+
+def make_transport(page_size: int) -> httpx.MockTransport:
+    rnd = random.Random(0)
+    # Pages are built once, so only flow's own work is measured
+    wall = [make_wall_item(id, rnd) for id in range(page_size, 0, -1)]
+    wall_json = json.dumps({"count": page_size, "items": wall}).encode()
+    page = b'{"response": %s}' % wall_json
+    ok = json.dumps({"ok": True, "result": {}}).encode()
+
+    def handler(request: httpx.Request):
+        if request.url.path == "/method/wall.get":
+            return httpx.Response(200, content=page)
+        if request.url.path == "/method/execute":
+            calls = request.url.params["code"].count("API.wall.get")
+            return httpx.Response(
+                200, content=b'{"response": [%s]}' % b",".join([wall_json] * calls)
+            )
+        return httpx.Response(200, content=ok)
+
+    return httpx.MockTransport(handler)
+
+
+async def run_once(settings: Settings, transport: httpx.MockTransport):
+    async with httpx.AsyncClient(transport=transport) as client:
+        with open_storage(settings) as storage:
+            await _main(settings, storage=storage, client=client, deadline=None)
+
+
+def run(
+    configs: tuple[tuple[int, int], ...] = ((1, 1), (10, 3)),
+) -> dict[str, float]:
+    results: dict[str, float] = {}
+    for backend in ("sqlite", "compact"):
+        for owners, chats in configs:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                transport = make_transport(page_size=20)
+                runs = iter(range(1_000))
+
+                def func():
+                    # Every run starts with empty database, so every post is published
+                    settings = Settings(
+                        vk_token="",
+                        tg_token="",
+                        routes=[
+                            Route(vk_owner_id=-owner, tg_chat_ids=list(range(chats)))
+                            for owner in range(1, owners + 1)
+                        ],
+                        publish_limit=0,
+                        # Stub walls are all the same, don't skip them as reposts
+                        dedupe_window=0,
+                        # Stub Telegram has no limits
+                        tg_rate_limit=0,
+                        db_backend=backend,  # type: ignore
+                        db_path=os.path.join(tmpdir, f"{next(runs)}.db"),
+                    )
+                    asyncio.run(run_once(settings, transport))
+
+                name = f"{backend}, {owners} walls x {chats} chats"
+                results[f"pipeline.main[{name}]"] = bench(func)
+    return results
+
+
+if __name__ == "__main__":
+    report(run())
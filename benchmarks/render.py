@@ -0,0 +1,57 @@
+# Message rendering on large link-dense posts.
+# Run with: python -m benchmarks.render
+from __future__ import annotations
+
+import random
+import re
+import textwrap
+
+import markupsafe
+
+from benchmarks._utils import bench, report
+from flow.tg import _render_message
+
+
+def make_text(*, words: int, link_ratio: float, seed: int = 0):
+    rnd = random.Random(seed)
+    parts: list[str] = []
+    for idx in range(words):
+        if rnd.random() < link_ratio:
+            parts.append(f"[id{idx}|User {idx}]")
+        elif rnd.random() < 0.05:
+            parts.append(f"<br>word{idx}")
+        else:
+            parts.append(f"word{idx}")
+    return " ".join(parts)
+
+
+def _legacy_format_internal_vk_links(text: str):
+    if match := re.findall(r"\[(https://)?(vk.com/)?([^\|\]]+)\|([^\]]+)\]", text):
+        for scheme, domain, user_id, username in match:
+            text = text.replace(
+                f"[{scheme}{domain}{user_id}|{username}]",
+                f'<a href="https://vk.com/{user_id}">{username}</a>',
+            )
+    return text
+
+
+def legacy_render(text: str):
+    # wrap → strip → link-format, as it was done before the single-pass renderer
+    return [
+        _legacy_format_internal_vk_links(markupsafe.Markup(chunk).striptags())
+        for chunk in textwrap.wrap(text, width=4096, replace_whitespace=False)
+    ]
+
+
+def run() -> dict[str, float]:
+    results: dict[str, float] = {}
+    for words, link_ratio in ((1_000, 0.5), (10_000, 0.5), (10_000, 0.05)):
+        text = make_text(words=words, link_ratio=link_ratio)
+        name = f"{words} words, {int(link_ratio * 100)}% links"
+        results[f"render.legacy[{name}]"] = bench(lambda: legacy_render(text))
+        results[f"render.single_pass[{name}]"] = bench(lambda: _render_message(text))
+    return results
+
+
+if __name__ == "__main__":
+    report(run())
@@ -0,0 +1,71 @@
+# Storage lookups and inserts with large amount of stored ids.
+# Run with: python -m benchmarks.storage
+from __future__ import annotations
+
+import os
+import tempfile
+from collections.abc import Generator
+from contextlib import contextmanager
+
+from benchmarks._utils import bench, report
+from flow.db import Storage
+from flow.db.compact import CompactStorage
+from flow.db.sqlite import SQLiteStorage
+
+OWNER_ID = -1
+CHAT_ID = 1
+
+
+@contextmanager
+def filled_storage(backend: str, count: int) -> Generator[Storage, None, None]:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "database.db")
+        storage: Storage
+        if backend == "compact":
+            storage = CompactStorage(path, keep_ids=200)
+        else:
+            storage = SQLiteStorage(path)
+        with storage:
+            storage.add_posts(
+                owner_id=OWNER_ID, chat_id=CHAT_ID, ids=range(1, count + 1)
+            )
+            yield storage
+
+
+def run(counts: tuple[int, ...] = (10_000, 100_000, 1_000_000)) -> dict[str, float]:
+    results: dict[str, float] = {}
+    for backend in ("sqlite", "compact"):
+        for count in counts:
+            with filled_storage(backend, count) as storage:
+                name = f"{backend}, {count} ids"
+                wall = list(range(count - 10, count + 10))
+                next_ids = iter(range(count + 1, count * 2))
+                results[f"storage.post_in_db[{name}, hit]"] = bench(
+                    lambda: storage.post_in_db(
+                        owner_id=OWNER_ID, chat_id=CHAT_ID, id=count // 2
+                    ),
+                    number=100,
+                )
+                results[f"storage.post_in_db[{name}, miss]"] = bench(
+                    lambda: storage.post_in_db(
+                        owner_id=OWNER_ID, chat_id=CHAT_ID, id=count * 2
+                    ),
+                    number=100,
+                )
+                results[f"storage.posts_in_db[{name}, 20 ids]"] = bench(
+                    lambda: storage.posts_in_db(
+                        owner_id=OWNER_ID, chat_id=CHAT_ID, ids=wall
+                    ),
+                    number=100,
+                )
+                results[f"storage.add_post[{name}]"] = bench(
+                    lambda: storage.add_post(
+                        owner_id=OWNER_ID, chat_id=CHAT_ID, id=next(next_ids)
+                    ),
+                    number=100,
+                )
+    return results
+
+
+if __name__ == "__main__":
+    report(run())
@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import signal
+import time
+
+import httpx
+
+from flow.db import Storage, open_storage
+from flow.main import collect_run_metrics, fetch_walls, init_sentry, publish_outbox
+from flow.models import Settings
+
+# Long-running alternative to running flow/main.py on schedule. Database,
+# HTTP connections and Sentry are set up once. Every wall is polled on its
+# own interval: it drops to the minimum when there are new posts and grows
+# while the wall stays quiet.
+
+logger = logging.getLogger(__name__)
+
+
+class _Schedule:
+    __slots__ = ("interval", "next_poll_at")
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.next_poll_at = 0.0  # Poll right away on start
+
+    def update(self, settings: Settings, *, active: bool, now: float):
+        if active:
+            self.interval = settings.poll_min_interval
+        else:
+            self.interval = min(
+                self.interval * settings.poll_backoff, settings.poll_max_interval
+            )
+        self.next_poll_at = now + self.interval
+
+
+async def _run_cycle(
+    settings: Settings,
+    *,
+    storage: Storage,
+    client: httpx.AsyncClient,
+    schedules: dict[int, _Schedule],
+    stop: asyncio.Event,
+):
+    now = time.monotonic()
+    due = [owner_id for owner_id, s in schedules.items() if s.next_poll_at <= now]
+    with collect_run_metrics(settings):
+        if due:
+            # Due walls are fetched together, so they still share VK requests
+            fetched = await fetch_walls(
+                settings, storage=storage, client=client, owner_ids=due
+            )
+            for owner_id, res in fetched.items():
+                if isinstance(res, BaseException):
+                    logger.error("Failed to fetch wall %s", owner_id, exc_info=res)
+                active = not isinstance(res, BaseException) and res > 0
+                schedules[owner_id].update(settings, active=active, now=now)
+        # Retries and posts over PUBLISH_LIMIT are picked up by later cycles
+        for exc in await publish_outbox(
+            settings, storage=storage, client=client, deadline=None, stop=stop
+        ):
+            logger.error("Failed to publish", exc_info=exc)
+
+
+def _sleep_time(schedules: dict[int, _Schedule], settings: Settings):
+    next_poll_at = min(s.next_poll_at for s in schedules.values())
+    # Wake up at least as often as the fastest poll to publish what is left
+    return min(max(next_poll_at - time.monotonic(), 0), settings.poll_min_interval)
+
+
+async def run_daemon(settings: Settings, *, stop: asyncio.Event | None = None):
+    # Runs until `stop` is set. Current cycle is finished before returning,
+    # though publishing stops after the post that is being sent.
+    if stop is None:
+        stop = asyncio.Event()
+    schedules = {
+        route.vk_owner_id: _Schedule(settings.poll_min_interval)
+        for route in settings.get_routes()
+    }
+    async with httpx.AsyncClient(timeout=settings.http_timeout) as client:
+        with open_storage(settings) as storage:
+            while not stop.is_set():
+                try:
+                    await _run_cycle(
+                        settings,
+                        storage=storage,
+                        client=client,
+                        schedules=schedules,
+                        stop=stop,
+                    )
+                    timeout = _sleep_time(schedules, settings)
+                except Exception:
+                    logger.exception("Cycle failed")
+                    timeout = settings.poll_min_interval
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stop.wait(), timeout=timeout)
+
+
+async def _main(settings: Settings):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    await run_daemon(settings, stop=stop)
+
+
+def main(settings: Settings) -> int:
+    init_sentry(settings.sentry_dsn, settings.sentry_traces_sample_rate)
+    asyncio.run(_main(settings))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(main(Settings(".env")))  # type: ignore
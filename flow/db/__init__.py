@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import copy
+from collections.abc import Iterable, Mapping
+from typing import Any, Callable, Protocol
+
+from flow.models import OutboxItem, Settings
+
+
+class Storage(Protocol):
+    def __enter__(self) -> Storage:
+        ...
+
+    def __exit__(self, *args: Any) -> None:
+        ...
+
+    def close(self) -> None:
+        ...
+
+    def checkpoint(self) -> None:
+        # Makes the database file complete, so it can be copied while open
+        ...
+
+    # Databases of older versions kept ids of a single route without owner
+    # and chat, they are assigned to a route on first fetch
+
+    def has_legacy_posts(self) -> bool:
+        ...
+
+    def adopt_legacy_posts(self, *, owner_id: int, chat_id: int) -> None:
+        ...
+
+    def add_posts(self, *, owner_id: int, chat_id: int, ids: Iterable[int]) -> None:
+        ...
+
+    def add_post(self, *, owner_id: int, chat_id: int, id: int) -> None:
+        ...
+
+    def posts_in_db(
+        self, *, owner_id: int, chat_id: int, ids: Iterable[int]
+    ) -> set[int]:
+        ...
+
+    def post_in_db(self, *, owner_id: int, chat_id: int, id: int) -> bool:
+        ...
+
+    def get_last_post_id(self, *, owner_id: int, chat_ids: Iterable[int]) -> int | None:
+        ...
+
+    def prune(self) -> None:
+        # Drops ids that are not needed anymore, called after fetching
+        ...
+
+    # Outbox: posts that are fetched, but not published yet. Enqueued posts
+    # count as added, so they are never fetched and enqueued again.
+
+    def enqueue_posts(self, items: Iterable[OutboxItem]) -> None:
+        ...
+
+    def get_outbox(self) -> list[OutboxItem]:
+        ...
+
+    def update_outbox_item(self, item: OutboxItem) -> None:
+        ...
+
+    def remove_outbox_item(self, item: OutboxItem) -> None:
+        ...
+
+    # Content fingerprints (see flow.tg.fingerprint_post) of recent posts
+    # per chat with Unix time of the latest post that had it
+
+    def get_fingerprints(
+        self, *, chat_id: int, fingerprints: Iterable[int]
+    ) -> dict[int, float]:
+        ...
+
+    def add_fingerprints(
+        self,
+        *,
+        chat_id: int,
+        fingerprints: Mapping[int, float],
+        expire_before: float,
+    ) -> None:
+        # Fingerprints of the chat older than `expire_before` are removed
+        ...
+
+
+# Method name, args and kwargs of a call that changes the database
+Change = tuple[str, tuple[Any, ...], dict[str, Any]]
+_CHANGING_METHODS = frozenset(
+    (
+        "adopt_legacy_posts",
+        "add_posts",
+        "add_post",
+        "prune",
+        "enqueue_posts",
+        "update_outbox_item",
+        "remove_outbox_item",
+        "add_fingerprints",
+    )
+)
+
+
+class RecordingStorage:
+    # Passes calls through to `storage` and appends the ones that change it
+    # to `changes`. Every change is idempotent, so they can be applied again
+    # to a newer copy of the database (see apply_changes).
+    def __init__(self, storage: Storage, changes: list[Change]) -> None:
+        self.storage = storage
+        self.changes = changes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args: Any):
+        self.storage.close()
+
+    def __getattr__(self, name: str) -> Any:
+        method = getattr(self.storage, name)
+        if name not in _CHANGING_METHODS:
+            return method
+        return self._record(name, method)
+
+    def _record(self, name: str, method: Callable[..., Any]):
+        def record(*args: Any, **kwargs: Any):
+            # Copied, outbox items are changed in place after the call
+            self.changes.append((name, copy.deepcopy(args), copy.deepcopy(kwargs)))
+            return method(*args, **kwargs)
+
+        return record
+
+
+def apply_changes(storage: Storage, changes: Iterable[Change]):
+    for name, args, kwargs in changes:
+        getattr(storage, name)(*args, **kwargs)
+
+
+def open_storage(settings: Settings) -> Storage:
+    # Backends are imported lazily: compact one doesn't need SQLAlchemy at all
+    # Ids are kept at least for as many posts as a fetch can walk back through
+    keep_ids = max(settings.db_keep_ids, settings.vk_page_size * settings.vk_max_pages)
+    if settings.db_backend == "compact":
+        from flow.db.compact import CompactStorage
+
+        return CompactStorage(settings.db_path, keep_ids=keep_ids)
+
+    from flow.db.sqlite import SQLiteStorage
+
+    return SQLiteStorage(settings.db_path, keep_ids=keep_ids)
@@ -0,0 +1,290 @@
+from __future__ import annotations
+
+import bisect
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import Iterable, Mapping
+from typing import Any
+
+from flow.models import OutboxItem
+
+_SQLITE_HEADER = b"SQLite format 3\x00"
+_VERSION = 1
+
+
+class _RouteState:
+    __slots__ = ("floor", "ids")
+
+    def __init__(self, floor: int = 0, ids: list[int] | None = None) -> None:
+        # Every id up to `floor` is considered published,
+        # `ids` are recently published ids above it, sorted
+        self.floor: int = floor
+        self.ids: list[int] = ids or []
+
+    def __contains__(self, id: int):
+        if id <= self.floor:
+            return True
+        idx = bisect.bisect_left(self.ids, id)
+        return idx < len(self.ids) and self.ids[idx] == id
+
+    @property
+    def last_id(self) -> int | None:
+        if self.ids:
+            return self.ids[-1]
+        return self.floor or None
+
+    def add(self, ids: Iterable[int], *, keep: int):
+        self.ids = sorted({*self.ids, *(id for id in ids if id > self.floor)})
+        if len(self.ids) > keep:
+            self.floor = self.ids[-keep - 1]
+            self.ids = self.ids[-keep:]
+
+
+def _read_tables(conn: sqlite3.Connection) -> dict[str, set[str]]:
+    return {
+        name: {column[1] for column in conn.execute(f"PRAGMA table_info({name})")}
+        for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )
+    }
+
+
+def _outbox_key(item: OutboxItem):
+    return (item.owner_id, item.chat_id, item.post_id)
+
+
+def _dump_outbox_item(item: OutboxItem):
+    return {**item.dict(), "date": item.date.isoformat()}
+
+
+# Alternative to SQLite backend: per-route high-water marks with small windows
+# of recent ids, kept in one JSON file
+class CompactStorage:
+    def __init__(self, db_path: str, *, keep_ids: int = 200) -> None:
+        self.db_path = db_path
+        self.keep_ids = keep_ids
+        self._lock = threading.RLock()
+        self._routes: dict[tuple[int, int], _RouteState] = {}
+        self._legacy_ids: list[int] = []
+        # Kept ready to be dumped: converting items on every save is slow
+        self._outbox: dict[tuple[int, int, int], dict[str, Any]] = {}
+        # Chat id -> fingerprint -> Unix time of the post
+        self._fingerprints: dict[int, dict[int, float]] = {}
+        self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args: Any):
+        self.close()
+
+    def close(self):
+        # Changes are saved as soon as they are made
+        pass
+
+    def checkpoint(self):
+        pass
+
+    def _load(self):
+        if not os.path.exists(self.db_path):
+            return
+        with open(self.db_path, "rb") as f:
+            content = f.read()
+
+        if content.startswith(_SQLITE_HEADER):
+            conn = sqlite3.connect(self.db_path)
+            try:
+                self._load_sqlite(conn)
+            finally:
+                conn.close()
+            self._save()
+            return
+
+        data = json.loads(content)
+        for route in data["routes"]:
+            self._routes[(route["owner_id"], route["chat_id"])] = _RouteState(
+                floor=route["floor"], ids=route["ids"]
+            )
+        self._legacy_ids = data.get("legacy_ids", [])
+        for raw_item in data.get("outbox", []):
+            self._outbox[_outbox_key(OutboxItem(**raw_item))] = raw_item
+        for chat in data.get("fingerprints", []):
+            self._fingerprints[chat["chat_id"]] = dict(chat["items"])
+
+    def _load_sqlite(self, conn: sqlite3.Connection):
+        # Migration from SQLite backend. Uses stdlib sqlite3 to stay light.
+        tables = _read_tables(conn)
+        for owner_id, chat_id, floor in (
+            conn.execute("SELECT owner_id, chat_id, floor FROM floors")
+            if "floors" in tables
+            else ()
+        ):
+            self._routes[(owner_id, chat_id)] = _RouteState(floor=floor)
+        routes: dict[tuple[int, int], list[int]] = {}
+        for name, columns in tables.items():
+            if name == "postdb" and "owner_id" in columns:
+                for owner_id, chat_id, id in conn.execute(
+                    "SELECT owner_id, chat_id, id FROM postdb"
+                ):
+                    routes.setdefault((owner_id, chat_id), []).append(id)
+            elif name in ("postdb", "postdb_legacy"):
+                self._legacy_ids.extend(
+                    id for (id,) in conn.execute(f"SELECT id FROM {name}")
+                )
+        for key, ids in routes.items():
+            self._route(*key).add(ids, keep=self.keep_ids)
+
+        if "outbox" in tables:
+            conn.row_factory = sqlite3.Row
+            for row in conn.execute("SELECT * FROM outbox"):
+                item = OutboxItem(**{**row, "steps": json.loads(row["steps"])})
+                self._outbox[_outbox_key(item)] = _dump_outbox_item(item)
+            conn.row_factory = None
+        if "fingerprints" in tables:
+            for chat_id, fingerprint, date in conn.execute(
+                "SELECT chat_id, fingerprint, date FROM fingerprints"
+            ):
+                self._fingerprints.setdefault(chat_id, {})[fingerprint] = date
+
+    def _save(self):
+        data: dict[str, Any] = {
+            "version": _VERSION,
+            "routes": [
+                {
+                    "owner_id": owner_id,
+                    "chat_id": chat_id,
+                    "floor": s.floor,
+                    "ids": s.ids,
+                }
+                for (owner_id, chat_id), s in self._routes.items()
+            ],
+        }
+        if self._legacy_ids:
+            data["legacy_ids"] = self._legacy_ids
+        if self._outbox:
+            data["outbox"] = list(self._outbox.values())
+        if self._fingerprints:
+            data["fingerprints"] = [
+                {"chat_id": chat_id, "items": list(items.items())}
+                for chat_id, items in self._fingerprints.items()
+            ]
+        tmp_path = f"{self.db_path}.tmp"
+        with open(tmp_path, "w") as f:
+            # json.dumps is much faster than json.dump, which encodes in pure Python
+            f.write(json.dumps(data, separators=(",", ":")))
+        os.replace(tmp_path, self.db_path)
+
+    def _route(self, owner_id: int, chat_id: int):
+        if (key := (owner_id, chat_id)) not in self._routes:
+            self._routes[key] = _RouteState()
+        return self._routes[key]
+
+    def has_legacy_posts(self) -> bool:
+        return bool(self._legacy_ids)
+
+    def adopt_legacy_posts(self, *, owner_id: int, chat_id: int):
+        if not self._legacy_ids:
+            return
+        with self._lock:
+            self._route(owner_id, chat_id).add(self._legacy_ids, keep=self.keep_ids)
+            self._legacy_ids = []
+            self._save()
+
+    def add_posts(self, *, owner_id: int, chat_id: int, ids: Iterable[int]):
+        ids = list(ids)
+        if not ids:
+            return
+        with self._lock:
+            self._route(owner_id, chat_id).add(ids, keep=self.keep_ids)
+            self._save()
+
+    def add_post(self, *, owner_id: int, chat_id: int, id: int):
+        self.add_posts(owner_id=owner_id, chat_id=chat_id, ids=[id])
+
+    def posts_in_db(self, *, owner_id: int, chat_id: int, ids: Iterable[int]):
+        with self._lock:
+            state = self._routes.get((owner_id, chat_id), _RouteState())
+            return {id for id in ids if id in state}
+
+    def post_in_db(self, *, owner_id: int, chat_id: int, id: int):
+        return id in self.posts_in_db(owner_id=owner_id, chat_id=chat_id, ids=[id])
+
+    def get_last_post_id(self, *, owner_id: int, chat_ids: Iterable[int]) -> int | None:
+        with self._lock:
+            last_ids = [
+                self._routes[key].last_id if key in self._routes else None
+                for key in ((owner_id, chat_id) for chat_id in set(chat_ids))
+            ]
+        if not last_ids or None in last_ids:
+            return None
+        return min(id for id in last_ids if id is not None)
+
+    def prune(self):
+        # Ids are pruned as they are added
+        pass
+
+    def enqueue_posts(self, items: Iterable[OutboxItem]):
+        items = list(items)
+        if not items:
+            return
+        with self._lock:
+            ids: dict[tuple[int, int], list[int]] = {}
+            for item in items:
+                if item.post_id in self._route(item.owner_id, item.chat_id):
+                    continue
+                self._outbox[_outbox_key(item)] = _dump_outbox_item(item)
+                ids.setdefault((item.owner_id, item.chat_id), []).append(item.post_id)
+            for key, route_ids in ids.items():
+                self._routes[key].add(route_ids, keep=self.keep_ids)
+            self._save()
+
+    def get_outbox(self):
+        with self._lock:
+            items = [OutboxItem(**raw_item) for raw_item in self._outbox.values()]
+        items.sort(key=lambda item: (item.date, item.post_id))
+        return items
+
+    def update_outbox_item(self, item: OutboxItem):
+        with self._lock:
+            if (key := _outbox_key(item)) in self._outbox:
+                self._outbox[key] = _dump_outbox_item(item)
+                self._save()
+
+    def remove_outbox_item(self, item: OutboxItem):
+        with self._lock:
+            if self._outbox.pop(_outbox_key(item), None) is not None:
+                self._save()
+
+    def get_fingerprints(self, *, chat_id: int, fingerprints: Iterable[int]):
+        with self._lock:
+            items = self._fingerprints.get(chat_id, {})
+            return {
+                fingerprint: items[fingerprint]
+                for fingerprint in fingerprints
+                if fingerprint in items
+            }
+
+    def add_fingerprints(
+        self,
+        *,
+        chat_id: int,
+        fingerprints: Mapping[int, float],
+        expire_before: float,
+    ):
+        with self._lock:
+            items = self._fingerprints.get(chat_id, {})
+            new_items = {
+                fingerprint: date
+                for fingerprint, date in items.items()
+                if date >= expire_before
+            }
+            new_items.update(fingerprints)
+            if new_items == items:
+                return
+            if new_items:
+                self._fingerprints[chat_id] = new_items
+            else:
+                self._fingerprints.pop(chat_id, None)
+            self._save()
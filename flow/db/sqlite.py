@@ -0,0 +1,364 @@
+from __future__ import annotations
+
+import json
+import threading
+from collections.abc import Iterable, Mapping, Sequence
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import inspect  # pyright: ignore[reportUnknownVariableType]
+from sqlalchemy import delete, event, func, insert, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Field  # pyright: ignore[reportUnknownVariableType]
+from sqlmodel import col  # pyright: ignore[reportUnknownVariableType]
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from flow.models import OutboxItem
+
+_LEGACY_TABLE = "postdb_legacy"
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER of old SQLite builds
+_MAX_QUERY_PARAMS = 500
+# VACUUM rewrites the whole file, so only when enough of it is free
+_VACUUM_MIN_FREE_PAGES = 64
+_VACUUM_FREE_RATIO = 0.25
+
+
+class PostDB(SQLModel, table=True):
+    owner_id: int = Field(default=None, primary_key=True)
+    chat_id: int = Field(default=None, primary_key=True)
+    id: int = Field(default=None, primary_key=True)
+
+
+class FloorDB(SQLModel, table=True):
+    __tablename__ = "floors"  # type: ignore
+
+    # Every id of the route up to `floor` is considered added:
+    # older ids are pruned from PostDB
+    owner_id: int = Field(default=None, primary_key=True)
+    chat_id: int = Field(default=None, primary_key=True)
+    floor: int
+
+
+class OutboxDB(SQLModel, table=True):
+    __tablename__ = "outbox"  # type: ignore
+
+    owner_id: int = Field(default=None, primary_key=True)
+    chat_id: int = Field(default=None, primary_key=True)
+    post_id: int = Field(default=None, primary_key=True)
+    date: datetime
+    steps: str  # JSON
+    sent_steps: int = 0
+    attempts: int = 0
+    next_attempt_at: float = 0
+
+
+class FingerprintDB(SQLModel, table=True):
+    __tablename__ = "fingerprints"  # type: ignore
+
+    # Lookups go by primary key, so they don't slow down as the table grows
+    chat_id: int = Field(default=None, primary_key=True)
+    fingerprint: int = Field(default=None, primary_key=True)
+    date: float  # Unix time
+
+
+def _outbox_key(item: OutboxItem):
+    return (
+        OutboxDB.owner_id == item.owner_id,
+        OutboxDB.chat_id == item.chat_id,
+        OutboxDB.post_id == item.post_id,
+    )
+
+
+def _set_pragmas(dbapi_connection: Any, connection_record: Any):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # Safe with WAL: a crash can lose only the last commit, not corrupt the file
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def _stash_legacy_table(engine: Engine):
+    # Before multiple routes were supported, "postdb" had only "id" column.
+    # Move it out of the way so it can be adopted by the route it belonged to.
+    table = str(PostDB.__tablename__)
+    columns = {c["name"] for c in inspect(engine).get_columns(table)}
+    if columns and "owner_id" not in columns:
+        with engine.begin() as conn:
+            conn.execute(
+                text(f"ALTER TABLE {PostDB.__tablename__} RENAME TO {_LEGACY_TABLE}")
+            )
+
+
+def _chunks(ids: Sequence[int]):
+    for idx in range(0, len(ids), _MAX_QUERY_PARAMS):
+        yield ids[idx : idx + _MAX_QUERY_PARAMS]
+
+
+class SQLiteStorage:
+    def __init__(self, db_path: str, *, keep_ids: int = 200) -> None:
+        self.keep_ids = keep_ids
+        # One connection for the whole run, shared between threads under lock
+        self.engine = create_engine(
+            f"sqlite:///{db_path}",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        event.listen(self.engine, "connect", _set_pragmas)
+        self._lock = threading.RLock()
+        _stash_legacy_table(self.engine)
+        SQLModel.metadata.create_all(self.engine)
+        self.session = Session(self.engine)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args: Any):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self.session.close()
+            self.checkpoint()
+            self.engine.dispose()
+
+    def checkpoint(self):
+        # Move everything from WAL to the database file, so it can be copied
+        with self._lock, self.engine.connect() as conn:
+            conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+
+    def has_legacy_posts(self) -> bool:
+        return inspect(self.engine).has_table(_LEGACY_TABLE)
+
+    def adopt_legacy_posts(self, *, owner_id: int, chat_id: int):
+        if not self.has_legacy_posts():
+            return
+        with self._lock:
+            self.session.execute(
+                text(
+                    f"INSERT OR IGNORE INTO {PostDB.__tablename__} (owner_id, chat_id, id) "
+                    f"SELECT :owner_id, :chat_id, id FROM {_LEGACY_TABLE}"
+                ),
+                {"owner_id": owner_id, "chat_id": chat_id},
+            )
+            self.session.execute(text(f"DROP TABLE {_LEGACY_TABLE}"))
+            self.session.commit()
+
+    def add_posts(self, *, owner_id: int, chat_id: int, ids: Iterable[int]):
+        values = [{"owner_id": owner_id, "chat_id": chat_id, "id": id} for id in ids]
+        if not values:
+            return
+        with self._lock:
+            self.session.execute(
+                insert(PostDB.__table__).prefix_with("OR IGNORE"), values  # type: ignore
+            )
+            self.session.commit()
+
+    def add_post(self, *, owner_id: int, chat_id: int, id: int):
+        self.add_posts(owner_id=owner_id, chat_id=chat_id, ids=[id])
+
+    def _get_floor(self, owner_id: int, chat_id: int) -> int | None:
+        floor = self.session.get(FloorDB, (owner_id, chat_id))
+        return None if floor is None else floor.floor
+
+    def posts_in_db(self, *, owner_id: int, chat_id: int, ids: Iterable[int]):
+        ids = list(ids)
+        res: set[int] = set()
+        with self._lock:
+            if (floor := self._get_floor(owner_id, chat_id)) is not None:
+                res.update(id for id in ids if id <= floor)
+                ids = [id for id in ids if id > floor]
+            for chunk in _chunks(ids):
+                res.update(
+                    self.session.exec(
+                        select(PostDB.id).where(
+                            PostDB.owner_id == owner_id,
+                            PostDB.chat_id == chat_id,
+                            col(PostDB.id).in_(chunk),
+                        )
+                    )
+                )
+            self.session.commit()
+        return res
+
+    def post_in_db(self, *, owner_id: int, chat_id: int, id: int):
+        return id in self.posts_in_db(owner_id=owner_id, chat_id=chat_id, ids=[id])
+
+    def get_last_post_id(self, *, owner_id: int, chat_ids: Iterable[int]):
+        # High-water mark of the owner: every chat has seen posts up to this id
+        chat_ids = set(chat_ids)
+        with self._lock:
+            last_ids: list[int] = (
+                self.session.execute(
+                    select(func.max(PostDB.id))  # type: ignore
+                    .where(
+                        PostDB.owner_id == owner_id, col(PostDB.chat_id).in_(chat_ids)
+                    )
+                    .group_by(PostDB.chat_id)
+                )
+                .scalars()
+                .all()
+            )
+            self.session.commit()
+        if not chat_ids or len(last_ids) < len(chat_ids):
+            return None
+        return min(last_ids)
+
+    def prune(self):
+        # Keep `keep_ids` latest ids of every route, older ones are covered
+        # by the route floor. Then give freed space back if there is a lot.
+        with self._lock:
+            routes = self.session.exec(
+                select(PostDB.owner_id, PostDB.chat_id)
+                .group_by(PostDB.owner_id, PostDB.chat_id)
+                .having(func.count() > self.keep_ids)
+            ).all()
+            for owner_id, chat_id in routes:
+                route = (PostDB.owner_id == owner_id, PostDB.chat_id == chat_id)
+                floor = self.session.exec(
+                    select(PostDB.id)
+                    .where(*route)
+                    .order_by(col(PostDB.id).desc())
+                    .offset(self.keep_ids)
+                    .limit(1)
+                ).one()
+                self.session.execute(delete(PostDB).where(*route, PostDB.id <= floor))
+                # Floor never goes down, even if older ids were added since
+                self.session.merge(
+                    FloorDB(
+                        owner_id=owner_id,
+                        chat_id=chat_id,
+                        floor=max(floor, self._get_floor(owner_id, chat_id) or floor),
+                    )
+                )
+            self.session.commit()
+            self._vacuum()
+
+    def _vacuum(self):
+        free_pages = self.session.execute(text("PRAGMA freelist_count")).scalar_one()
+        pages = self.session.execute(text("PRAGMA page_count")).scalar_one()
+        self.session.commit()
+        if free_pages < max(_VACUUM_MIN_FREE_PAGES, pages * _VACUUM_FREE_RATIO):
+            return
+        with self.engine.connect() as conn:
+            conn.execute(text("VACUUM"))
+
+    def enqueue_posts(self, items: Iterable[OutboxItem]):
+        items = list(items)
+        if not items:
+            return
+        with self._lock:
+            # Post already added (maybe published and removed from the outbox
+            # by now) is never enqueued again
+            routes: dict[tuple[int, int], list[OutboxItem]] = {}
+            for item in items:
+                routes.setdefault((item.owner_id, item.chat_id), []).append(item)
+            items = []
+            for (owner_id, chat_id), route_items in routes.items():
+                added = self.posts_in_db(
+                    owner_id=owner_id,
+                    chat_id=chat_id,
+                    ids=(item.post_id for item in route_items),
+                )
+                items += (item for item in route_items if item.post_id not in added)
+            if not items:
+                return
+            # Both in one transaction: a post is either enqueued and added, or neither
+            self.session.execute(
+                insert(OutboxDB.__table__).prefix_with("OR IGNORE"),  # type: ignore
+                [{**item.dict(), "steps": json.dumps(item.steps)} for item in items],
+            )
+            self.session.execute(
+                insert(PostDB.__table__).prefix_with("OR IGNORE"),  # type: ignore
+                [
+                    {
+                        "owner_id": item.owner_id,
+                        "chat_id": item.chat_id,
+                        "id": item.post_id,
+                    }
+                    for item in items
+                ],
+            )
+            self.session.commit()
+
+    def get_outbox(self):
+        with self._lock:
+            rows = self.session.exec(
+                select(OutboxDB).order_by(
+                    OutboxDB.date, OutboxDB.post_id  # pyright: ignore
+                )
+            ).all()
+            self.session.commit()
+        return [
+            OutboxItem(
+                owner_id=row.owner_id,
+                chat_id=row.chat_id,
+                post_id=row.post_id,
+                date=row.date,
+                steps=json.loads(row.steps),
+                sent_steps=row.sent_steps,
+                attempts=row.attempts,
+                next_attempt_at=row.next_attempt_at,
+            )
+            for row in rows
+        ]
+
+    def update_outbox_item(self, item: OutboxItem):
+        with self._lock:
+            self.session.execute(
+                update(OutboxDB)
+                .where(*_outbox_key(item))
+                .values(
+                    sent_steps=item.sent_steps,
+                    attempts=item.attempts,
+                    next_attempt_at=item.next_attempt_at,
+                )
+            )
+            self.session.commit()
+
+    def remove_outbox_item(self, item: OutboxItem):
+        with self._lock:
+            self.session.execute(delete(OutboxDB).where(*_outbox_key(item)))
+            self.session.commit()
+
+    def get_fingerprints(self, *, chat_id: int, fingerprints: Iterable[int]):
+        res: dict[int, float] = {}
+        with self._lock:
+            for chunk in _chunks(list(fingerprints)):
+                res.update(
+                    self.session.exec(
+                        select(FingerprintDB.fingerprint, FingerprintDB.date).where(
+                            FingerprintDB.chat_id == chat_id,
+                            col(FingerprintDB.fingerprint).in_(chunk),
+                        )
+                    ).all()
+                )
+            self.session.commit()
+        return res
+
+    def add_fingerprints(
+        self,
+        *,
+        chat_id: int,
+        fingerprints: Mapping[int, float],
+        expire_before: float,
+    ):
+        with self._lock:
+            if fingerprints:
+                self.session.execute(
+                    insert(FingerprintDB.__table__).prefix_with(  # type: ignore
+                        "OR REPLACE"
+                    ),
+                    [
+                        {"chat_id": chat_id, "fingerprint": fingerprint, "date": date}
+                        for fingerprint, date in fingerprints.items()
+                    ],
+                )
+            self.session.execute(
+                delete(FingerprintDB).where(
+                    FingerprintDB.chat_id == chat_id,
+                    col(FingerprintDB.date) < expire_before,
+                )
+            )
+            self.session.commit()
@@ -1,68 +1,809 @@
 from __future__ import annotations
 
+import asyncio
 import contextlib
-from typing import Any
+import hashlib
+import logging
+import os
+import sys
+import time
+from collections.abc import Collection, Coroutine
+from typing import TYPE_CHECKING, Any, Literal, TypeVar
 
-import boto3
-import botocore.exceptions
-import sentry_sdk
-from sentry_sdk.integrations.serverless import serverless_function
+from flow import metrics
+from flow.db import Change, RecordingStorage, Storage, apply_changes, open_storage
+from flow.media import PhotoProcessor
+from flow.metrics import collect_metrics
+from flow.models import LambdaSettings, OutboxItem, Post, Route, Settings
+from flow.snapshot import compress_file, decompress_chunks
+from flow.tg import (
+    AsyncBot,
+    RateLimiter,
+    fingerprint_post,
+    plan_post,
+    publish_item_async,
+)
+from flow.vk import get_walls_async, probe_walls_async
 
-from flow.db import Storage
-from flow.models import LambdaSettings, Settings
-from flow.tg import publish_post
-from flow.vk import get_wall
+if TYPE_CHECKING:
+    import httpx
 
+logger = logging.getLogger(__name__)
+T = TypeVar("T")
 
-def _init_sentry(dsn: str | None):
+# Fetch stage puts new posts to the outbox, publish stage sends them to
+# Telegram. They can run together or on their own schedules. fetch_walls
+# and publish_outbox are also used by the long-running daemon.
+Stage = Literal["all", "fetch", "publish"]
+# Seconds idle HTTP connections are kept between warm Lambda invocations
+_KEEPALIVE_EXPIRY = 60
+# Database uploads that lost the race to another run, see db_from_s3
+_MAX_UPLOAD_ATTEMPTS = 3
+
+# boto3, botocore, sentry_sdk and httpx are heavy, so they are imported only
+# on paths that use them to keep Lambda cold start fast.
+
+
+def init_sentry(dsn: str | None, traces_sample_rate: float | None = None):
     if dsn is not None:
-        sentry_sdk.init(dsn)
+        import sentry_sdk
+
+        sentry_sdk.init(dsn, traces_sample_rate=traces_sample_rate)
+
+
+def _make_outbox_item(
+    *, owner_id: int, chat_id: int, post: Post, steps: dict[int, list[dict[str, Any]]]
+):
+    # Rendered once per post, even if it goes to several chats
+    if post.id not in steps:
+        with metrics.span("tg.render"):
+            steps[post.id] = [step.dict() for step in plan_post(post)]
+    return OutboxItem(
+        owner_id=owner_id,
+        chat_id=chat_id,
+        post_id=post.id,
+        date=post.date,
+        steps=steps[post.id],
+    )
+
+
+def _find_duplicates(
+    settings: Settings,
+    storage: Storage,
+    *,
+    chat_id: int,
+    posts: list[Post],
+    fingerprints: dict[int, int | None],
+):
+    # Posts that repeat content of a recent post in the chat (reposts,
+    # re-uploads) and fingerprints of all `posts` with their dates
+    for post in posts:
+        if post.id not in fingerprints:
+            fingerprints[post.id] = fingerprint_post(post)
+    post_fingerprints = {
+        post.id: fingerprint
+        for post in posts
+        if (fingerprint := fingerprints[post.id]) is not None
+    }
+    with metrics.span("db.read"):
+        seen = storage.get_fingerprints(
+            chat_id=chat_id, fingerprints=set(post_fingerprints.values())
+        )
+    duplicate_ids: set[int] = set()
+    dates: dict[int, float] = {}
+    for post in posts:
+        if (fingerprint := post_fingerprints.get(post.id)) is None:
+            continue
+        date = post.date.timestamp()
+        if (last_date := dates.get(fingerprint, seen.get(fingerprint))) is not None:
+            if abs(date - last_date) <= settings.dedupe_window:
+                duplicate_ids.add(post.id)
+            date = max(date, last_date)
+        dates[fingerprint] = date
+    return duplicate_ids, dates
+
+
+def _enqueue_new_posts(
+    settings: Settings,
+    *,
+    storage: Storage,
+    owner_id: int,
+    chat_id: int,
+    wall: list[Post],
+    steps: dict[int, list[dict[str, Any]]],
+    fingerprints: dict[int, int | None],
+):
+    # `steps` and `fingerprints` are cached by post id, shared between chats
+    with metrics.span("db.read"):
+        seen_ids = storage.posts_in_db(
+            owner_id=owner_id, chat_id=chat_id, ids=[post.id for post in wall]
+        )
+    posts = [post for post in wall if post.id not in seen_ids]
+    metrics.incr("posts.skipped", len(wall) - len(posts))
+
+    duplicate_ids: set[int] = set()
+    dates: dict[int, float] = {}
+    if settings.dedupe_window and posts:
+        duplicate_ids, dates = _find_duplicates(
+            settings,
+            storage,
+            chat_id=chat_id,
+            posts=posts,
+            fingerprints=fingerprints,
+        )
+    items = [
+        _make_outbox_item(owner_id=owner_id, chat_id=chat_id, post=post, steps=steps)
+        for post in posts
+        if post.id not in duplicate_ids
+    ]
+    with metrics.span("db.write"):
+        storage.enqueue_posts(items)
+        if duplicate_ids:
+            # Never published, but never fetched again either
+            storage.add_posts(owner_id=owner_id, chat_id=chat_id, ids=duplicate_ids)
+        if dates:
+            storage.add_fingerprints(
+                chat_id=chat_id,
+                fingerprints=dates,
+                expire_before=time.time() - settings.dedupe_window,
+            )
+    metrics.incr("posts.enqueued", len(items))
+    metrics.incr("posts.duplicates", len(duplicate_ids))
+    return len(items)
+
+
+def _get_since_ids(storage: Storage, routes: list[Route]):
+    chat_ids: dict[int, list[int]] = {}
+    for route in routes:
+        chat_ids.setdefault(route.vk_owner_id, []).extend(route.tg_chat_ids)
+    with metrics.span("db.read"):
+        return {
+            owner_id: storage.get_last_post_id(
+                owner_id=owner_id, chat_ids=owner_chat_ids
+            )
+            for owner_id, owner_chat_ids in chat_ids.items()
+        }
+
 
+def _adopt_legacy_posts(settings: Settings, storage: Storage):
+    if not storage.has_legacy_posts():
+        return
+    if route := settings.legacy_route:
+        owner_id, chat_id = route.vk_owner_id, route.tg_chat_ids[0]
+    else:
+        # Without VK_OWNER_ID and TG_CHAT_ID it is clear only with one route
+        pairs = {
+            (route.vk_owner_id, chat_id)
+            for route in settings.routes
+            for chat_id in route.tg_chat_ids
+        }
+        if len(pairs) != 1:
+            raise ValueError(
+                "Database has posts from older version without owner and chat, "
+                "set VK_OWNER_ID and TG_CHAT_ID they were published with"
+            )
+        ((owner_id, chat_id),) = pairs
+    storage.adopt_legacy_posts(owner_id=owner_id, chat_id=chat_id)
 
-def main(settings: Settings) -> int:
-    storage = Storage(settings.db_path)
-    wall = get_wall(token=settings.vk_token, owner_id=settings.vk_owner_id)
 
-    for post in wall:
-        if storage.post_in_db(post.id):
+async def fetch_walls(
+    settings: Settings,
+    *,
+    storage: Storage,
+    client: httpx.AsyncClient,
+    owner_ids: Collection[int] | None = None,
+    probed: bool = False,
+) -> dict[int, int | BaseException]:
+    # Fetch stage: new posts of every wall (or only of `owner_ids`) are rendered
+    # and put to the outbox. Returns number of new posts or error per wall.
+    # With `probed` walls of `owner_ids` are already known to have changed.
+    _adopt_legacy_posts(settings, storage)
+    routes = [
+        route
+        for route in settings.get_routes()
+        if owner_ids is None or route.vk_owner_id in owner_ids
+    ]
+
+    since_ids = _get_since_ids(storage, routes)
+
+    # Fetch every wall once, even if it is shared between several routes.
+    # Walls are fetched together, so many of them take only a few requests.
+    with metrics.span("vk.fetch"):
+        walls = await get_walls_async(
+            client=client,
+            token=settings.vk_token,
+            since_ids=since_ids,
+            page_size=settings.vk_page_size,
+            max_pages=settings.vk_max_pages,
+            photo_policy=settings.photo_size_policy,
+            semaphore=asyncio.Semaphore(settings.max_workers),
+            probe=settings.vk_probe and not probed,
+            endpoint=settings.vk_endpoint,
+        )
+
+    new_posts: dict[int, int] = {}
+    # Post ids are unique only within a wall
+    steps: dict[int, dict[int, list[dict[str, Any]]]] = {}
+    fingerprints: dict[int, dict[int, int | None]] = {}
+    for route in routes:
+        if isinstance(wall := walls[route.vk_owner_id], BaseException):
             continue
-        publish_post(token=settings.tg_token, chat_id=settings.tg_chat_id, post=post)
-        storage.add_post(post.id)
-        break
+        for chat_id in route.tg_chat_ids:
+            new_posts[route.vk_owner_id] = new_posts.get(
+                route.vk_owner_id, 0
+            ) + _enqueue_new_posts(
+                settings,
+                storage=storage,
+                owner_id=route.vk_owner_id,
+                chat_id=chat_id,
+                wall=wall,
+                steps=steps.setdefault(route.vk_owner_id, {}),
+                fingerprints=fingerprints.setdefault(route.vk_owner_id, {}),
+            )
+    with metrics.span("db.prune"):
+        storage.prune()
+    return {
+        owner_id: wall
+        if isinstance(wall, BaseException)
+        else new_posts.get(owner_id, 0)
+        for owner_id, wall in walls.items()
+    }
+
+
+def _retry_later(settings: Settings, storage: Storage, item: OutboxItem):
+    item.attempts += 1
+    if item.attempts >= settings.outbox_max_attempts:
+        # Give up, otherwise the chat is stuck on this post forever
+        logger.warning(
+            "Dropping post %s for chat %s after %s attempts",
+            item.post_id,
+            item.chat_id,
+            item.attempts,
+        )
+        storage.remove_outbox_item(item)
+        metrics.incr("posts.dropped")
+        return
+    delay = settings.outbox_retry_delay * 2 ** (item.attempts - 1)
+    item.next_attempt_at = time.time() + delay
+    storage.update_outbox_item(item)
+    metrics.incr("posts.failed")
+
+
+async def _publish_queue(
+    *,
+    settings: Settings,
+    storage: Storage,
+    bot: AsyncBot,
+    semaphore: asyncio.Semaphore,
+    items: list[OutboxItem],
+    deadline: float | None,
+    stop: asyncio.Event | None,
+):
+    published = 0
+    for item in items:
+        if settings.publish_limit and published >= settings.publish_limit:
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        if stop is not None and stop.is_set():
+            break
+        # Posts go out in order, so the one waiting for retry holds back the rest
+        if item.next_attempt_at > time.time():
+            break
+        try:
+            async with semaphore:
+                with metrics.span("tg.publish"):
+                    await publish_item_async(bot=bot, item=item)
+        except Exception:
+            _retry_later(settings, storage, item)
+            raise
+        # Removed right away so a post is never republished if the run is cut short
+        with metrics.span("db.write"):
+            storage.remove_outbox_item(item)
+        metrics.incr("posts.published")
+        published += 1
+
+
+def _get_outbox(settings: Settings, storage: Storage):
+    # Only items of configured routes
+    routes = {
+        (route.vk_owner_id, chat_id)
+        for route in settings.get_routes()
+        for chat_id in route.tg_chat_ids
+    }
+    with metrics.span("db.read"):
+        outbox = storage.get_outbox()
+    return [item for item in outbox if (item.owner_id, item.chat_id) in routes]
+
+
+def _make_rate_limiter(settings: Settings):
+    if not settings.tg_rate_limit:
+        return None
+    return RateLimiter(
+        rate=settings.tg_rate_limit, chat_rate=settings.tg_chat_rate_limit
+    )
+
+
+def _open_photo_processor(
+    settings: Settings,
+) -> contextlib.AbstractContextManager[PhotoProcessor | None]:
+    if not settings.recompress_photos:
+        return contextlib.nullcontext()
+    return PhotoProcessor(
+        max_side=settings.recompress_max_side,
+        max_bytes=settings.recompress_max_bytes,
+        cache_dir=settings.recompress_cache_dir,
+    )
+
+
+async def publish_outbox(
+    settings: Settings,
+    *,
+    storage: Storage,
+    client: httpx.AsyncClient,
+    deadline: float | None,
+    stop: asyncio.Event | None = None,
+) -> list[BaseException]:
+    # Publish stage: drains the outbox, doesn't touch VK
+    queues: dict[tuple[int, int], list[OutboxItem]] = {}
+    for item in _get_outbox(settings, storage):
+        queues.setdefault((item.owner_id, item.chat_id), []).append(item)
+
+    with _open_photo_processor(settings) as media:
+        bot = AsyncBot(
+            settings.tg_token,
+            client=client,
+            endpoint=settings.tg_endpoint,
+            # Recompressed photos can only be uploaded
+            upload_photos=settings.tg_upload_photos or media is not None,
+            max_photo_bytes=settings.tg_max_photo_bytes,
+            media=media,
+            limiter=_make_rate_limiter(settings),
+            max_retries=settings.tg_max_retries,
+        )
+        semaphore = asyncio.Semaphore(settings.max_workers)
+        published = await asyncio.gather(
+            *(
+                _publish_queue(
+                    settings=settings,
+                    storage=storage,
+                    bot=bot,
+                    semaphore=semaphore,
+                    items=items,
+                    deadline=deadline,
+                    stop=stop,
+                )
+                for items in queues.values()
+            ),
+            return_exceptions=True,
+        )
+    return [result for result in published if isinstance(result, BaseException)]
+
+
+def _raise_first_exception(results: list[Any]):
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def _main(
+    settings: Settings,
+    *,
+    storage: Storage,
+    client: httpx.AsyncClient,
+    deadline: float | None,
+    stage: Stage = "all",
+    probed_owner_ids: Collection[int] | None = None,
+):
+    errors: list[BaseException] = []
+    if stage != "publish":
+        fetched = await fetch_walls(
+            settings,
+            storage=storage,
+            client=client,
+            owner_ids=probed_owner_ids,
+            probed=probed_owner_ids is not None,
+        )
+        errors += [res for res in fetched.values() if isinstance(res, BaseException)]
+    if stage != "fetch":
+        errors += await publish_outbox(
+            settings, storage=storage, client=client, deadline=deadline
+        )
+    _raise_first_exception(errors)
+
+
+async def _has_work(
+    settings: Settings,
+    *,
+    storage: Storage,
+    client: httpx.AsyncClient,
+    stage: Stage = "all",
+) -> tuple[bool, set[int] | None]:
+    # Whether the run would do anything: some post in the outbox is due
+    # or some wall has new posts. If walls were probed, also the ones
+    # to fetch, so they are not probed again.
+    if stage != "fetch":
+        now = time.time()
+        if any(item.next_attempt_at <= now for item in _get_outbox(settings, storage)):
+            return True, None
+    if stage == "publish":
+        return False, None
+
+    since_ids = _get_since_ids(storage, settings.get_routes())
+    if None in since_ids.values():
+        return True, None
+    changes = await probe_walls_async(
+        client=client,
+        token=settings.vk_token,
+        since_ids=since_ids,  # type: ignore
+        semaphore=asyncio.Semaphore(settings.max_workers),
+        endpoint=settings.vk_endpoint,
+    )
+    # Errors are reported by the full run
+    changed = {owner_id for owner_id, c in changes.items() if c is not False}
+    return bool(changed), changed
+
+
+def collect_run_metrics(settings: Settings):
+    return collect_metrics(
+        emit=settings.emit_metrics, sentry=settings.sentry_dsn is not None
+    )
+
+
+class WarmContext:
+    # Warm Lambda container keeps the process between invocations, so what is
+    # slow to set up is kept here: parsed settings, Sentry, S3 client, open
+    # storage and HTTP connection pool. Everything is created on first use.
+    def __init__(self, settings: LambdaSettings) -> None:
+        self.settings = settings
+        # Pooled connections are bound to the loop they were opened in
+        self._loop = asyncio.new_event_loop()
+        self._client: httpx.AsyncClient | None = None
+        self._storage: Storage | None = None
+        # Changes made during current invocation, see db_from_s3
+        self.changes: list[Change] = []
+        # Walls with new posts if they were probed before sync, see _should_sync
+        self.probed_owner_ids: set[int] | None = None
+        self._s3: Any = None
+        self._sentry = False
+
+    def run(self, coro: Coroutine[Any, Any, T]) -> T:
+        return self._loop.run_until_complete(coro)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            import httpx
+
+            # With default 5 seconds nothing would survive until next invocation
+            self._client = httpx.AsyncClient(
+                timeout=self.settings.http_timeout,
+                limits=httpx.Limits(keepalive_expiry=_KEEPALIVE_EXPIRY),
+            )
+        return self._client
+
+    @property
+    def storage(self) -> Storage:
+        if self._storage is None:
+            self._storage = open_storage(self.settings)
+        return RecordingStorage(self._storage, self.changes)  # type: ignore
 
+    @property
+    def s3(self) -> Any:
+        if self._s3 is None:
+            self._s3 = _make_s3_client(self.settings)
+        return self._s3
+
+    def init_sentry(self):
+        if not self._sentry:
+            init_sentry(
+                self.settings.sentry_dsn, self.settings.sentry_traces_sample_rate
+            )
+            self._sentry = True
+
+    def checkpoint(self):
+        if self._storage is not None:
+            self._storage.checkpoint()
+
+    def close_storage(self):
+        # Before the database file is replaced or after a failed run,
+        # which could leave the session in a bad state
+        if self._storage is not None:
+            self._storage.close()
+            self._storage = None
+
+    def close(self):
+        self.close_storage()
+        if self._client is not None:
+            self.run(self._client.aclose())
+        self._loop.close()
+
+
+_warm_context: WarmContext | None = None
+
+
+def _get_warm_context() -> WarmContext:
+    # Everything is recreated only if settings have changed. Lambda starts
+    # a new container for that, but local and test runs don't. Whole
+    # environment can't be compared: Lambda sets _X_AMZN_TRACE_ID anew
+    # before every invocation.
+    global _warm_context
+    settings = LambdaSettings()  # type: ignore
+    if _warm_context is not None and _warm_context.settings != settings:
+        _warm_context.close()
+        _warm_context = None
+    if _warm_context is None:
+        _warm_context = WarmContext(settings)
+    return _warm_context
+
+
+async def main_async(
+    settings: Settings, deadline: float | None = None, *, stage: Stage = "all"
+) -> int:
+    import httpx
+
+    with collect_run_metrics(settings):
+        async with httpx.AsyncClient(timeout=settings.http_timeout) as client:
+            with open_storage(settings) as storage:
+                await _main(
+                    settings,
+                    storage=storage,
+                    client=client,
+                    deadline=deadline,
+                    stage=stage,
+                )
     return 0
 
 
-@contextlib.contextmanager
-def db_from_s3(settings: LambdaSettings):
-    client = boto3.client(  # type: ignore
+def main(
+    settings: Settings,
+    deadline: float | None = None,
+    *,
+    stage: Stage = "all",
+    context: WarmContext | None = None,
+) -> int:
+    if context is None:
+        return asyncio.run(main_async(settings, deadline=deadline, stage=stage))
+
+    with collect_run_metrics(settings):
+        try:
+            context.run(
+                _main(
+                    settings,
+                    storage=context.storage,
+                    client=context.client,
+                    deadline=deadline,
+                    stage=stage,
+                    probed_owner_ids=context.probed_owner_ids,
+                )
+            )
+        except BaseException:
+            context.close_storage()
+            raise
+    return 0
+
+
+def _file_md5(path: str) -> str | None:
+    if not os.path.exists(path):
+        return None
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _read_etag(path: str) -> str | None:
+    with contextlib.suppress(FileNotFoundError):
+        with open(path) as f:
+            return f.read()
+
+
+def _write_etag(path: str, etag: str):
+    with open(path, "w") as f:
+        f.write(etag)
+
+
+def _count_downloaded(body: Any):
+    for chunk in body.iter_chunks():
+        metrics.incr("s3.bytes_downloaded", len(chunk), unit="Bytes")
+        yield chunk
+
+
+def _make_s3_client(settings: LambdaSettings) -> Any:
+    import boto3
+
+    return boto3.client(  # type: ignore
         service_name="s3",
         endpoint_url=settings.s3_endpoint,
         aws_access_key_id=settings.aws_access_key_id,
         aws_secret_access_key=settings.aws_secret_access_key,
     )
+
+
+def _download_db(
+    settings: LambdaSettings,
+    client: Any,
+    *,
+    etag: str | None,
+    context: WarmContext | None,
+) -> str | None:
+    # Returns ETag of the object the local copy matches now
+    import botocore.exceptions
+
+    conditions = {"IfNoneMatch": etag} if etag else {}
+    with metrics.span("s3.download"):
+        try:
+            response = client.get_object(
+                Bucket=settings.s3_bucket, Key=settings.s3_key, **conditions
+            )
+        except botocore.exceptions.ClientError:
+            # Either local copy is up to date (304)
+            # or initial download (object doesn't exist yet)
+            return etag
+        tmp_path = f"{settings.db_path}.download"
+        with open(tmp_path, "wb") as f:
+            decompress_chunks(_count_downloaded(response["Body"]), f)
+        if context is not None:
+            context.close_storage()
+        os.replace(tmp_path, settings.db_path)
+        _write_etag(f"{settings.db_path}.etag", response["ETag"])
+        return response["ETag"]
+
+
+def _is_upload_conflict(exc: Any) -> bool:
+    # 412 when the object has changed, 409 when it is being changed right now
+    return exc.response["Error"]["Code"] in (
+        "PreconditionFailed",
+        "ConditionalRequestConflict",
+    )
+
+
+def _upload_db(
+    settings: LambdaSettings,
+    client: Any,
+    *,
+    etag: str | None,
+    context: WarmContext | None,
+):
+    import botocore.exceptions
+
+    upload_path = f"{settings.db_path}.upload"
+    for attempt in range(1, _MAX_UPLOAD_ATTEMPTS + 1):
+        with metrics.span("s3.compress"):
+            with open(settings.db_path, "rb") as src, open(upload_path, "wb") as f:
+                compress_file(src, f, settings.s3_compression)
+        metrics.incr("s3.bytes_uploaded", os.path.getsize(upload_path), unit="Bytes")
+        # Written only if nobody else has uploaded since this run downloaded
+        # the object: fetch and publish stages can run at the same time
+        conditions = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            with metrics.span("s3.upload"), open(upload_path, "rb") as f:
+                response = client.put_object(
+                    Bucket=settings.s3_bucket, Key=settings.s3_key, Body=f, **conditions
+                )
+        except botocore.exceptions.ClientError as exc:
+            if (
+                context is None
+                or attempt == _MAX_UPLOAD_ATTEMPTS
+                or not _is_upload_conflict(exc)
+            ):
+                raise
+            # Take the newer copy and make the changes of this run on it
+            metrics.incr("s3.conflicts")
+            etag = _download_db(settings, client, etag=None, context=context)
+            with open_storage(settings) as storage:
+                apply_changes(storage, context.changes)
+            continue
+        finally:
+            os.remove(upload_path)
+        _write_etag(f"{settings.db_path}.etag", response["ETag"])
+        return
+
+
+@contextlib.contextmanager
+def db_from_s3(settings: LambdaSettings, *, context: WarmContext | None = None):
+    # With `context` changes of the run are recorded, so they can be merged
+    # into the object if another run uploads it in the meantime
+    client = _make_s3_client(settings) if context is None else context.s3
+    if context is not None:
+        context.changes.clear()
+    # Warm Lambda keeps /tmp, so the database from previous invocation
+    # is reused as long as it matches the object in the bucket.
+    etag = _read_etag(f"{settings.db_path}.etag")
+    if not os.path.exists(settings.db_path):
+        etag = None
+    etag = _download_db(settings, client, etag=etag, context=context)
+    md5 = _file_md5(settings.db_path)
+
     try:
-        client.download_file(
-            Bucket=settings.s3_bucket, Key=settings.s3_key, Filename=settings.db_path
-        )
-    except botocore.exceptions.ClientError:
-        # Initial download (object doesn't exist yet)
-        pass
-    yield
-    client.upload_file(
-        Bucket=settings.s3_bucket, Key=settings.s3_key, Filename=settings.db_path
+        yield
+    finally:
+        # Upload progress even if something failed, so nothing is republished
+        if context is not None:
+            context.checkpoint()
+        new_md5 = _file_md5(settings.db_path)
+        if new_md5 is not None and (etag is None or new_md5 != md5):
+            _upload_db(settings, client, etag=etag, context=context)
+
+
+def _get_deadline(settings: LambdaSettings, context: Any) -> float | None:
+    if context is None:
+        return None
+    remaining = context.get_remaining_time_in_millis() / 1000
+    # Leave time to upload the database
+    return time.monotonic() + remaining - settings.lambda_time_reserve
+
+
+def _object_changed(warm: WarmContext, etag: str) -> bool:
+    import botocore.exceptions
+
+    settings = warm.settings
+    with metrics.span("s3.head"):
+        try:
+            warm.s3.head_object(
+                Bucket=settings.s3_bucket, Key=settings.s3_key, IfNoneMatch=etag
+            )
+        except botocore.exceptions.ClientError as exc:
+            return exc.response.get("Error", {}).get("Code") != "304"
+    return True
+
+
+def _should_sync(warm: WarmContext, stage: Stage) -> bool:
+    # Warm Lambda keeps the database from previous run. Its high-water marks
+    # can only be behind the bucket copy, never ahead. So if even they show
+    # nothing new, the run is skipped without downloading the database.
+    settings = warm.settings
+    warm.probed_owner_ids = None
+    etag = _read_etag(f"{settings.db_path}.etag")
+    if not settings.vk_probe or etag is None or not os.path.exists(settings.db_path):
+        return True
+    # Outbox is different: separate fetch function fills it in the bucket copy,
+    # so the local one is reliable only if the object hasn't changed
+    if stage != "fetch" and _object_changed(warm, etag):
+        return True
+    has_work, warm.probed_owner_ids = warm.run(
+        _has_work(settings, storage=warm.storage, client=warm.client, stage=stage)
     )
+    return has_work
 
 
-@serverless_function
-def lambda_handler(event: Any, handler: Any):
-    settings = LambdaSettings()  # type: ignore
-    _init_sentry(settings.sentry_dsn)
-    with db_from_s3(settings):
-        main(settings)
+def _handle(warm: WarmContext, context: Any, stage: Stage):
+    settings = warm.settings
+    deadline = _get_deadline(settings, context)
+    with collect_run_metrics(settings):
+        if not _should_sync(warm, stage):
+            metrics.incr("runs.skipped")
+            return
+        with db_from_s3(settings, context=warm):
+            main(settings, deadline=deadline, stage=stage, context=warm)
+
+
+def _lambda_handler(context: Any, stage: Stage):
+    warm = _get_warm_context()
+    if warm.settings.sentry_dsn is None:
+        return _handle(warm, context, stage)
+
+    from sentry_sdk.integrations.serverless import serverless_function
+
+    warm.init_sentry()
+    return serverless_function(_handle)(warm, context, stage)
+
+
+def lambda_handler(event: Any, context: Any):
+    return _lambda_handler(context, "all")
+
+
+def fetch_lambda_handler(event: Any, context: Any):
+    return _lambda_handler(context, "fetch")
+
+
+def publish_lambda_handler(event: Any, context: Any):
+    return _lambda_handler(context, "publish")
 
 
 if __name__ == "__main__":
+    # python flow/main.py [all|fetch|publish]
     settings = Settings(".env")  # type: ignore
-    _init_sentry(settings.sentry_dsn)
-    raise SystemExit(main(settings))
+    init_sentry(settings.sentry_dsn, settings.sentry_traces_sample_rate)
+    raise SystemExit(main(settings, stage=sys.argv[1] if len(sys.argv) > 1 else "all"))  # type: ignore
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import logging
+import math
+import os
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+from typing import Any
+
+from flow import metrics
+
+# Optional stage between VK and Telegram: photos are downloaded, downscaled
+# and recompressed to JPEG before they are uploaded, so large VK originals
+# don't make Telegram slow or reject them. Requires Pillow (`media` extra),
+# which is imported only when the stage is used.
+
+MAX_SOURCE_BYTES = 50 * 1024 * 1024  # Originals are shrunk, so allow more
+_QUALITIES = (90, 80, 70, 60)
+_MIN_SIDE = 320
+_CACHE_TTL = 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+def recompress(data: bytes, *, max_side: int, max_bytes: int) -> bytes:
+    # Runs in worker process, so takes and returns plain bytes
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as source:
+        if (
+            source.format == "JPEG"
+            and max(source.size) <= max_side
+            and len(data) <= max_bytes
+        ):
+            return data
+        # JPEG is decoded right at reduced scale, which is a lot faster
+        scale = min(max_side / max(source.size), 1)
+        width, height = source.size
+        source.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+        image: Any = ImageOps.exif_transpose(source)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+    side = min(max_side, max(image.size))
+    buffer = io.BytesIO()
+    while True:
+        image.thumbnail((side, side))
+        for quality in _QUALITIES:
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=quality, optimize=True)
+            if buffer.tell() <= max_bytes:
+                return buffer.getvalue()
+        if side <= _MIN_SIDE:
+            return buffer.getvalue()
+        side = max(side * 3 // 4, _MIN_SIDE)
+
+
+def _make_executor(max_workers: int | None) -> concurrent.futures.Executor:
+    try:
+        return concurrent.futures.ProcessPoolExecutor(max_workers)
+    except (OSError, NotImplementedError):
+        # No /dev/shm (AWS Lambda): Pillow releases the GIL
+        # while encoding, so threads still help
+        logger.info("Process pool is not available, using threads")
+        return concurrent.futures.ThreadPoolExecutor(max_workers)
+
+
+class PhotoProcessor:
+    def __init__(
+        self,
+        *,
+        max_side: int,
+        max_bytes: int,
+        cache_dir: str,
+        max_workers: int | None = None,
+    ) -> None:
+        try:
+            import PIL  # noqa: F401  # pyright: ignore[reportUnusedImport]
+        except ImportError:  # pragma: no cover
+            raise RuntimeError("Pillow is required to recompress photos") from None
+        self.max_side = max_side
+        self.max_bytes = max_bytes
+        self.max_source_bytes = MAX_SOURCE_BYTES
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._prune_cache()
+        self._executor = _make_executor(max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args: Any):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown()
+
+    def _prune_cache(self):
+        # /tmp is small in Lambda and daemon runs for long
+        expired = time.time() - _CACHE_TTL
+        for path in self.cache_dir.iterdir():
+            with contextlib.suppress(OSError):
+                if path.stat().st_mtime < expired:
+                    path.unlink()
+
+    def _cache_path(self, url: str):
+        # Limits are part of the key, so changing them doesn't reuse old output
+        key = f"{self.max_side}:{self.max_bytes}:{url}".encode()
+        return self.cache_dir / f"{hashlib.sha256(key).hexdigest()}.jpg"
+
+    def _write_cache(self, path: Path, data: bytes):
+        # Written to temporary file first, so a reader never sees partial output
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            logger.warning("Failed to cache photo", exc_info=True)
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+
+    async def get(self, url: str, download: Callable[[], Awaitable[bytes]]):
+        # Cached output is returned without downloading the photo again
+        path = self._cache_path(url)
+        with contextlib.suppress(FileNotFoundError):
+            data = path.read_bytes()
+            metrics.incr("media.cache_hits")
+            return data
+
+        source = await download()
+        loop = asyncio.get_running_loop()
+        with metrics.span("media.recompress"):
+            data = await loop.run_in_executor(
+                self._executor,
+                functools.partial(
+                    recompress,
+                    source,
+                    max_side=self.max_side,
+                    max_bytes=self.max_bytes,
+                ),
+            )
+        metrics.incr("media.photos")
+        metrics.incr("media.bytes_saved", len(source) - len(data), unit="Bytes")
+        self._write_cache(path, data)
+        return data
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import time
+from collections.abc import Generator
+from contextvars import ContextVar
+from typing import Any, Literal
+
+# Timings and counters of one run. Stages call module level `span` and `incr`,
+# which are no-op unless called inside `collect_metrics`. Metrics are kept in
+# context variable, so they don't have to be passed through every call and
+# are visible in asyncio tasks started within the run.
+
+NAMESPACE = "flow"
+Unit = Literal["Milliseconds", "Count", "Bytes"]
+
+
+class Metrics:
+    def __init__(self, *, sentry: bool = False) -> None:
+        self.values: dict[str, float] = {}
+        self.units: dict[str, Unit] = {}
+        self._transaction: Any = None
+        if sentry:
+            import sentry_sdk
+
+            self._transaction = sentry_sdk.start_transaction(op="flow.run", name="flow")
+
+    def incr(self, name: str, value: float = 1, *, unit: Unit = "Count"):
+        self.values[name] = self.values.get(name, 0) + value
+        self.units[name] = unit
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Generator[None, None, None]:
+        # Time is summed over calls, so concurrent calls may add up
+        # to more than the whole run took
+        sentry_span = self._transaction and self._transaction.start_child(op=name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.incr(name, (time.perf_counter() - start) * 1000, unit="Milliseconds")
+            if sentry_span:
+                sentry_span.finish()
+
+    def finish(self, *, failed: bool = False):
+        if self._transaction:
+            self._transaction.set_status("internal_error" if failed else "ok")
+            self._transaction.finish()
+
+    def to_emf(self, timestamp: float | None = None) -> dict[str, Any]:
+        # https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+        if timestamp is None:
+            timestamp = time.time()
+        return {
+            "_aws": {
+                "Timestamp": int(timestamp * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": NAMESPACE,
+                        "Dimensions": [["Service"]],
+                        "Metrics": [
+                            {"Name": name, "Unit": unit}
+                            for name, unit in self.units.items()
+                        ],
+                    }
+                ],
+            },
+            "Service": NAMESPACE,
+            **{name: round(value, 3) for name, value in self.values.items()},
+        }
+
+
+_current: ContextVar[Metrics | None] = ContextVar("flow_metrics", default=None)
+
+
+def span(name: str) -> contextlib.AbstractContextManager[None]:
+    if metrics := _current.get():
+        return metrics.span(name)
+    return contextlib.nullcontext()
+
+
+def incr(name: str, value: float = 1, *, unit: Unit = "Count"):
+    if metrics := _current.get():
+        metrics.incr(name, value, unit=unit)
+
+
+@contextlib.contextmanager
+def collect_metrics(
+    *, emit: bool = False, sentry: bool = False
+) -> Generator[Metrics, None, None]:
+    # Nested calls share metrics of the outermost one,
+    # e. g. main() called from lambda_handler()
+    if (metrics := _current.get()) is not None:
+        yield metrics
+        return
+
+    metrics = Metrics(sentry=sentry)
+    token = _current.set(metrics)
+    failed = True
+    try:
+        with metrics.span("run"):
+            yield metrics
+        failed = False
+    finally:
+        _current.reset(token)
+        metrics.finish(failed=failed)
+        if emit:
+            # Printed as is: CloudWatch picks up EMF only from raw JSON lines
+            print(json.dumps(metrics.to_emf()), flush=True)
@@ -1,28 +1,106 @@
 from datetime import datetime
-from typing import Optional
+from typing import Any, Literal, Optional
 
-from pydantic import BaseSettings, HttpUrl
-from sqlmodel import Field, SQLModel  # pyright: ignore[reportUnknownVariableType]
+from pydantic import root_validator  # pyright: ignore[reportUnknownVariableType]
+from pydantic import BaseModel, BaseSettings, HttpUrl
 
 
-class Post(SQLModel):
+class Post(BaseModel):
     id: int
     text: Optional[str]
     photos: list[HttpUrl]
     date: datetime
 
 
-class PostDB(SQLModel, table=True):
-    id: int = Field(default=None, primary_key=True)
+class PhotoSizePolicy(BaseModel):
+    # Sizes over `max_pixels` are used only if there is nothing smaller.
+    # `preferred_types` are VK size type letters, most preferred first.
+    max_pixels: Optional[int] = None
+    preferred_types: list[str] = []
+
+
+class OutboxItem(BaseModel):
+    # Post waiting to be published to a chat. `steps` are already rendered
+    # (dicts of flow.tg.PublishStep), so publishing doesn't need VK at all.
+    owner_id: int
+    chat_id: int
+    post_id: int
+    date: datetime
+    steps: list[dict[str, Any]]
+    sent_steps: int = 0  # Steps sent before a failure are not sent again
+    attempts: int = 0
+    next_attempt_at: float = 0  # Unix time
+
+
+class Route(BaseModel):
+    vk_owner_id: int
+    tg_chat_ids: list[int]
 
 
 class Settings(BaseSettings):
     vk_token: str
-    vk_owner_id: int
+    vk_owner_id: Optional[int]
     tg_token: str
-    tg_chat_id: int
+    tg_chat_id: Optional[int]
+    routes: list[Route] = []
+    max_workers: int = 8
+    http_timeout: float = 30
+    vk_page_size: int = 20
+    vk_max_pages: int = 10
+    vk_probe: bool = True
+    vk_endpoint: str = "https://api.vk.com"
+    publish_limit: int = 1
+    dedupe_window: float = 3 * 24 * 60 * 60
+    outbox_max_attempts: int = 5
+    outbox_retry_delay: float = 60
+    poll_min_interval: float = 60
+    poll_max_interval: float = 900
+    poll_backoff: float = 2
+    photo_max_pixels: Optional[int] = None
+    photo_size_types: list[str] = []
+    tg_upload_photos: bool = False
+    tg_max_photo_bytes: int = 10 * 1024 * 1024
+    tg_endpoint: str = "https://api.telegram.org"
+    tg_rate_limit: float = 30
+    tg_chat_rate_limit: float = 1
+    tg_max_retries: int = 3
+    recompress_photos: bool = False
+    recompress_max_side: int = 2560
+    recompress_max_bytes: int = 5 * 1024 * 1024
+    recompress_cache_dir: str = "/tmp/flow-photos"
     db_path: str = "/tmp/database.db"
+    db_backend: Literal["sqlite", "compact"] = "sqlite"
+    db_keep_ids: int = 200
     sentry_dsn: Optional[str]
+    sentry_traces_sample_rate: float = 1.0
+    emit_metrics: bool = False
+
+    @root_validator(skip_on_failure=True)  # type: ignore
+    def _check_routes(cls, values: dict[str, Any]):
+        if not values["routes"] and (
+            values["vk_owner_id"] is None or values["tg_chat_id"] is None
+        ):
+            raise ValueError(
+                "Either routes or vk_owner_id and tg_chat_id should be set"
+            )
+        return values
+
+    @property
+    def legacy_route(self) -> Optional[Route]:
+        if self.vk_owner_id is None or self.tg_chat_id is None:
+            return None
+        return Route(vk_owner_id=self.vk_owner_id, tg_chat_ids=[self.tg_chat_id])
+
+    @property
+    def photo_size_policy(self):
+        return PhotoSizePolicy(
+            max_pixels=self.photo_max_pixels, preferred_types=self.photo_size_types
+        )
+
+    def get_routes(self) -> list[Route]:
+        if route := self.legacy_route:
+            return [*self.routes, route]
+        return list(self.routes)
 
 
 class LambdaSettings(Settings):
@@ -31,3 +109,6 @@ class LambdaSettings(Settings):
     s3_endpoint: str
     aws_access_key_id: str
     aws_secret_access_key: str
+    lambda_time_reserve: float = 10
+    s3_compression: Literal["none", "gzip", "zstd"] = "gzip"
+    emit_metrics: bool = True  # CloudWatch picks them up from the logs
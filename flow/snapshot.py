@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import zlib
+from collections.abc import Iterable
+from typing import Any, BinaryIO, Literal
+
+# Database snapshots in S3 are compressed, format is detected by magic bytes
+# on download. Anything else is raw database file: written by older versions
+# or with compression turned off.
+
+Compression = Literal["none", "gzip", "zstd"]
+_CHUNK_SIZE = 1024 * 1024
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_MAGIC_LENGTH = max(len(_GZIP_MAGIC), len(_ZSTD_MAGIC))
+
+
+def _require_zstandard() -> Any:
+    # Optional and used only with zstd, so imported on first use
+    try:
+        import zstandard  # pyright: ignore[reportMissingImports]
+    except ImportError:  # pragma: no cover
+        raise RuntimeError("zstandard is required for zstd snapshots") from None
+    return zstandard
+
+
+def _compressor(compression: Compression) -> Any:
+    if compression == "zstd":
+        return _require_zstandard().ZstdCompressor(level=3).compressobj()
+    # Same as gzip.compress(), but incremental
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def _decompressor(header: bytes) -> Any:
+    if header.startswith(_GZIP_MAGIC):
+        return zlib.decompressobj(31)
+    if header.startswith(_ZSTD_MAGIC):
+        return _require_zstandard().ZstdDecompressor().decompressobj()
+    return None
+
+
+def compress_file(src: BinaryIO, dst: BinaryIO, compression: Compression):
+    if compression == "none":
+        while chunk := src.read(_CHUNK_SIZE):
+            dst.write(chunk)
+        return
+    compressor = _compressor(compression)
+    while chunk := src.read(_CHUNK_SIZE):
+        dst.write(compressor.compress(chunk))
+    dst.write(compressor.flush())
+
+
+def decompress_chunks(chunks: Iterable[bytes], dst: BinaryIO):
+    # Streams into `dst`, so the whole snapshot is never held in memory
+    chunks = iter(chunks)
+    header = b""
+    for chunk in chunks:
+        header += chunk
+        if len(header) >= _MAGIC_LENGTH:
+            break
+    decompressor = _decompressor(header)
+    if decompressor is None:
+        dst.write(header)
+        for chunk in chunks:
+            dst.write(chunk)
+        return
+    dst.write(decompressor.decompress(header))
+    for chunk in chunks:
+        dst.write(decompressor.decompress(chunk))
+    dst.write(decompressor.flush())
@@ -1,67 +1,569 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import hashlib
+import html
+import json
+import logging
 import re
-import textwrap
+import time
+from json import JSONDecodeError
+from typing import TYPE_CHECKING, Any, Literal, Optional, Union
+from urllib.parse import urlsplit
 
-import markupsafe
+import requests
 from base_telegram_bot import BaseTelegramBot, TelegramBotError
-from pydantic import HttpUrl
+from pydantic import BaseModel, HttpUrl, parse_obj_as
 
-from flow.models import Post
+from flow import metrics
+from flow.media import PhotoProcessor
+from flow.models import OutboxItem, Post
 
+if TYPE_CHECKING:
+    import httpx
+
+TG_ENDPOINT = "https://api.telegram.org"
+MAX_MESSAGE_LENGTH = 4096  # Taken from python-telegram-bot constants
+MAX_CAPTION_LENGTH = 1024
+MAX_MEDIA_GROUP_SIZE = 10
+MAX_PHOTO_BYTES = 10 * 1024 * 1024  # Telegram limit for photos
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+# Same as markupsafe's striptags: drop comments and tags
+_TAG_RE = re.compile(r"<!--.*?-->|<.*?>", re.DOTALL)
+# [(scheme)?(domain)?(user_id)|(username)]
+_LINK_RE = re.compile(r"\[(?:https://)?(?:vk\.com/)?([^|\]]+)\|([^\]]+)\]")
+_MAX_ENTITY_LENGTH = len("&quot;")
+
+
+def _render_link(match: re.Match[str]):
+    # -> <a href="https://vk.com/(user_id)">(username)</a>
+    user_id, username = match.groups()
+    user_id = user_id.replace('"', "&quot;")
+    return f'<a href="https://vk.com/{user_id}">{username}</a>'
+
+
+def _render_text(text: str):
+    # Strip tags, collapse whitespace, escape HTML and format VK links.
+    # Escaping doesn't touch "[", "|" and "]", so links are formatted after it.
+    text = html.unescape(" ".join(_TAG_RE.sub("", text).split()))
+    return _LINK_RE.sub(_render_link, html.escape(text, quote=False))
+
+
+def _inside_link(text: str, start: int, pos: int):
+    link_start = text.rfind("<a ", start, pos)
+    if link_start != -1 and text.find("</a>", link_start, pos) == -1:
+        return link_start
+    return None
+
+
+def _find_break(text: str, start: int, limit: int) -> tuple[int, int]:
+    # Returns end of the chunk and start of the next one
+    end = start + limit
+    if end >= len(text):
+        return len(text), len(text)
+
+    # Prefer the last space that is not inside a link
+    pos = text.rfind(" ", start, end + 1)
+    while pos > start:
+        link_start = _inside_link(text, start, pos)
+        if link_start is None:
+            return pos, pos + 1
+        pos = text.rfind(" ", start, link_start)
+
+    # No space: cut the word without breaking a link or an entity
+    if (link_start := _inside_link(text, start, end)) is not None:
+        if link_start > start:
+            return link_start, link_start
+        link_end = text.find("</a>", start) + len("</a>")
+        return link_end, link_end
+    amp = text.rfind("&", end - _MAX_ENTITY_LENGTH + 1, end)
+    if amp > start and text.find(";", amp, end) == -1:
+        end = amp
+    return end, end
+
+
+def _render_message(text: str, limit: int = MAX_MESSAGE_LENGTH):
+    # Split rendered text into chunks that fit `limit`
+    text = _render_text(text)
+    chunks: list[str] = []
+    start = 0
+    while start < len(text):
+        end, start_ = _find_break(text, start, limit)
+        chunks.append(text[start:end])
+        start = start_
+    return chunks
+
+
+class MessageStep(BaseModel):
+    type: Literal["message"] = "message"
+    text: str  # Rendered
+
+
+class PhotosStep(BaseModel):
+    type: Literal["photos"] = "photos"
+    photo_urls: list[HttpUrl]
+    caption: Optional[str]  # Rendered
+
+
+PublishStep = Union[MessageStep, PhotosStep]
+
+
+def plan_post(post: Post) -> list[PublishStep]:
+    # Fewest API calls to publish a post: text goes to album caption if it fits,
+    # albums are split by MAX_MEDIA_GROUP_SIZE photos.
+    chunks = _render_message(post.text) if post.text else []
+    groups = [
+        post.photos[idx : idx + MAX_MEDIA_GROUP_SIZE]
+        for idx in range(0, len(post.photos), MAX_MEDIA_GROUP_SIZE)
+    ]
+    caption = None
+    if groups and len(chunks) == 1 and len(chunks[0]) <= MAX_CAPTION_LENGTH:
+        caption = chunks.pop()
+
+    steps: list[PublishStep] = [MessageStep(text=chunk) for chunk in chunks]
+    for idx, group in enumerate(groups):
+        steps.append(PhotosStep(photo_urls=group, caption=None if idx else caption))
+    return steps
+
+
+def fingerprint_post(post: Post) -> int | None:
+    # Content of a post as signed 64-bit integer (fits SQLite INTEGER):
+    # normalized rendered text and photo paths. Host and query of photo URLs
+    # vary between requests and reposts, path stays the same.
+    text = _render_text(post.text).casefold() if post.text else ""
+    photos = [urlsplit(url).path for url in post.photos]
+    if not text and not photos:
+        return None
+    digest = hashlib.blake2b("\0".join((text, *photos)).encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), "big", signed=True)
 
-def _format_internal_vk_links(text: str):
-    # [(scheme)?(domain)?(user_id)|(username)] -> \
-    # <a href="https://vk.com/(user_id)">(username)</a>
-    if match := re.findall(r"\[(https://)?(vk.com/)?([^\|\]]+)\|([^\]]+)\]", text):
-        for scheme, domain, user_id, username in match:
-            text = text.replace(
-                f"[{scheme}{domain}{user_id}|{username}]",
-                f'<a href="https://vk.com/{user_id}">{username}</a>',
-            )
-    return text
 
+def _build_message(*, chat_id: int, text: str):
+    return {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
 
-def _strip_html_tags(text: str) -> str:
-    return markupsafe.Markup(text).striptags()
+
+def _build_caption(caption: str | None) -> dict[str, str]:
+    if caption is None:
+        return {}
+    return {"caption": caption, "parse_mode": "HTML"}
+
+
+def _build_photos(*, chat_id: int, photo_urls: list[HttpUrl], caption: str | None):
+    # Single photo can't be sent with sendMediaGroup
+    if len(photo_urls) == 1:
+        return "/sendPhoto", {
+            "chat_id": chat_id,
+            "photo": photo_urls[0],
+            **_build_caption(caption),
+        }
+    media = [{"type": "photo", "media": url} for url in photo_urls]
+    media[0].update(_build_caption(caption))
+    return "/sendMediaGroup", {"chat_id": chat_id, "media": media}
+
+
+def _build_photos_upload(
+    *, chat_id: int, photos: list[bytes | None], caption: str | None
+):
+    # Multipart form with attached files
+    files = {
+        f"photo{idx}": (f"photo{idx}.jpg", photo, "image/jpeg")
+        for idx, photo in enumerate(photos)
+        if photo is not None
+    }
+    if len(files) == 1:
+        data = {"chat_id": str(chat_id), **_build_caption(caption)}
+        return "/sendPhoto", data, {"photo": next(iter(files.values()))}
+
+    media: list[dict[str, str]] = [
+        {"type": "photo", "media": f"attach://{name}"} for name in files
+    ]
+    if media:
+        media[0].update(_build_caption(caption))
+    data = {"chat_id": str(chat_id), "media": json.dumps(media)}
+    return "/sendMediaGroup", data, files
+
+
+# Sometimes sending photos fails with 400 Bad Request because Telegram
+# can't fetch them from VK. Then they are downloaded and uploaded instead.
+def _should_upload_photos(exc: TelegramBotError):
+    return exc.response.status_code == 400
+
+
+class PhotoTooLargeError(Exception):
+    pass
+
+
+def _check_photo_size(size: int, max_bytes: int):
+    if size > max_bytes:
+        raise PhotoTooLargeError(f"Photo is larger than {max_bytes} bytes")
+
+
+def _download_photo(session: requests.Session, url: str, *, max_bytes: int):
+    buffer = bytearray()
+    with session.get(url, stream=True) as response:
+        response.raise_for_status()
+        _check_photo_size(int(response.headers.get("content-length", 0)), max_bytes)
+        for chunk in response.iter_content(_DOWNLOAD_CHUNK_SIZE):
+            buffer += chunk
+            _check_photo_size(len(buffer), max_bytes)
+    return bytes(buffer)
+
+
+async def _download_photo_async(client: httpx.AsyncClient, url: str, *, max_bytes: int):
+    buffer = bytearray()
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        _check_photo_size(int(response.headers.get("content-length", 0)), max_bytes)
+        async for chunk in response.aiter_bytes(_DOWNLOAD_CHUNK_SIZE):
+            buffer += chunk
+            _check_photo_size(len(buffer), max_bytes)
+    return bytes(buffer)
+
+
+def _skip_too_large(photos: list[bytes | PhotoTooLargeError]):
+    res: list[bytes | None] = []
+    for photo in photos:
+        if isinstance(photo, PhotoTooLargeError):
+            logger.warning("Skipping photo: %s", photo)
+            res.append(None)
+        else:
+            metrics.incr("tg.bytes_uploaded", len(photo), unit="Bytes")
+            res.append(photo)
+    return res
 
 
 class Bot(BaseTelegramBot):
+    def __init__(
+        self,
+        token: str,
+        endpoint: str = TG_ENDPOINT,
+        *,
+        upload_photos: bool = False,
+        max_photo_bytes: int = MAX_PHOTO_BYTES,
+    ):
+        super().__init__(token, endpoint)
+        self.upload_photos = upload_photos
+        self.max_photo_bytes = max_photo_bytes
+
     def send_message(self, *, chat_id: int, text: str):
-        for chunk in textwrap.wrap(
-            text=text,
-            width=4096,  # MAX_MESSAGE_LENGTH, taken from python-telegram-bot constants
-            replace_whitespace=False,
-        ):
-            chunk = _strip_html_tags(chunk)
-            chunk = _format_internal_vk_links(chunk)
+        for chunk in _render_message(text):
             self.make_request(
-                method="/sendMessage",
-                json={
-                    "chat_id": chat_id,
-                    "text": chunk,
-                    "parse_mode": "HTML",
-                },
+                method="/sendMessage", json=_build_message(chat_id=chat_id, text=chunk)
             )
 
+    def _download_photo(self, url: str):
+        try:
+            return _download_photo(self._session, url, max_bytes=self.max_photo_bytes)
+        except PhotoTooLargeError as exc:
+            return exc
+
+    def send_uploaded_photos(
+        self, *, chat_id: int, photo_urls: list[HttpUrl], caption: str | None = None
+    ):
+        photos = _skip_too_large([self._download_photo(url) for url in photo_urls])
+        method, data, files = _build_photos_upload(
+            chat_id=chat_id, photos=photos, caption=caption
+        )
+        if not files:
+            # Every photo is skipped, but the post text is in the caption
+            if caption is not None:
+                self.make_request(
+                    method="/sendMessage",
+                    json=_build_message(chat_id=chat_id, text=caption),
+                )
+            return
+        response = self._session.post(
+            url=self._build_url(method), data=data, files=files
+        )
+        self.parse_response(response=response)
+
+    def send_photos(
+        self, *, chat_id: int, photo_urls: list[HttpUrl], caption: str | None = None
+    ):
+        if not self.upload_photos:
+            method, data = _build_photos(
+                chat_id=chat_id, photo_urls=photo_urls, caption=caption
+            )
+            try:
+                self.make_request(method=method, json=data)
+                return
+            except TelegramBotError as exc:
+                if not _should_upload_photos(exc):
+                    raise
+                metrics.incr("tg.retries")
+        self.send_uploaded_photos(
+            chat_id=chat_id, photo_urls=photo_urls, caption=caption
+        )
+
     def send_photo_group(self, *, chat_id: int, photo_urls: list[HttpUrl]):
-        data = {
-            "chat_id": chat_id,
-            "media": [{"type": "photo", "media": url} for url in photo_urls],
-        }
-        # Sometimes this endpoint fails for with 400 Bad Request.
-        # It is irrelevant to the _request_ though.
-        # So, retry three times or give up.
-        for _ in range(3):
+        self.send_photos(chat_id=chat_id, photo_urls=photo_urls)
+
+    def execute(self, *, chat_id: int, step: PublishStep):
+        if isinstance(step, MessageStep):
+            self.make_request(
+                method="/sendMessage",
+                json=_build_message(chat_id=chat_id, text=step.text),
+            )
+        else:
+            self.send_photos(
+                chat_id=chat_id, photo_urls=step.photo_urls, caption=step.caption
+            )
+
+
+class TokenBucket:
+    # `rate` tokens per second, up to `capacity` saved for bursts. Tokens are
+    # reserved ahead: balance goes negative and next callers wait longer.
+    def __init__(self, rate: float, capacity: float = 1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        # Takes a token, returns seconds to wait before using it
+        self._refill()
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, 0)
+
+    def pause(self, seconds: float):
+        # Next token is available in `seconds`, e. g. on 429 Too Many Requests
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class RateLimiter:
+    # Telegram limits: about 30 requests per second overall
+    # and 1 per second in one chat. `chat_rate` of 0 turns off the latter.
+    def __init__(self, *, rate: float = 30, chat_rate: float = 1) -> None:
+        self.chat_rate = chat_rate
+        self._bucket = TokenBucket(rate, capacity=rate)
+        self._chat_buckets: dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int):
+        if chat_id not in self._chat_buckets:
+            self._chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return self._chat_buckets[chat_id]
+
+    async def acquire(self, chat_id: int | None):
+        # Chat first, so a busy chat doesn't hold global tokens while it waits
+        if chat_id is not None and self.chat_rate:
+            await _wait(self._chat_bucket(chat_id).reserve())
+        await _wait(self._bucket.reserve())
+
+    def pause(self, chat_id: int | None, seconds: float):
+        if chat_id is not None and self.chat_rate:
+            self._chat_bucket(chat_id).pause(seconds)
+        else:
+            self._bucket.pause(seconds)
+
+
+async def _wait(seconds: float):
+    if seconds > 0:
+        with metrics.span("tg.throttled"):
+            await asyncio.sleep(seconds)
+
+
+MAX_RETRY_AFTER = 60  # Longer waits go to the outbox instead
+
+
+def _get_retry_after(response: httpx.Response, resp_json: Any) -> float | None:
+    if response.status_code != 429 or not isinstance(resp_json, dict):
+        return None
+    retry_after = resp_json.get("parameters", {}).get("retry_after")  # type: ignore
+    if not isinstance(retry_after, (int, float)) or retry_after > MAX_RETRY_AFTER:
+        return None
+    return retry_after
+
+
+def _get_chat_id(payload: Any) -> int | None:
+    # Both JSON body and form data have it, in form it is string
+    if isinstance(payload, dict) and "chat_id" in payload:
+        return int(payload["chat_id"])  # type: ignore
+    return None
+
+
+class AsyncBot:
+    # Same as Bot, but uses shared httpx.AsyncClient instead of own session
+    def __init__(
+        self,
+        token: str,
+        *,
+        client: httpx.AsyncClient,
+        endpoint: str = TG_ENDPOINT,
+        upload_photos: bool = False,
+        max_photo_bytes: int = MAX_PHOTO_BYTES,
+        media: PhotoProcessor | None = None,
+        limiter: RateLimiter | None = None,
+        max_retries: int = 3,
+    ) -> None:
+        self.token = token
+        self.client = client
+        self.endpoint = endpoint
+        self.upload_photos = upload_photos
+        self.max_photo_bytes = max_photo_bytes
+        self.media = media
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    async def _post(
+        self, *, chat_id: int | None, method: str, json: Any, data: Any, files: Any
+    ):
+        if self.limiter is not None:
+            await self.limiter.acquire(chat_id)
+        metrics.incr("tg.requests")
+        with metrics.span("tg.request"):
+            response = await self.client.post(
+                f"{self.endpoint}/bot{self.token}{method}",
+                json=json,
+                data=data,
+                files=files,
+            )
+        try:
+            return response, response.json()
+        except JSONDecodeError:
+            raise TelegramBotError(
+                "Can't decode json response", response=response  # type: ignore
+            )
+
+    async def make_request(
+        self,
+        *,
+        method: str,
+        json: Any = None,
+        data: Any = None,
+        files: Any = None,
+    ) -> Any:
+        chat_id = _get_chat_id(json if json is not None else data)
+        response, resp_json = await self._post(
+            chat_id=chat_id, method=method, json=json, data=data, files=files
+        )
+        for _ in range(self.max_retries):
+            if (retry_after := _get_retry_after(response, resp_json)) is None:
+                break
+            # Flood control: wait as long as Telegram asks and try again
+            logger.info("Rate limited, retrying after %s s", retry_after)
+            metrics.incr("tg.retries")
+            if self.limiter is not None:
+                self.limiter.pause(chat_id, retry_after)
+            else:
+                await asyncio.sleep(retry_after)
+            response, resp_json = await self._post(
+                chat_id=chat_id, method=method, json=json, data=data, files=files
+            )
+        if response.is_error:
+            raise TelegramBotError(
+                resp_json.get("description", response.reason_phrase),
+                response=response,  # type: ignore
+            )
+        return resp_json["result"]
+
+    async def send_message(self, *, chat_id: int, text: str):
+        for chunk in _render_message(text):
+            await self.make_request(
+                method="/sendMessage", json=_build_message(chat_id=chat_id, text=chunk)
+            )
+
+    async def _get_photo(self, url: str):
+        if self.media is None:
+            return await _download_photo_async(
+                self.client, url, max_bytes=self.max_photo_bytes
+            )
+        return await self.media.get(
+            url,
+            lambda: _download_photo_async(
+                self.client, url, max_bytes=self.media.max_source_bytes  # type: ignore
+            ),
+        )
+
+    async def send_uploaded_photos(
+        self, *, chat_id: int, photo_urls: list[HttpUrl], caption: str | None = None
+    ):
+        # Photos are downloaded (and recompressed) concurrently, each one
+        # is capped by max_photo_bytes or media.max_source_bytes
+        photos = await asyncio.gather(
+            *(self._get_photo(url) for url in photo_urls), return_exceptions=True
+        )
+        for photo in photos:
+            if isinstance(photo, BaseException) and not isinstance(
+                photo, PhotoTooLargeError
+            ):
+                raise photo
+        method, data, files = _build_photos_upload(
+            chat_id=chat_id,
+            photos=_skip_too_large(photos),  # type: ignore
+            caption=caption,
+        )
+        if files:
+            await self.make_request(method=method, data=data, files=files)
+        elif caption is not None:
+            # Every photo is skipped, but the post text is in the caption
+            await self.make_request(
+                method="/sendMessage",
+                json=_build_message(chat_id=chat_id, text=caption),
+            )
+
+    async def send_photos(
+        self, *, chat_id: int, photo_urls: list[HttpUrl], caption: str | None = None
+    ):
+        if not self.upload_photos:
+            method, data = _build_photos(
+                chat_id=chat_id, photo_urls=photo_urls, caption=caption
+            )
             try:
-                self.make_request(method="/sendMediaGroup", json=data)
+                await self.make_request(method=method, json=data)
                 return
             except TelegramBotError as exc:
-                if exc.response.status_code != 400:
+                if not _should_upload_photos(exc):
                     raise
+                metrics.incr("tg.retries")
+        await self.send_uploaded_photos(
+            chat_id=chat_id, photo_urls=photo_urls, caption=caption
+        )
+
+    async def send_photo_group(self, *, chat_id: int, photo_urls: list[HttpUrl]):
+        await self.send_photos(chat_id=chat_id, photo_urls=photo_urls)
+
+    async def execute(self, *, chat_id: int, step: PublishStep):
+        if isinstance(step, MessageStep):
+            await self.make_request(
+                method="/sendMessage",
+                json=_build_message(chat_id=chat_id, text=step.text),
+            )
+        else:
+            await self.send_photos(
+                chat_id=chat_id, photo_urls=step.photo_urls, caption=step.caption
+            )
+
+
+@functools.cache
+def _get_bot(token: str) -> Bot:
+    # Shared between calls, so they reuse keep-alive connections of its session
+    return Bot(token)
 
 
 def publish_post(*, token: str, chat_id: int, post: Post):
-    bot = Bot(token)
-    if post.text:
-        bot.send_message(chat_id=chat_id, text=post.text)
-    if post.photos:
-        bot.send_photo_group(chat_id=chat_id, photo_urls=post.photos)
+    bot = _get_bot(token)
+    for step in plan_post(post):
+        bot.execute(chat_id=chat_id, step=step)
+
+
+async def publish_post_async(*, bot: AsyncBot, chat_id: int, post: Post):
+    for step in plan_post(post):
+        await bot.execute(chat_id=chat_id, step=step)
+
+
+async def publish_item_async(*, bot: AsyncBot, item: OutboxItem):
+    # Progress is kept in `item.sent_steps`, so a retry continues where it failed
+    steps = parse_obj_as(list[PublishStep], item.steps)
+    for step in steps[item.sent_steps :]:
+        await bot.execute(chat_id=item.chat_id, step=step)
+        item.sent_steps += 1
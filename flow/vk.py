@@ -1,20 +1,171 @@
-from datetime import datetime
-from typing import Literal, Optional
+from __future__ import annotations
 
-from base_vk_api import BaseVKAPI
+import asyncio
+import contextlib
+import json
+from collections.abc import Iterator
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Any, Literal, Optional
+
+from base_vk_api import BaseVKAPI, VKAPIError
 from pydantic import BaseModel, HttpUrl
 
-from flow.models import Post
+from flow import metrics
+from flow.models import PhotoSizePolicy, Post
+
+if TYPE_CHECKING:
+    import httpx
+
+try:
+    from orjson import loads as _loads
+except ImportError:  # pragma: no cover
+    _loads = json.loads
+
+
+def _load_json(response: Any) -> dict[str, Any]:
+    # Same checks as BaseVKAPI.parse_response, without validation into models
+    metrics.incr("vk.requests")
+    metrics.incr("vk.bytes_received", len(response.content), unit="Bytes")
+    try:
+        resp_json = _loads(response.content)
+    except ValueError:
+        raise VKAPIError("Can't decode json response", response=response)
+    if error := resp_json.get("error"):
+        raise VKAPIError(
+            error["error_msg"],
+            response=response,
+            error_code=error["error_code"],
+            error_msg=error["error_msg"],
+        )
+    if "response" not in resp_json:
+        raise VKAPIError('No "response" key found in response dict', response=response)
+    return resp_json
+
+
+def _load_response(response: Any) -> Any:
+    return _load_json(response)["response"]
+
+
+# VK allows up to 25 API calls in one `execute`
+VK_ENDPOINT = "https://api.vk.com"
+MAX_EXECUTE_CALLS = 25
+
+
+def _build_wall_execute_code(calls: list[dict[str, int]]):
+    # VKScript is close enough to JavaScript to accept JSON objects as is
+    return "return [%s];" % ",".join(
+        f"API.wall.get({json.dumps(params)})" for params in calls
+    )
+
+
+def _split_execute_response(
+    resp_json: dict[str, Any], *, response: Any, count: int
+) -> list[Any]:
+    # Failed calls are `false` in the response list, their errors are listed
+    # in the same order in `execute_errors`
+    results: list[Any] = resp_json["response"]
+    if not isinstance(results, list) or len(results) != count:  # pyright: ignore
+        raise VKAPIError("Unexpected execute response", response=response)
+    errors: Iterator[dict[str, Any]] = iter(resp_json.get("execute_errors") or ())
+    for idx, result in enumerate(results):
+        if result is not False:
+            continue
+        error: dict[str, Any] = next(
+            errors, {"error_code": None, "error_msg": "Unknown error"}
+        )
+        results[idx] = VKAPIError(
+            error["error_msg"],
+            response=response,
+            error_code=error["error_code"],
+            error_msg=error["error_msg"],
+        )
+    return results
 
 
 class VKAPI(BaseVKAPI):
-    def get_wall(self, *, owner_id: int):
+    def get_wall(self, *, owner_id: int, offset: int = 0, count: int = 20):
         return self.make_request(
-            method="wall.get", params={"owner_id": owner_id}, model=WallGetResponse
+            method="wall.get",
+            params={"owner_id": owner_id, "offset": offset, "count": count},
+            model=WallGetResponse,
+        )
+
+    def get_wall_raw(self, *, owner_id: int, offset: int = 0, count: int = 20):
+        params = self._get_params(
+            {"owner_id": owner_id, "offset": offset, "count": count}
+        )
+        with metrics.span("vk.request"):
+            response = self._session.get(
+                f"{self.endpoint}/method/wall.get", params=params
+            )
+        return _load_response(response)
+
+
+class AsyncVKAPI:
+    # Same as VKAPI, but uses shared httpx.AsyncClient instead of own session
+    def __init__(
+        self,
+        token: str,
+        *,
+        client: httpx.AsyncClient,
+        endpoint: str = VK_ENDPOINT,
+        api_version: str = "5.131",
+        lang: str = "ru",
+    ) -> None:
+        self.token = token
+        self.client = client
+        self.endpoint = endpoint
+        self.api_version = api_version
+        self.lang = lang
+
+    async def _request(self, *, method: str, params: dict[str, Any]):
+        params = params | {
+            "access_token": self.token,
+            "v": self.api_version,
+            "lang": self.lang,
+        }
+        with metrics.span("vk.request"):
+            response = await self.client.get(
+                f"{self.endpoint}/method/{method}", params=params
+            )
+        return response, _load_json(response)
+
+    async def make_request(self, *, method: str, params: dict[str, Any]) -> Any:
+        _, resp_json = await self._request(method=method, params=params)
+        return resp_json["response"]
+
+    async def get_wall_raw(self, *, owner_id: int, offset: int = 0, count: int = 20):
+        return await self.make_request(
+            method="wall.get",
+            params={"owner_id": owner_id, "offset": offset, "count": count},
         )
 
+    async def get_wall(self, *, owner_id: int, offset: int = 0, count: int = 20):
+        return WallGetResponse(
+            **await self.get_wall_raw(owner_id=owner_id, offset=offset, count=count)
+        )
+
+    async def execute_wall_raw(self, calls: list[dict[str, int]]) -> list[Any]:
+        # Several wall.get calls in one request. Each one is a dict of wall.get
+        # params. Failed calls are returned as VKAPIError in place of response.
+        if not 0 < len(calls) <= MAX_EXECUTE_CALLS:
+            raise ValueError(
+                f"Expected 1 to {MAX_EXECUTE_CALLS} calls, got {len(calls)}"
+            )
+        response, resp_json = await self._request(
+            method="execute", params={"code": _build_wall_execute_code(calls)}
+        )
+        return _split_execute_response(resp_json, response=response, count=len(calls))
+
+    async def execute_wall(self, calls: list[dict[str, int]]):
+        return [
+            result if isinstance(result, VKAPIError) else WallGetResponse(**result)
+            for result in await self.execute_wall_raw(calls)
+        ]
+
 
 class WallItemAttachmentPhotoSize(BaseModel):
+    type: Optional[str]
     width: int
     height: int
     url: HttpUrl
@@ -33,6 +184,7 @@ class WallItem(BaseModel):
     id: int
     owner_id: int
     marked_as_ads: Optional[Literal[0, 1]]
+    is_pinned: Optional[Literal[0, 1]] = None
     text: Optional[str]
     attachments: Optional[list[WallItemAttachment]]
     date: datetime
@@ -43,16 +195,57 @@ class WallGetResponse(BaseModel):
     items: list[WallItem]
 
 
-def _get_photo_with_highest_quality(photo: WallItemAttachmentPhoto):
-    biggest_pixel_count = 0
+# Telegram rejects photos with width + height over 10000 or sides ratio over 20
+_TG_MAX_PHOTO_DIMENSIONS = 10000
+_TG_MAX_PHOTO_RATIO = 20
+
+
+def _fits_telegram(width: int, height: int):
+    if width + height > _TG_MAX_PHOTO_DIMENSIONS:
+        return False
+    if not width or not height:  # Old photos may have no dimensions
+        return True
+    return max(width, height) / min(width, height) <= _TG_MAX_PHOTO_RATIO
+
+
+def _select_photo_url(sizes: list[dict[str, Any]], policy: PhotoSizePolicy):
+    # Best size is picked in one pass by comparing keys: fits Telegram limits,
+    # fits pixel budget, preferred type, then the biggest one within budget
+    # or the smallest one over it.
+    type_ranks = {
+        type: len(policy.preferred_types) - idx
+        for idx, type in enumerate(policy.preferred_types)
+    }
+    best_key: tuple[bool, bool, int, int] | None = None
     url = None
-    for size in photo.sizes:
-        if (size.height * size.width) > biggest_pixel_count:
-            url = size.url
+    for size in sizes:
+        width, height = size["width"], size["height"]
+        pixel_count = width * height
+        within_budget = policy.max_pixels is None or pixel_count <= policy.max_pixels
+        key: tuple[bool, bool, int, int] = (
+            _fits_telegram(width, height),
+            within_budget,
+            type_ranks.get(size.get("type", ""), 0),
+            pixel_count if within_budget else -pixel_count,
+        )
+        # Sizes usually go from smallest to biggest, so prefer later ones on tie
+        if best_key is None or key >= best_key:
+            best_key = key
+            url = size["url"]
     return url
 
 
-def _parse_wall(response: WallGetResponse):
+def _get_photo_with_highest_quality(
+    photo: WallItemAttachmentPhoto, policy: PhotoSizePolicy = PhotoSizePolicy()
+):
+    return _select_photo_url([size.dict() for size in photo.sizes], policy)
+
+
+# Reference parser on pydantic models: _WallCollector is checked against it
+# in tests and compared with it in benchmarks
+def _parse_wall(  # pyright: ignore[reportUnusedFunction]
+    response: WallGetResponse, photo_policy: PhotoSizePolicy = PhotoSizePolicy()
+):
     res: list[Post] = []
     for item in response.items:
         if item.marked_as_ads:
@@ -62,7 +255,9 @@ def _parse_wall(response: WallGetResponse):
         for attachment in item.attachments or []:
             if attachment.photo is None:
                 continue
-            if photo_url := _get_photo_with_highest_quality(attachment.photo):
+            if photo_url := _get_photo_with_highest_quality(
+                attachment.photo, photo_policy
+            ):
                 photos.append(photo_url)
 
         res.append(Post(id=item.id, text=item.text, photos=photos, date=item.date))
@@ -70,6 +265,279 @@ def _parse_wall(response: WallGetResponse):
     return res
 
 
-def get_wall(*, token: str, owner_id: int):
-    response = VKAPI(token).get_wall(owner_id=owner_id)
-    return _parse_wall(response)
+class _WallRecord:
+    # Only fields that are used, taken from raw wall.get item
+    __slots__ = ("id", "text", "photos", "date")
+
+    def __init__(self, item: dict[str, Any], photo_policy: PhotoSizePolicy) -> None:
+        self.id: int = item["id"]
+        self.text: str | None = item.get("text")
+        self.date: int = item["date"]
+        self.photos: list[str] = []
+        for attachment in item.get("attachments") or ():
+            if (photo := attachment.get("photo")) is None:
+                continue
+            if url := _select_photo_url(photo["sizes"], photo_policy):
+                self.photos.append(url)
+
+    def to_post(self):
+        # Values are already checked, so skip validation
+        return Post.construct(
+            id=self.id,
+            text=self.text,
+            photos=self.photos,
+            date=datetime.fromtimestamp(self.date, timezone.utc),
+        )
+
+
+class _WallCollector:
+    # Accumulates raw wall pages. Without `since_id` only the first page
+    # is needed. Otherwise walk back until `since_id` is reached, so posts
+    # missed during an outage are seen too. Ads and posts at or below
+    # `since_id` are skipped before any object is built.
+    def __init__(
+        self, *, since_id: int | None, page_size: int, photo_policy: PhotoSizePolicy
+    ) -> None:
+        self.since_id = since_id
+        self.page_size = page_size
+        self.photo_policy = photo_policy
+        self.records: dict[int, _WallRecord] = {}
+
+    def add(self, response: dict[str, Any]) -> bool:
+        # Returns whether the next page is needed
+        items: list[dict[str, Any]] = response["items"]
+        reached_since_id = False
+        for item in items:
+            id: int = item["id"]
+            if self.since_id is not None and id <= self.since_id:
+                # Pinned post is always on top of the wall, even if it is an old one
+                if not item.get("is_pinned"):
+                    reached_since_id = True
+                continue
+            # New posts may shift the wall between requests, so dedupe by id
+            if id in self.records or item.get("marked_as_ads"):
+                continue
+            self.records[id] = _WallRecord(item, self.photo_policy)
+
+        return not (
+            self.since_id is None or len(items) < self.page_size or reached_since_id
+        )
+
+    def get_posts(self):
+        metrics.incr("posts.fetched", len(self.records))
+        records = sorted(self.records.values(), key=lambda record: record.date)
+        return [record.to_post() for record in records]
+
+
+def get_wall(
+    *,
+    token: str,
+    owner_id: int,
+    since_id: int | None = None,
+    page_size: int = 20,
+    max_pages: int = 10,
+    photo_policy: PhotoSizePolicy = PhotoSizePolicy(),
+):
+    vk = VKAPI(token)
+    collector = _WallCollector(
+        since_id=since_id, page_size=page_size, photo_policy=photo_policy
+    )
+    for page in range(max_pages):
+        response = vk.get_wall_raw(
+            owner_id=owner_id, offset=page * page_size, count=page_size
+        )
+        with metrics.span("vk.parse"):
+            has_next = collector.add(response)
+        if not has_next:
+            break
+    return collector.get_posts()
+
+
+async def get_wall_async(
+    *,
+    client: httpx.AsyncClient,
+    token: str,
+    owner_id: int,
+    since_id: int | None = None,
+    page_size: int = 20,
+    max_pages: int = 10,
+    photo_policy: PhotoSizePolicy = PhotoSizePolicy(),
+    endpoint: str = VK_ENDPOINT,
+):
+    vk = AsyncVKAPI(token, client=client, endpoint=endpoint)
+    collector = _WallCollector(
+        since_id=since_id, page_size=page_size, photo_policy=photo_policy
+    )
+    for page in range(max_pages):
+        response = await vk.get_wall_raw(
+            owner_id=owner_id, offset=page * page_size, count=page_size
+        )
+        with metrics.span("vk.parse"):
+            has_next = collector.add(response)
+        if not has_next:
+            break
+    return collector.get_posts()
+
+
+@contextlib.asynccontextmanager
+async def _no_limit():
+    # contextlib.nullcontext supports `async with` only since Python 3.10
+    yield
+
+
+async def _fetch_pages(
+    vk: AsyncVKAPI, calls: list[dict[str, int]], semaphore: asyncio.Semaphore | None
+) -> list[Any]:
+    async with semaphore or _no_limit():
+        if len(calls) == 1:  # Plain wall.get is enough
+            try:
+                return [await vk.get_wall_raw(**calls[0])]
+            except VKAPIError as exc:
+                return [exc]
+        return await vk.execute_wall_raw(calls)
+
+
+async def _get_walls_page(
+    vk: AsyncVKAPI,
+    owner_ids: list[int],
+    *,
+    offset: int,
+    count: int,
+    semaphore: asyncio.Semaphore | None,
+) -> dict[int, Any]:
+    # Same page of every wall, packing up to MAX_EXECUTE_CALLS walls into one
+    # `execute`. Values are raw responses or errors.
+    batches = [
+        owner_ids[idx : idx + MAX_EXECUTE_CALLS]
+        for idx in range(0, len(owner_ids), MAX_EXECUTE_CALLS)
+    ]
+    results = await asyncio.gather(
+        *(
+            _fetch_pages(
+                vk,
+                [
+                    {"owner_id": owner_id, "offset": offset, "count": count}
+                    for owner_id in batch
+                ],
+                semaphore,
+            )
+            for batch in batches
+        ),
+        return_exceptions=True,
+    )
+    res: dict[int, Any] = {}
+    for batch, result in zip(batches, results):
+        # Whole request failed, so every wall in it failed too
+        responses = (
+            [result] * len(batch) if isinstance(result, BaseException) else result
+        )
+        res.update(zip(batch, responses))
+    return res
+
+
+# Pinned post is always on top, so the newest one may be the second
+_PROBE_COUNT = 2
+
+
+def _has_new_posts(response: dict[str, Any], since_id: int):
+    items: list[dict[str, Any]] = response["items"]
+    posts = [item for item in items if not item.get("marked_as_ads")]
+    if any(item["id"] > since_id for item in posts):
+        return True
+    if not items or len(items) >= response.get("count", float("inf")):
+        return False  # Whole wall is seen
+    # Pinned post and ads are out of order: the newest post could be right
+    # after them, so without a regular post the full page is needed
+    return all(item.get("is_pinned") for item in posts)
+
+
+async def probe_walls_async(
+    *,
+    client: httpx.AsyncClient,
+    token: str,
+    since_ids: dict[int, int],
+    semaphore: asyncio.Semaphore | None = None,
+    endpoint: str = VK_ENDPOINT,
+) -> dict[int, bool | BaseException]:
+    # Cheap check whether walls have posts newer than `since_ids`:
+    # only a couple of newest posts are requested
+    vk = AsyncVKAPI(token, client=client, endpoint=endpoint)
+    responses = await _get_walls_page(
+        vk, list(since_ids), offset=0, count=_PROBE_COUNT, semaphore=semaphore
+    )
+    res: dict[int, bool | BaseException] = {}
+    for owner_id, response in responses.items():
+        if isinstance(response, BaseException):
+            res[owner_id] = response
+        else:
+            res[owner_id] = _has_new_posts(response, since_ids[owner_id])
+            metrics.incr("vk.probes")
+    return res
+
+
+async def get_walls_async(
+    *,
+    client: httpx.AsyncClient,
+    token: str,
+    since_ids: dict[int, int | None],
+    page_size: int = 20,
+    max_pages: int = 10,
+    photo_policy: PhotoSizePolicy = PhotoSizePolicy(),
+    semaphore: asyncio.Semaphore | None = None,
+    probe: bool = True,
+    endpoint: str = VK_ENDPOINT,
+) -> dict[int, list[Post] | BaseException]:
+    # Same as get_wall_async for many owners at once, keyed by owner id. Each
+    # round requests next page of every wall that needs one, packing up to
+    # MAX_EXECUTE_CALLS pages into one `execute`. Errors are returned per owner.
+    # With `probe`, walls with known `since_id` are probed first and only
+    # changed ones are fetched in full.
+    vk = AsyncVKAPI(token, client=client, endpoint=endpoint)
+    collectors = {
+        owner_id: _WallCollector(
+            since_id=since_id, page_size=page_size, photo_policy=photo_policy
+        )
+        for owner_id, since_id in since_ids.items()
+    }
+    errors: dict[int, BaseException] = {}
+    pending = list(collectors)
+    known_since_ids = {o: s for o, s in since_ids.items() if s is not None}
+    if probe and known_since_ids:
+        changes = await probe_walls_async(
+            client=client,
+            token=token,
+            since_ids=known_since_ids,
+            semaphore=semaphore,
+            endpoint=endpoint,
+        )
+        for owner_id, changed in changes.items():
+            if isinstance(changed, BaseException):
+                errors[owner_id] = changed
+            if changed is not True:
+                pending.remove(owner_id)
+
+    for page in range(max_pages):
+        if not pending:
+            break
+        responses = await _get_walls_page(
+            vk,
+            pending,
+            offset=page * page_size,
+            count=page_size,
+            semaphore=semaphore,
+        )
+        pending: list[int] = []
+        for owner_id, response in responses.items():
+            if isinstance(response, BaseException):
+                errors[owner_id] = response
+                continue
+            with metrics.span("vk.parse"):
+                if collectors[owner_id].add(response):
+                    pending.append(owner_id)
+
+    res: dict[int, list[Post] | BaseException] = {}
+    for owner_id, collector in collectors.items():
+        res[owner_id] = (
+            errors[owner_id] if owner_id in errors else collector.get_posts()
+        )
+    return res
@@ -0,0 +1,75 @@
+"""Measure cold import time of Lambda entrypoint with `python -X importtime`.
+
+Usage: python scripts/importtime.py [--module flow.main] [--runs 5] [--max-ms 400]
+
+Exits with non-zero code if the median import time exceeds --max-ms
+or a module that should be imported lazily is loaded.
+"""
+from __future__ import annotations
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+LAZY_MODULES = (
+    "boto3",
+    "botocore",
+    "sentry_sdk",
+    "sqlalchemy",
+    "sqlmodel",
+    "httpx",
+    "zstandard",
+)
+
+
+def measure(module: str) -> tuple[int, set[str]]:
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    total_us = 0
+    imported: set[str] = set()
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+        if not cumulative.strip().isdigit():
+            continue  # Header line
+        imported.add(name)
+        if name == module:
+            total_us = int(cumulative)
+    return total_us, imported
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="flow.main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, default=400)
+    args = parser.parse_args()
+
+    timings: list[float] = []
+    imported: set[str] = set()
+    for _ in range(args.runs):
+        total_us, imported = measure(args.module)
+        timings.append(total_us / 1000)
+
+    median = statistics.median(timings)
+    print(f"{args.module}: median {median:.1f} ms over {args.runs} runs")
+
+    code = 0
+    if lazy := sorted(m for m in imported if m.split(".")[0] in LAZY_MODULES):
+        print(f"Eagerly imported: {', '.join(lazy)}")
+        code = 1
+    if median > args.max_ms:
+        print(f"Import time regression: {median:.1f} ms > {args.max_ms} ms")
+        code = 1
+    return code
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import signal
+from datetime import datetime
+from typing import Any
+
+import py
+import pytest
+
+import flow.daemon
+import flow.main
+from flow.daemon import _main, _Schedule, run_daemon
+from flow.models import OutboxItem, Post, Route, Settings
+from flow.tg import AsyncBot
+
+
+@pytest.fixture
+def settings(tmpdir: py.path.local):
+    return Settings(
+        vk_token="my_vk_token",
+        tg_token="my_tg_token",
+        routes=[
+            Route(vk_owner_id=1, tg_chat_ids=[10]),
+            Route(vk_owner_id=2, tg_chat_ids=[20]),
+        ],
+        publish_limit=0,
+        poll_min_interval=0.01,
+        poll_max_interval=0.04,
+        db_path=os.path.join(tmpdir, "database.db"),
+    )  # type: ignore
+
+
+def test_schedule(settings: Settings):
+    schedule = _Schedule(settings.poll_min_interval)
+    intervals: list[float] = []
+    for active in (False, False, False, True, False):
+        schedule.update(settings, active=active, now=100)
+        intervals.append(schedule.interval)
+    assert intervals == [0.02, 0.04, 0.04, 0.01, 0.02]
+    assert schedule.next_poll_at == 100.02
+
+
+def _mock_flow(monkeypatch: pytest.MonkeyPatch, stop: asyncio.Event):
+    # Wall 1 gets new post on every poll, wall 2 never does
+    polls: list[int] = []
+    published: list[tuple[int, int]] = []
+
+    async def get_walls_async(*, since_ids: dict[int, int | None], **kwargs: Any):
+        polls.extend(since_ids)
+        if len(polls) >= 12:
+            stop.set()
+        return {
+            owner_id: [
+                Post(
+                    id=len(polls) if owner_id == 1 else 1,
+                    text=f"text {len(polls)}",
+                    photos=[],
+                    date=datetime.now(),
+                )
+            ]
+            for owner_id in since_ids
+        }
+
+    async def publish_item_async(*, bot: AsyncBot, item: OutboxItem):
+        published.append((item.chat_id, item.post_id))
+
+    monkeypatch.setattr(flow.main, "get_walls_async", get_walls_async)
+    monkeypatch.setattr(flow.main, "publish_item_async", publish_item_async)
+    return polls, published
+
+
+def test_run_daemon(monkeypatch: pytest.MonkeyPatch, settings: Settings):
+    opened: list[Any] = []
+    open_storage = flow.daemon.open_storage
+
+    def open_storage_spy(settings: Settings):
+        opened.append(settings)
+        return open_storage(settings)
+
+    monkeypatch.setattr(flow.daemon, "open_storage", open_storage_spy)
+
+    async def run():
+        stop = asyncio.Event()
+        polls, published = _mock_flow(monkeypatch, stop)
+        await asyncio.wait_for(run_daemon(settings, stop=stop), timeout=5)
+        return polls, published
+
+    polls, published = asyncio.run(run())
+    assert len(opened) == 1
+    # Both walls are polled first, then active one is polled more often
+    assert sorted(polls[:2]) == [1, 2]
+    assert polls.count(1) > polls.count(2) > 1
+    assert (20, 1) in published
+    assert [post_id for chat_id, post_id in published if chat_id == 10] == sorted(
+        {post_id for chat_id, post_id in published if chat_id == 10}
+    )
+
+
+def test_run_daemon_survives_errors(
+    monkeypatch: pytest.MonkeyPatch, settings: Settings
+):
+    calls = 0
+    stop: Any = None
+
+    async def get_walls_async(*, since_ids: dict[int, int | None], **kwargs: Any):
+        nonlocal calls
+        calls += 1
+        if calls == 3:
+            stop.set()
+        raise RuntimeError
+
+    monkeypatch.setattr(flow.main, "get_walls_async", get_walls_async)
+
+    async def run():
+        nonlocal stop
+        # Created inside the loop: on Python 3.9 it binds to the current one
+        stop = asyncio.Event()
+        await asyncio.wait_for(run_daemon(settings, stop=stop), timeout=5)
+
+    asyncio.run(run())
+    assert calls == 3
+
+
+def test_daemon_stops_on_sigterm(monkeypatch: pytest.MonkeyPatch, settings: Settings):
+    async def run():
+        _mock_flow(monkeypatch, asyncio.Event())
+        asyncio.get_running_loop().call_later(
+            0.05, os.kill, os.getpid(), signal.SIGTERM
+        )
+        await asyncio.wait_for(_main(settings), timeout=5)
+
+    asyncio.run(run())
@@ -1,33 +1,281 @@
 import os
+import sqlite3
+from datetime import datetime
+from typing import Any
 
 import py
 import pytest
-from sqlmodel import Session
+from sqlalchemy import text
+from sqlmodel import Session, select  # pyright: ignore[reportUnknownVariableType]
 
-from flow.db import Storage
-from flow.models import PostDB
+from flow.db import Change, RecordingStorage, apply_changes, open_storage
+from flow.db.compact import CompactStorage
+from flow.db.sqlite import PostDB, SQLiteStorage
+from flow.models import OutboxItem, Settings
 
 
 @pytest.fixture
 def storage(tmpdir: py.path.local):
-    return Storage(os.path.join(tmpdir, "database.db"))
+    return SQLiteStorage(os.path.join(tmpdir, "database.db"))
 
 
-def test_add_post(storage: Storage):
-    storage.add_post(20)
+def test_add_post(storage: SQLiteStorage):
+    storage.add_post(owner_id=1, chat_id=2, id=20)
     with Session(storage.engine) as session:
-        assert session.get(PostDB, 20) is not None
+        assert session.get(PostDB, (1, 2, 20)) is not None
 
 
-def test_post_in_db_true(storage: Storage):
-    storage.add_post(20)
-    assert storage.post_in_db(20)
+def test_post_in_db_true(storage: SQLiteStorage):
+    storage.add_post(owner_id=1, chat_id=2, id=20)
+    assert storage.post_in_db(owner_id=1, chat_id=2, id=20)
 
 
-def test_post_in_db_false_not_empty_db(storage: Storage):
-    storage.add_post(10)
-    assert not storage.post_in_db(20)
+def test_post_in_db_false_not_empty_db(storage: SQLiteStorage):
+    storage.add_post(owner_id=1, chat_id=2, id=10)
+    assert not storage.post_in_db(owner_id=1, chat_id=2, id=20)
 
 
-def test_post_in_db_false_empty_db(storage: Storage):
-    assert not storage.post_in_db(20)
+def test_post_in_db_false_empty_db(storage: SQLiteStorage):
+    assert not storage.post_in_db(owner_id=1, chat_id=2, id=20)
+
+
+def test_post_in_db_false_other_route(storage: SQLiteStorage):
+    storage.add_post(owner_id=1, chat_id=2, id=20)
+    assert not storage.post_in_db(owner_id=1, chat_id=3, id=20)
+    assert not storage.post_in_db(owner_id=4, chat_id=2, id=20)
+
+
+def test_adopt_legacy_posts(tmpdir: py.path.local):
+    db_path = os.path.join(tmpdir, "database.db")
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE postdb (id INTEGER NOT NULL PRIMARY KEY)")
+        conn.executemany("INSERT INTO postdb (id) VALUES (?)", [(10,), (20,)])
+    conn.close()
+
+    storage = SQLiteStorage(db_path)
+    assert not storage.post_in_db(owner_id=1, chat_id=2, id=10)
+    storage.adopt_legacy_posts(owner_id=1, chat_id=2)
+    assert storage.post_in_db(owner_id=1, chat_id=2, id=10)
+    assert storage.post_in_db(owner_id=1, chat_id=2, id=20)
+
+    # Second call is no-op
+    storage.adopt_legacy_posts(owner_id=1, chat_id=3)
+    assert not storage.post_in_db(owner_id=1, chat_id=3, id=10)
+
+
+def test_get_last_post_id(storage: SQLiteStorage):
+    storage.add_post(owner_id=1, chat_id=2, id=5)
+    storage.add_post(owner_id=1, chat_id=2, id=7)
+    storage.add_post(owner_id=1, chat_id=3, id=6)
+    storage.add_post(owner_id=4, chat_id=3, id=10)
+    assert storage.get_last_post_id(owner_id=1, chat_ids=[2]) == 7
+    assert storage.get_last_post_id(owner_id=1, chat_ids=[2, 3]) == 6
+    assert storage.get_last_post_id(owner_id=1, chat_ids=[2, 5]) is None
+    assert storage.get_last_post_id(owner_id=1, chat_ids=[]) is None
+
+
+def test_posts_in_db(storage: SQLiteStorage):
+    storage.add_posts(owner_id=1, chat_id=2, ids=range(1000))
+    storage.add_posts(owner_id=1, chat_id=3, ids=[1500])
+    assert storage.posts_in_db(owner_id=1, chat_id=2, ids=range(990, 1600)) == set(
+        range(990, 1000)
+    )
+
+
+def test_add_posts_ignores_duplicates(storage: SQLiteStorage):
+    storage.add_posts(owner_id=1, chat_id=2, ids=[1, 2])
+    storage.add_posts(owner_id=1, chat_id=2, ids=[2, 3])
+    storage.add_posts(owner_id=1, chat_id=2, ids=[])
+    assert storage.posts_in_db(owner_id=1, chat_id=2, ids=[1, 2, 3, 4]) == {1, 2, 3}
+
+
+def test_storage_wal(storage: SQLiteStorage):
+    with storage.engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+
+
+def test_storage_close(tmpdir: py.path.local):
+    db_path = os.path.join(tmpdir, "database.db")
+    with SQLiteStorage(db_path) as storage:
+        storage.add_post(owner_id=1, chat_id=2, id=20)
+
+    assert not os.path.exists(db_path + "-wal") or not os.path.getsize(db_path + "-wal")
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT id FROM postdb").fetchall() == [(20,)]
+    conn.close()
+
+
+@pytest.mark.parametrize(
+    ("backend", "cls"), (("sqlite", SQLiteStorage), ("compact", CompactStorage))
+)
+def test_open_storage(
+    monkeypatch: pytest.MonkeyPatch, tmpdir: py.path.local, backend: str, cls: type
+):
+    monkeypatch.setenv("VK_TOKEN", "my_vk_token")
+    monkeypatch.setenv("VK_OWNER_ID", "1")
+    monkeypatch.setenv("TG_TOKEN", "my_tg_token")
+    monkeypatch.setenv("TG_CHAT_ID", "2")
+    monkeypatch.setenv("DB_PATH", os.path.join(tmpdir, "database.db"))
+    monkeypatch.setenv("DB_BACKEND", backend)
+    with open_storage(Settings()) as storage:  # type: ignore
+        assert isinstance(storage, cls)
+
+
+def _outbox_item(chat_id: int, post_id: int, **kwargs: Any):
+    return OutboxItem(
+        owner_id=1,
+        chat_id=chat_id,
+        post_id=post_id,
+        date=datetime(2022, 1, 1, 0, 0, post_id),
+        steps=[{"type": "message", "text": str(post_id)}],
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("backend", ("sqlite", "compact"))
+def test_outbox(tmpdir: py.path.local, backend: str):
+    db_path = os.path.join(tmpdir, "database.db")
+    storage = SQLiteStorage(db_path) if backend == "sqlite" else CompactStorage(db_path)
+
+    storage.enqueue_posts(
+        [_outbox_item(2, 20), _outbox_item(2, 10), _outbox_item(3, 10)]
+    )
+    # Enqueued post is never enqueued again
+    storage.enqueue_posts([_outbox_item(2, 10, attempts=4)])
+    storage.enqueue_posts([])
+    assert storage.posts_in_db(owner_id=1, chat_id=2, ids=[10, 20]) == {10, 20}
+    assert [(item.chat_id, item.post_id) for item in storage.get_outbox()] == [
+        (2, 10),
+        (3, 10),
+        (2, 20),
+    ]
+
+    item = storage.get_outbox()[0]
+    assert item == _outbox_item(2, 10)
+    item.sent_steps, item.attempts, item.next_attempt_at = 1, 2, 3.5
+    storage.update_outbox_item(item)
+    storage.remove_outbox_item(_outbox_item(3, 10))
+    assert storage.get_outbox() == [item, _outbox_item(2, 20)]
+    # Published post stays added
+    assert storage.post_in_db(owner_id=1, chat_id=3, id=10)
+
+
+@pytest.mark.parametrize("backend", ("sqlite", "compact"))
+def test_outbox_skips_pruned_posts(tmpdir: py.path.local, backend: str):
+    db_path = os.path.join(tmpdir, "database.db")
+    storage = (
+        SQLiteStorage(db_path, keep_ids=1)
+        if backend == "sqlite"
+        else CompactStorage(db_path, keep_ids=1)
+    )
+    storage.add_posts(owner_id=1, chat_id=2, ids=[1, 2, 3])
+    storage.prune()
+    storage.enqueue_posts([_outbox_item(2, 1), _outbox_item(2, 4)])
+    assert [item.post_id for item in storage.get_outbox()] == [4]
+
+
+@pytest.mark.parametrize("backend", ("sqlite", "compact"))
+def test_recorded_changes_apply_to_other_copy(tmpdir: py.path.local, backend: str):
+    def open(name: str):
+        db_path = os.path.join(tmpdir, name)
+        if backend == "sqlite":
+            return SQLiteStorage(db_path)
+        return CompactStorage(db_path)
+
+    changes: list[Change] = []
+    storage: Any = RecordingStorage(open("database.db"), changes)
+    storage.enqueue_posts([_outbox_item(2, 10), _outbox_item(2, 20)])
+    item = storage.get_outbox()[0]
+    item.attempts = 1
+    storage.update_outbox_item(item)
+    item.attempts = 2
+    storage.remove_outbox_item(_outbox_item(2, 20))
+    storage.add_post(owner_id=1, chat_id=3, id=30)
+    assert [name for name, _, _ in changes] == [
+        "enqueue_posts",
+        "update_outbox_item",
+        "remove_outbox_item",
+        "add_post",
+    ]
+
+    # Newer copy already has one of the posts published
+    other = open("other.db")
+    other.enqueue_posts([_outbox_item(2, 5), _outbox_item(2, 10)])
+    other.remove_outbox_item(_outbox_item(2, 5))
+    apply_changes(other, changes)
+    apply_changes(other, changes)
+    assert other.get_outbox() == [_outbox_item(2, 10, attempts=1)]
+    assert other.posts_in_db(owner_id=1, chat_id=2, ids=[5, 10, 20]) == {5, 10, 20}
+    assert other.post_in_db(owner_id=1, chat_id=3, id=30)
+
+    # Post published by the other copy meanwhile is not enqueued again
+    changes.clear()
+    storage.enqueue_posts([_outbox_item(2, 40)])
+    other.enqueue_posts([_outbox_item(2, 40)])
+    other.remove_outbox_item(_outbox_item(2, 40))
+    apply_changes(other, changes)
+    assert other.get_outbox() == [_outbox_item(2, 10, attempts=1)]
+
+
+@pytest.mark.parametrize("backend", ("sqlite", "compact"))
+def test_fingerprints(tmpdir: py.path.local, backend: str):
+    db_path = os.path.join(tmpdir, "database.db")
+    storage = SQLiteStorage(db_path) if backend == "sqlite" else CompactStorage(db_path)
+
+    storage.add_fingerprints(
+        chat_id=1, fingerprints={-(2**63): 100, 2**63 - 1: 200}, expire_before=0
+    )
+    storage.add_fingerprints(chat_id=2, fingerprints={5: 100}, expire_before=0)
+    assert storage.get_fingerprints(chat_id=1, fingerprints=[-(2**63), 5, 7]) == {
+        -(2**63): 100
+    }
+
+    # Newer date replaces older one, expired ones are removed
+    storage.add_fingerprints(
+        chat_id=1, fingerprints={2**63 - 1: 300}, expire_before=150
+    )
+    storage.close()
+    storage = SQLiteStorage(db_path) if backend == "sqlite" else CompactStorage(db_path)
+    assert storage.get_fingerprints(
+        chat_id=1, fingerprints=[-(2**63), 2**63 - 1]
+    ) == {2**63 - 1: 300}
+    assert storage.get_fingerprints(chat_id=2, fingerprints=[5]) == {5: 100}
+
+
+def test_prune(tmpdir: py.path.local):
+    storage = SQLiteStorage(os.path.join(tmpdir, "database.db"), keep_ids=2)
+    storage.add_posts(owner_id=1, chat_id=2, ids=range(1, 11))
+    storage.add_posts(owner_id=1, chat_id=3, ids=[5])
+    storage.prune()
+    with Session(storage.engine) as session:
+        assert sorted(
+            (post.chat_id, post.id) for post in session.exec(select(PostDB))
+        ) == [
+            (2, 9),
+            (2, 10),
+            (3, 5),
+        ]
+    # Pruned ids are still added
+    assert storage.posts_in_db(owner_id=1, chat_id=2, ids=range(12)) == set(
+        range(1, 11)
+    ) | {0}
+    assert storage.posts_in_db(owner_id=1, chat_id=3, ids=[1, 5]) == {5}
+    assert storage.get_last_post_id(owner_id=1, chat_ids=[2]) == 10
+
+    # Floor never goes down
+    storage.add_posts(owner_id=1, chat_id=2, ids=[1, 2, 3])
+    storage.prune()
+    assert storage.posts_in_db(owner_id=1, chat_id=2, ids=[8]) == {8}
+
+
+def test_prune_vacuums(tmpdir: py.path.local):
+    db_path = os.path.join(tmpdir, "database.db")
+    storage = SQLiteStorage(db_path, keep_ids=1)
+    storage.add_posts(owner_id=1, chat_id=2, ids=range(100_000))
+    storage.close()
+    size = os.path.getsize(db_path)
+
+    storage = SQLiteStorage(db_path, keep_ids=1)
+    storage.prune()
+    storage.close()
+    assert os.path.getsize(db_path) < size / 10
@@ -0,0 +1,134 @@
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+import py
+import pytest
+
+from flow.db.compact import CompactStorage
+from flow.db.sqlite import SQLiteStorage
+from flow.models import OutboxItem
+
+
+@pytest.fixture
+def db_path(tmpdir: py.path.local):
+    return os.path.join(tmpdir, "database.db")
+
+
+@pytest.fixture
+def storage(db_path: str):
+    return CompactStorage(db_path, keep_ids=3)
+
+
+def test_add_posts(storage: CompactStorage):
+    storage.add_posts(owner_id=1, chat_id=2, ids=[5, 3])
+    storage.add_post(owner_id=1, chat_id=2, id=4)
+    assert storage.posts_in_db(owner_id=1, chat_id=2, ids=[2, 3, 4, 5, 6]) == {
+        3,
+        4,
+        5,
+    }
+    assert storage.post_in_db(owner_id=1, chat_id=2, id=4)
+    assert not storage.post_in_db(owner_id=1, chat_id=3, id=4)
+
+
+def test_add_posts_keeps_recent_ids(storage: CompactStorage, db_path: str):
+    storage.add_posts(owner_id=1, chat_id=2, ids=[10, 20, 30, 40, 50])
+    with open(db_path) as f:
+        assert json.load(f)["routes"] == [
+            {"owner_id": 1, "chat_id": 2, "floor": 20, "ids": [30, 40, 50]}
+        ]
+    # Everything below the window is considered published
+    assert storage.posts_in_db(owner_id=1, chat_id=2, ids=[15, 35, 40]) == {15, 40}
+
+
+def test_persisted(storage: CompactStorage, db_path: str):
+    storage.add_posts(owner_id=1, chat_id=2, ids=[10, 20])
+    assert CompactStorage(db_path).posts_in_db(
+        owner_id=1, chat_id=2, ids=[10, 20, 30]
+    ) == {10, 20}
+
+
+def test_get_last_post_id(storage: CompactStorage):
+    storage.add_posts(owner_id=1, chat_id=2, ids=[5, 7])
+    storage.add_post(owner_id=1, chat_id=3, id=6)
+    assert storage.get_last_post_id(owner_id=1, chat_ids=[2]) == 7
+    assert storage.get_last_post_id(owner_id=1, chat_ids=[2, 3]) == 6
+    assert storage.get_last_post_id(owner_id=1, chat_ids=[2, 4]) is None
+    assert storage.get_last_post_id(owner_id=1, chat_ids=[]) is None
+
+
+def test_migrate_from_sqlite(db_path: str):
+    item = OutboxItem(
+        owner_id=1,
+        chat_id=2,
+        post_id=11,
+        date=datetime(2022, 1, 1),
+        steps=[{"type": "message", "text": "text"}],
+        attempts=1,
+        next_attempt_at=5.5,
+    )
+    with SQLiteStorage(db_path, keep_ids=2) as sqlite_storage:
+        sqlite_storage.add_posts(owner_id=1, chat_id=2, ids=[1, 5, 10, 20])
+        sqlite_storage.add_post(owner_id=3, chat_id=2, id=30)
+        sqlite_storage.prune()
+        sqlite_storage.enqueue_posts([item])
+        sqlite_storage.add_fingerprints(
+            chat_id=2, fingerprints={123: 1000.0}, expire_before=0
+        )
+
+    storage = CompactStorage(db_path)
+    # Floor of the route is kept: pruned ids are still added
+    assert storage.posts_in_db(owner_id=1, chat_id=2, ids=[3, 7, 10, 11, 30]) == {
+        3,
+        10,
+        11,
+    }
+    assert storage.post_in_db(owner_id=3, chat_id=2, id=30)
+    assert storage.get_outbox() == [item]
+    assert storage.get_fingerprints(chat_id=2, fingerprints=[123]) == {123: 1000.0}
+    with open(db_path) as f:
+        assert json.load(f)["version"] == 1
+
+
+def test_migrate_from_legacy_sqlite(db_path: str):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE postdb (id INTEGER NOT NULL PRIMARY KEY)")
+        conn.executemany("INSERT INTO postdb (id) VALUES (?)", [(10,), (20,)])
+    conn.close()
+
+    storage = CompactStorage(db_path)
+    assert not storage.post_in_db(owner_id=1, chat_id=2, id=10)
+    storage.adopt_legacy_posts(owner_id=1, chat_id=2)
+    storage.adopt_legacy_posts(owner_id=1, chat_id=3)
+    assert CompactStorage(db_path).posts_in_db(owner_id=1, chat_id=2, ids=[10, 20]) == {
+        10,
+        20,
+    }
+    assert not storage.post_in_db(owner_id=1, chat_id=3, id=10)
+
+
+def test_unchanged_file_not_rewritten(storage: CompactStorage, db_path: str):
+    storage.add_post(owner_id=1, chat_id=2, id=10)
+    mtime = os.stat(db_path).st_mtime_ns
+    with CompactStorage(db_path) as storage:
+        storage.posts_in_db(owner_id=1, chat_id=2, ids=[10])
+    assert os.stat(db_path).st_mtime_ns == mtime
+
+
+def test_outbox_persisted(storage: CompactStorage, db_path: str):
+    item = OutboxItem(
+        owner_id=1,
+        chat_id=2,
+        post_id=3,
+        date=datetime(2022, 1, 1, tzinfo=timezone.utc),
+        steps=[{"type": "photos", "photo_urls": ["https://example.com"]}],
+        attempts=1,
+    )
+    storage.enqueue_posts([item])
+    assert CompactStorage(db_path).get_outbox() == [item]
+
+    storage.remove_outbox_item(item)
+    with open(db_path) as f:
+        assert "outbox" not in json.load(f)
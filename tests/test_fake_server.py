@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import argparse
+
+import pytest
+
+from benchmarks.load import main, run
+
+
+@pytest.mark.parametrize("mode", ("main", "lambda"))
+def test_load(mode: str, monkeypatch: pytest.MonkeyPatch, tmpdir: str):
+    # Whole run over real HTTP: VK execute, Telegram requests, S3 sync
+    monkeypatch.chdir(tmpdir)
+    args = argparse.Namespace(
+        mode=mode,
+        runs=2,
+        walls=3,
+        chats=2,
+        wall_size=3,
+        new_posts=1,
+        latency=0,
+        error_rate=0,
+        flood_rate=0,
+        retry_after=1,
+        tg_rate_limit=0,
+        tg_chat_rate_limit=0,
+        db_backend="sqlite",
+    )
+    result = run(args)
+    assert result["failed_runs"] == 0
+    assert result["posts"] == 3 * (3 + 1) * 2
+    assert result["requests"]["tg"] >= result["posts"]
+    if mode == "lambda":
+        assert result["requests"]["s3.put"] == 2
+
+
+def test_load_retries_after_429(capsys: pytest.CaptureFixture[str]):
+    main(
+        [
+            "--runs=1",
+            "--walls=1",
+            "--chats=1",
+            "--wall-size=5",
+            "--latency=0",
+            "--flood-rate=0.2",
+            "--retry-after=0",
+            "--tg-chat-rate-limit=0",
+        ]
+    )
+    out = capsys.readouterr().out
+    assert "5 posts in 1 runs (0 failed)" in out
+    assert "tg.429" in out
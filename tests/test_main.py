@@ -1,18 +1,36 @@
+from __future__ import annotations
+
+import gzip
+import json
 import os
-from datetime import datetime
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Any
 from unittest.mock import Mock
 
 import boto3
-import botocore.exceptions
+import moto
 import py
 import pytest
 import sentry_sdk
+from pydantic import ValidationError
 from sqlmodel import Session, select  # pyright: ignore[reportUnknownVariableType]
 
 import flow.main
-from flow.db import Storage
-from flow.main import _init_sentry, lambda_handler, main
-from flow.models import LambdaSettings, Post, PostDB, Settings
+from flow.db.sqlite import PostDB, SQLiteStorage
+from flow.main import _get_deadline, init_sentry, lambda_handler, main
+from flow.models import (
+    LambdaSettings,
+    OutboxItem,
+    PhotoSizePolicy,
+    Post,
+    Route,
+    Settings,
+)
+from flow.tg import AsyncBot
 
 
 @pytest.fixture
@@ -30,17 +48,43 @@ def settings(monkeypatch: pytest.MonkeyPatch, tmpdir: py.path.local):
 def test_sentry_initialised(monkeypatch: pytest.MonkeyPatch):
     m = Mock()
     monkeypatch.setattr(sentry_sdk, "init", m)
-    _init_sentry("mydsn")
+    init_sentry("mydsn")
     assert m.call_args[0][0] == "mydsn"
 
 
 def test_sentry_not_initialised(monkeypatch: pytest.MonkeyPatch):
     m = Mock()
     monkeypatch.setattr(sentry_sdk, "init", m)
-    _init_sentry(None)
+    init_sentry(None)
     m.assert_not_called()
 
 
+def test_settings_routes(settings: Settings):
+    assert settings.get_routes() == [Route(vk_owner_id=1, tg_chat_ids=[2])]
+
+
+def test_settings_no_routes(monkeypatch: pytest.MonkeyPatch, settings: Settings):
+    monkeypatch.delenv("VK_OWNER_ID")
+    with pytest.raises(ValidationError):
+        Settings()  # type: ignore
+
+
+def _mock_walls(monkeypatch: pytest.MonkeyPatch, get_wall_async: Any):
+    # Fake of get_walls_async built from per-owner fake of get_wall_async
+    async def get_walls_async(*, since_ids: dict[int, int | None], **kwargs: Any):
+        res: dict[int, Any] = {}
+        for owner_id, since_id in since_ids.items():
+            try:
+                res[owner_id] = await get_wall_async(
+                    owner_id=owner_id, since_id=since_id, **kwargs
+                )
+            except Exception as exc:
+                res[owner_id] = exc
+        return res
+
+    monkeypatch.setattr(flow.main, "get_walls_async", get_walls_async)
+
+
 def test_main_main(monkeypatch: pytest.MonkeyPatch, settings: Settings):
     called_get_wall = False
 
@@ -48,37 +92,56 @@ def test_main_main(monkeypatch: pytest.MonkeyPatch, settings: Settings):
     datetime_1 = datetime.now()
     datetime_2 = datetime.now()
 
-    def get_wall(*, token: str, owner_id: int):
+    async def get_walls_async(
+        *,
+        client: Any,
+        token: str,
+        since_ids: dict[int, int | None],
+        page_size: int,
+        max_pages: int,
+        photo_policy: PhotoSizePolicy,
+        semaphore: Any,
+        probe: bool,
+        endpoint: str,
+    ):
         nonlocal called_get_wall
         called_get_wall = True
         assert token == settings.vk_token
-        assert owner_id == settings.vk_owner_id
-        return [
-            Post(id=2, text="text 2", photos=[], date=datetime_2),
-            Post(id=1, text="text 1", photos=[], date=datetime_1),
-            Post(id=0, text="text 0", photos=[], date=datetime_0),
-        ]
+        assert since_ids == {settings.vk_owner_id: 2}
+        assert page_size == settings.vk_page_size
+        assert max_pages == settings.vk_max_pages
+        assert photo_policy == PhotoSizePolicy()
+        assert probe
+        assert endpoint == "https://api.vk.com"
+        return {
+            settings.vk_owner_id: [
+                Post(id=2, text="text 2", photos=[], date=datetime_2),
+                Post(id=1, text="text 1", photos=[], date=datetime_1),
+                Post(id=0, text="text 0", photos=[], date=datetime_0),
+            ]
+        }
 
     called_publish_post = False
     published_post_ids: list[int] = []
 
-    def publish_post(*, token: str, chat_id: int, post: Post):
+    async def publish_item_async(*, bot: AsyncBot, item: OutboxItem):
         nonlocal called_publish_post
         called_publish_post = True
-        assert token == settings.tg_token
-        assert chat_id == settings.tg_chat_id
-        published_post_ids.append(post.id)
+        assert bot.token == settings.tg_token
+        assert item.chat_id == settings.tg_chat_id
+        published_post_ids.append(item.post_id)
 
-    storage = Storage(settings.db_path)
-    storage.add_post(2)
+    storage = SQLiteStorage(settings.db_path)
+    storage.add_post(owner_id=1, chat_id=2, id=2)
 
-    monkeypatch.setattr(flow.main, "get_wall", get_wall)
-    monkeypatch.setattr(flow.main, "publish_post", publish_post)
+    monkeypatch.setattr(flow.main, "get_walls_async", get_walls_async)
+    monkeypatch.setattr(flow.main, "publish_item_async", publish_item_async)
 
+    # Oldest post goes first
     assert main(settings.copy()) == 0
     assert called_get_wall
     assert called_publish_post
-    assert published_post_ids == [1]
+    assert published_post_ids == [0]
 
     called_get_wall = False
     called_publish_post = False
@@ -87,10 +150,274 @@ def test_main_main(monkeypatch: pytest.MonkeyPatch, settings: Settings):
     assert main(settings.copy()) == 0
     assert called_get_wall
     assert called_publish_post
-    assert published_post_ids == [0]
+    assert published_post_ids == [1]
 
     with Session(storage.engine) as session:
-        assert [post.id for post in session.exec(select(PostDB))] == [0, 1, 2]
+        assert sorted(post.id for post in session.exec(select(PostDB))) == [0, 1, 2]
+
+
+def test_main_main_routes(monkeypatch: pytest.MonkeyPatch, settings: Settings):
+    settings.vk_owner_id = None
+    settings.tg_chat_id = None
+    settings.routes = [
+        Route(vk_owner_id=1, tg_chat_ids=[10, 11]),
+        Route(vk_owner_id=2, tg_chat_ids=[10]),
+        Route(vk_owner_id=1, tg_chat_ids=[12]),
+    ]
+    fetched_owner_ids: list[int] = []
+    published: list[tuple[int, int]] = []
+
+    async def get_wall_async(*, token: str, owner_id: int, **kwargs: Any):
+        fetched_owner_ids.append(owner_id)
+        return [
+            Post(id=id, text=f"text {id}", photos=[], date=datetime.now())
+            for id in (owner_id * 100, owner_id * 100 + 1)
+        ]
+
+    async def publish_item_async(*, bot: AsyncBot, item: OutboxItem):
+        published.append((item.chat_id, item.post_id))
+
+    _mock_walls(monkeypatch, get_wall_async)
+    monkeypatch.setattr(flow.main, "publish_item_async", publish_item_async)
+
+    storage = SQLiteStorage(settings.db_path)
+    storage.add_post(owner_id=1, chat_id=11, id=100)
+
+    assert main(settings) == 0
+    assert sorted(fetched_owner_ids) == [1, 2]
+    assert sorted(published) == [(10, 100), (10, 200), (11, 101), (12, 100)]
+
+
+def _make_legacy_db(db_path: str, ids: list[int]):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE postdb (id INTEGER NOT NULL PRIMARY KEY)")
+        conn.executemany("INSERT INTO postdb (id) VALUES (?)", [(id,) for id in ids])
+    conn.close()
+
+
+def test_main_main_adopts_legacy_posts_with_routes(
+    monkeypatch: pytest.MonkeyPatch, settings: Settings
+):
+    settings.vk_owner_id = None
+    settings.tg_chat_id = None
+    settings.routes = [Route(vk_owner_id=1, tg_chat_ids=[10])]
+    _make_legacy_db(settings.db_path, [1])
+    published: list[int] = []
+
+    async def get_wall_async(*, token: str, owner_id: int, **kwargs: Any):
+        return [
+            Post(id=id, text=f"text {id}", photos=[], date=datetime.now())
+            for id in (2, 1)
+        ]
+
+    async def publish_item_async(*, bot: AsyncBot, item: OutboxItem):
+        published.append(item.post_id)
+
+    _mock_walls(monkeypatch, get_wall_async)
+    monkeypatch.setattr(flow.main, "publish_item_async", publish_item_async)
+
+    assert main(settings) == 0
+    assert published == [2]
+
+
+def test_main_main_legacy_posts_ambiguous_routes(
+    monkeypatch: pytest.MonkeyPatch, settings: Settings
+):
+    settings.vk_owner_id = None
+    settings.tg_chat_id = None
+    settings.routes = [Route(vk_owner_id=1, tg_chat_ids=[10, 11])]
+    _make_legacy_db(settings.db_path, [1])
+
+    async def get_wall_async(**kwargs: Any):
+        raise AssertionError("Nothing is fetched")
+
+    _mock_walls(monkeypatch, get_wall_async)
+    with pytest.raises(ValueError, match="VK_OWNER_ID and TG_CHAT_ID"):
+        main(settings)
+
+
+@pytest.mark.parametrize("dedupe_window", (0, 3600))
+def test_main_main_skips_duplicates(
+    monkeypatch: pytest.MonkeyPatch, settings: Settings, dedupe_window: float
+):
+    settings.routes = [Route(vk_owner_id=2, tg_chat_ids=[settings.tg_chat_id])]  # type: ignore
+    settings.dedupe_window = dedupe_window
+    now = datetime.now()
+    walls = {
+        1: [Post(id=1, text="Repost", photos=[], date=now)],
+        # Same ids on other wall are other posts
+        2: [
+            Post(id=1, text="Other", photos=[], date=now),
+            Post(id=2, text=" repost", photos=[], date=now),
+            Post(id=3, text="Other", photos=[], date=now - timedelta(hours=2)),
+        ],
+    }
+    published: list[tuple[int, list[dict[str, Any]]]] = []
+
+    async def get_wall_async(*, token: str, owner_id: int, **kwargs: Any):
+        return walls[owner_id]
+
+    async def publish_item_async(*, bot: AsyncBot, item: OutboxItem):
+        published.append((item.owner_id, item.steps))
+
+    _mock_walls(monkeypatch, get_wall_async)
+    monkeypatch.setattr(flow.main, "publish_item_async", publish_item_async)
+    settings.publish_limit = 0
+
+    assert main(settings) == 0
+    # Routes go first, so the repost from wall 2 is published first
+    texts = sorted((owner_id, steps[0]["text"]) for owner_id, steps in published)
+    if dedupe_window:
+        assert texts == [(2, "Other"), (2, "Other"), (2, "repost")]
+    else:
+        assert texts == [(1, "Repost"), (2, "Other"), (2, "Other"), (2, "repost")]
+    # Duplicates are never fetched again
+    with SQLiteStorage(settings.db_path) as storage:
+        assert storage.posts_in_db(owner_id=2, chat_id=2, ids=[1, 2, 3]) == {1, 2, 3}
+
+
+def test_main_main_wall_error(monkeypatch: pytest.MonkeyPatch, settings: Settings):
+    settings.routes = [Route(vk_owner_id=3, tg_chat_ids=[10])]
+    published: list[int] = []
+
+    async def get_wall_async(*, token: str, owner_id: int, **kwargs: Any):
+        if owner_id == 3:
+            raise RuntimeError
+        return [Post(id=1, text="text", photos=[], date=datetime.now())]
+
+    async def publish_item_async(*, bot: AsyncBot, item: OutboxItem):
+        published.append(item.chat_id)
+
+    _mock_walls(monkeypatch, get_wall_async)
+    monkeypatch.setattr(flow.main, "publish_item_async", publish_item_async)
+
+    with pytest.raises(RuntimeError):
+        main(settings)
+    assert published == [settings.tg_chat_id]
+
+
+def _mock_backlog(monkeypatch: pytest.MonkeyPatch, published: list[int]):
+    async def get_wall_async(*, token: str, owner_id: int, **kwargs: Any):
+        return [
+            Post(id=id, text=f"text {id}", photos=[], date=datetime.fromtimestamp(id))
+            for id in range(1, 6)
+        ]
+
+    async def publish_item_async(*, bot: AsyncBot, item: OutboxItem):
+        published.append(item.post_id)
+
+    _mock_walls(monkeypatch, get_wall_async)
+    monkeypatch.setattr(flow.main, "publish_item_async", publish_item_async)
+
+
+@pytest.mark.parametrize(("limit", "expected"), ((0, [1, 2, 3, 4, 5]), (3, [1, 2, 3])))
+def test_main_main_publish_limit(
+    monkeypatch: pytest.MonkeyPatch, settings: Settings, limit: int, expected: list[int]
+):
+    published: list[int] = []
+    _mock_backlog(monkeypatch, published)
+    settings.publish_limit = limit
+    main(settings)
+    assert published == expected
+
+    storage = SQLiteStorage(settings.db_path)
+    assert all(storage.post_in_db(owner_id=1, chat_id=2, id=id) for id in expected)
+
+
+def test_main_main_deadline(monkeypatch: pytest.MonkeyPatch, settings: Settings):
+    published: list[int] = []
+    _mock_backlog(monkeypatch, published)
+    settings.publish_limit = 0
+    main(settings, deadline=time.monotonic() - 1)
+    assert published == []
+
+
+def test_main_main_stages(monkeypatch: pytest.MonkeyPatch, settings: Settings):
+    published: list[int] = []
+    _mock_backlog(monkeypatch, published)
+    settings.publish_limit = 0
+
+    main(settings, stage="fetch")
+    assert published == []
+    assert [item.post_id for item in SQLiteStorage(settings.db_path).get_outbox()] == [
+        1,
+        2,
+        3,
+        4,
+        5,
+    ]
+
+    async def get_walls_async(**kwargs: Any):
+        raise AssertionError("Publish stage doesn't use VK")
+
+    monkeypatch.setattr(flow.main, "get_walls_async", get_walls_async)
+    main(settings, stage="publish")
+    assert published == [1, 2, 3, 4, 5]
+    assert SQLiteStorage(settings.db_path).get_outbox() == []
+
+
+def test_main_main_publish_retry(monkeypatch: pytest.MonkeyPatch, settings: Settings):
+    published: list[int] = []
+    _mock_backlog(monkeypatch, published)
+    settings.publish_limit = 0
+    settings.outbox_max_attempts = 2
+
+    async def publish_item_async(*, bot: AsyncBot, item: OutboxItem):
+        if item.post_id == 2:
+            item.sent_steps = 1
+            raise RuntimeError
+        published.append(item.post_id)
+
+    monkeypatch.setattr(flow.main, "publish_item_async", publish_item_async)
+    with pytest.raises(RuntimeError):
+        main(settings)
+    # Later posts wait for the failed one
+    assert published == [1]
+    (item, *_) = SQLiteStorage(settings.db_path).get_outbox()
+    assert (item.post_id, item.sent_steps, item.attempts) == (2, 1, 1)
+    assert item.next_attempt_at == pytest.approx(time.time() + 60, abs=5)
+
+    # Not retried until it's due
+    main(settings, stage="publish")
+    assert published == [1]
+
+    storage = SQLiteStorage(settings.db_path)
+    item.next_attempt_at = 0
+    storage.update_outbox_item(item)
+    with pytest.raises(RuntimeError):
+        main(settings, stage="publish")
+    # Dropped after the last attempt, so the rest is published next time
+    main(settings, stage="publish")
+    assert published == [1, 3, 4, 5]
+
+
+def test_main_main_metrics(
+    monkeypatch: pytest.MonkeyPatch,
+    settings: Settings,
+    capsys: pytest.CaptureFixture[str],
+):
+    _mock_backlog(monkeypatch, [])
+    SQLiteStorage(settings.db_path).add_post(owner_id=1, chat_id=2, id=1)
+    settings.publish_limit = 2
+    settings.emit_metrics = True
+    main(settings)
+
+    line = json.loads(capsys.readouterr().out)
+    assert line["posts.skipped"] == 1
+    assert line["posts.published"] == 2
+    assert {"run", "vk.fetch", "tg.publish", "db.read", "db.write"} <= line.keys()
+
+
+def test_get_deadline(lambda_settings: LambdaSettings):
+    class Context:
+        def get_remaining_time_in_millis(self):
+            return 30_000
+
+    now = time.monotonic()
+    deadline = _get_deadline(lambda_settings, Context())
+    assert deadline is not None
+    assert now + 19 < deadline <= time.monotonic() + 20
+    assert _get_deadline(lambda_settings, None) is None
 
 
 @pytest.fixture
@@ -98,53 +425,444 @@ def lambda_settings(monkeypatch: pytest.MonkeyPatch, settings: Settings):
     # Other env vars loaded from "settings" fixture
     monkeypatch.setenv("S3_BUCKET", "my_bucket")
     monkeypatch.setenv("S3_KEY", "my_key")
-    monkeypatch.setenv("S3_ENDPOINT", "my_endpoint")
+    monkeypatch.setenv("S3_ENDPOINT", "https://s3.amazonaws.com")
     monkeypatch.setenv("AWS_ACCESS_KEY_ID", "my_key")
     monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "my_access_key")
-    return LambdaSettings()  # type: ignore
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    # Most tests write fake database that can't be probed
+    monkeypatch.setenv("VK_PROBE", "false")
+    yield LambdaSettings()  # type: ignore
+    if flow.main._warm_context is not None:
+        flow.main._warm_context.close()
+        flow.main._warm_context = None
+
+
+@pytest.fixture
+def s3(lambda_settings: LambdaSettings):
+    with moto.mock_aws():
+        client = boto3.client("s3")  # type: ignore
+        client.create_bucket(Bucket=lambda_settings.s3_bucket)
+        yield client
+
+
+@pytest.fixture
+def s3_calls(monkeypatch: pytest.MonkeyPatch, s3: Any):
+    calls: list[str] = []
+    client: Any = boto3.client  # type: ignore
+
+    def client_with_spy(*args: Any, **kwargs: Any) -> Any:
+        res: Any = client(*args, **kwargs)
+        res.meta.events.register(
+            "before-call.s3",
+            lambda model, **kw: calls.append(model.name),  # type: ignore
+        )
+        return res
+
+    monkeypatch.setattr(boto3, "client", client_with_spy)
+    return calls
+
+
+def _mock_main(monkeypatch: pytest.MonkeyPatch, content: bytes | None):
+    def main(settings: Settings, deadline: float | None, stage: str, **kwargs: Any):
+        assert deadline is None
+        assert stage == "all"
+        if content is not None:
+            with open(settings.db_path, "wb") as f:
+                f.write(content)
+
+    monkeypatch.setattr(flow.main, "main", main)
+
+
+def _get_raw_object(s3: Any, settings: LambdaSettings) -> bytes:
+    return s3.get_object(Bucket=settings.s3_bucket, Key=settings.s3_key)["Body"].read()
 
 
-@pytest.mark.parametrize("fail_download", (True, False))
-def test_lambda_handler(
+def _get_object(s3: Any, settings: LambdaSettings) -> bytes:
+    return gzip.decompress(_get_raw_object(s3, settings))
+
+
+def test_lambda_handler_initial(
     monkeypatch: pytest.MonkeyPatch,
     lambda_settings: LambdaSettings,
-    fail_download: bool,
+    s3: Any,
+    s3_calls: list[str],
 ):
-    calls: list[str] = []
+    _mock_main(monkeypatch, b"db")
+    lambda_handler(None, None)
+    assert s3_calls == ["GetObject", "PutObject"]
+    assert _get_object(s3, lambda_settings) == b"db"
+
+
+def test_lambda_handler_warm_unchanged(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+    s3_calls: list[str],
+):
+    _mock_main(monkeypatch, b"db")
+    lambda_handler(None, None)
+    s3_calls.clear()
+
+    _mock_main(monkeypatch, None)
+    lambda_handler(None, None)
+    assert s3_calls == ["GetObject"]
+
+
+def test_lambda_handler_warm_changed(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+    s3_calls: list[str],
+):
+    _mock_main(monkeypatch, b"db")
+    lambda_handler(None, None)
+    _mock_main(monkeypatch, b"db 2")
+    lambda_handler(None, None)
+    assert _get_object(s3, lambda_settings) == b"db 2"
+
+
+def test_lambda_handler_cold_downloads(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+    s3_calls: list[str],
+):
+    s3.put_object(
+        Bucket=lambda_settings.s3_bucket, Key=lambda_settings.s3_key, Body=b"remote"
+    )
+    with open(lambda_settings.db_path, "wb") as f:
+        f.write(b"stale")
+    _mock_main(monkeypatch, None)
+    lambda_handler(None, None)
+
+    with open(lambda_settings.db_path, "rb") as f:
+        assert f.read() == b"remote"
+    assert s3_calls == ["GetObject"]
+
+
+@pytest.mark.parametrize("compression", ("gzip", "none"))
+def test_lambda_handler_compression(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+    compression: str,
+):
+    monkeypatch.setenv("S3_COMPRESSION", compression)
+    content = b"db" * 1000
+    _mock_main(monkeypatch, content)
+    lambda_handler(None, None)
+    raw = _get_raw_object(s3, lambda_settings)
+    if compression == "none":
+        assert raw == content
+    else:
+        assert len(raw) < len(content)
+        assert gzip.decompress(raw) == content
+
+    # Cold start reads snapshot in either format
+    os.remove(lambda_settings.db_path)
+    _mock_main(monkeypatch, None)
+    lambda_handler(None, None)
+    with open(lambda_settings.db_path, "rb") as f:
+        assert f.read() == content
+
+
+def test_lambda_handler_uploads_on_error(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+):
+    def main(settings: Settings, deadline: float | None, stage: str, **kwargs: Any):
+        with open(settings.db_path, "wb") as f:
+            f.write(b"partial")
+        raise RuntimeError
+
+    monkeypatch.setattr(flow.main, "main", main)
+    with pytest.raises(RuntimeError):
+        lambda_handler(None, None)
+    assert _get_object(s3, lambda_settings) == b"partial"
+
+
+def test_lambda_handler_metrics(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+    capsys: pytest.CaptureFixture[str],
+):
+    _mock_main(monkeypatch, b"db")
+    lambda_handler(None, None)
+
+    (line,) = capsys.readouterr().out.splitlines()
+    metrics = json.loads(line)
+    assert metrics["s3.bytes_uploaded"] == len(_get_raw_object(s3, lambda_settings))
+    assert {"run", "s3.download", "s3.compress", "s3.upload"} <= metrics.keys()
+
+
+def test_lambda_handler_skips_unchanged(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+    s3_calls: list[str],
+):
+    monkeypatch.setenv("VK_PROBE", "true")
+    runs: list[str] = []
+
+    def main(settings: Settings, deadline: float | None, stage: str, **kwargs: Any):
+        runs.append(stage)
+        with SQLiteStorage(settings.db_path) as storage:
+            storage.add_post(owner_id=1, chat_id=2, id=5)
+
+    changed = False
+
+    async def probe_walls_async(*, since_ids: dict[int, int], **kwargs: Any):
+        assert since_ids == {1: 5}
+        return {1: changed}
+
+    monkeypatch.setattr(flow.main, "main", main)
+    monkeypatch.setattr(flow.main, "probe_walls_async", probe_walls_async)
+
+    # Cold start: nothing to probe with
+    lambda_handler(None, None)
+    assert runs == ["all"]
+    assert s3_calls == ["GetObject", "PutObject"]
+    s3_calls.clear()
+
+    # Only a cheap check that nobody else has changed the database
+    lambda_handler(None, None)
+    assert runs == ["all"]
+    assert s3_calls == ["HeadObject"]
+    s3_calls.clear()
+
+    changed = True
+    lambda_handler(None, None)
+    assert runs == ["all", "all"]
+    assert s3_calls == ["HeadObject", "GetObject"]
+
+
+def test_lambda_handler_publishes_outbox_without_changes(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+):
+    monkeypatch.setenv("VK_PROBE", "true")
+    runs: list[str] = []
+
+    def main(settings: Settings, deadline: float | None, stage: str, **kwargs: Any):
+        runs.append(stage)
+        with SQLiteStorage(settings.db_path) as storage:
+            storage.enqueue_posts(
+                [
+                    OutboxItem(
+                        owner_id=1,
+                        chat_id=2,
+                        post_id=5,
+                        date=datetime.now(),
+                        steps=[],
+                        next_attempt_at=0 if not runs[1:] else time.time() + 60,
+                    )
+                ]
+            )
+
+    async def probe_walls_async(**kwargs: Any):
+        raise AssertionError("Publish stage doesn't probe walls")
+
+    monkeypatch.setattr(flow.main, "main", main)
+    monkeypatch.setattr(flow.main, "probe_walls_async", probe_walls_async)
+
+    flow.main.publish_lambda_handler(None, None)
+    flow.main.publish_lambda_handler(None, None)
+    assert runs == ["publish", "publish"]
+
+
+def test_lambda_handler_publishes_outbox_of_other_writer(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+    s3_calls: list[str],
+    tmpdir: py.path.local,
+):
+    monkeypatch.setenv("VK_PROBE", "true")
+    published: list[int] = []
+
+    async def publish_item_async(*, bot: AsyncBot, item: OutboxItem):
+        published.append(item.post_id)
+
+    monkeypatch.setattr(flow.main, "publish_item_async", publish_item_async)
+
+    flow.main.publish_lambda_handler(None, None)
+    s3_calls.clear()
+    flow.main.publish_lambda_handler(None, None)
+    assert s3_calls == ["HeadObject"]
+    assert published == []
+
+    # Fetch function enqueues a post, local outbox of publish one is stale
+    other_path = os.path.join(tmpdir, "other.db")
+    with SQLiteStorage(other_path) as storage:
+        storage.enqueue_posts([_make_outbox_item(5)])
+    _put_db(s3, lambda_settings, other_path)
+    s3_calls.clear()
+
+    flow.main.publish_lambda_handler(None, None)
+    assert s3_calls[:2] == ["HeadObject", "GetObject"]
+    assert published == [5]
+
+
+def test_lambda_handler_probes_walls_once(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+):
+    monkeypatch.setenv("VK_PROBE", "true")
+    probes: list[bool] = []
+
+    async def get_walls_async(
+        *, since_ids: dict[int, int | None], probe: bool, **kwargs: Any
+    ) -> dict[int, list[Post]]:
+        probes.append(probe)
+        return {owner_id: [] for owner_id in since_ids}
+
+    async def probe_walls_async(*, since_ids: dict[int, int], **kwargs: Any):
+        return {owner_id: True for owner_id in since_ids}
+
+    monkeypatch.setattr(flow.main, "get_walls_async", get_walls_async)
+    monkeypatch.setattr(flow.main, "probe_walls_async", probe_walls_async)
+
+    with SQLiteStorage(lambda_settings.db_path) as storage:
+        storage.add_post(owner_id=1, chat_id=2, id=5)
+    _put_db(s3, lambda_settings, lambda_settings.db_path)
+    os.remove(lambda_settings.db_path)
+
+    # Cold start probes in get_walls_async, warm one before the download
+    lambda_handler(None, None)
+    lambda_handler(None, None)
+    assert probes == [True, False]
+
+
+def test_lambda_handler_reuses_warm_context(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+):
+    resources: list[tuple[Any, ...]] = []
+
+    def main(settings: Settings, deadline: float | None, stage: str, context: Any):
+        context.storage.add_post(owner_id=1, chat_id=2, id=1)
+        resources.append((context, context._storage, context.client, context.s3))
 
-    class MyClient:
-        def __init__(
-            self,
-            service_name: str,
-            endpoint_url: str,
-            aws_access_key_id: str,
-            aws_secret_access_key: str,
-        ):
-            assert service_name == "s3"
-            assert endpoint_url == lambda_settings.s3_endpoint
-            assert aws_access_key_id == lambda_settings.aws_access_key_id
-            assert aws_secret_access_key == lambda_settings.aws_secret_access_key
-            calls.append("init")
-
-        def download_file(self, Bucket: str, Key: str, Filename: str):
-            assert Bucket == lambda_settings.s3_bucket
-            assert Key == lambda_settings.s3_key
-            assert Filename == lambda_settings.db_path
-            calls.append("download")
-            if fail_download:
-                raise botocore.exceptions.ClientError({}, "")
-
-        def upload_file(self, Bucket: str, Key: str, Filename: str):
-            assert Bucket == lambda_settings.s3_bucket
-            assert Key == lambda_settings.s3_key
-            assert Filename == lambda_settings.db_path
-            calls.append("upload")
-
-    def main(settings: Settings):
-        calls.append("main")
-
-    monkeypatch.setattr(boto3, "client", MyClient)
     monkeypatch.setattr(flow.main, "main", main)
+    monkeypatch.setenv("_X_AMZN_TRACE_ID", "Root=1-00000000-000000000000000000000001")
+    lambda_handler(None, None)
+    # Lambda sets new trace id for every invocation
+    monkeypatch.setenv("_X_AMZN_TRACE_ID", "Root=1-00000000-000000000000000000000002")
+    lambda_handler(None, None)
+    assert resources[0] == resources[1]
+
+    monkeypatch.setenv("PUBLISH_LIMIT", "2")
+    lambda_handler(None, None)
+    context = resources[2][0]
+    assert context is not resources[0][0]
+    assert context.settings.publish_limit == 2
+    assert resources[0][0]._storage is None
 
-    lambda_handler(None, None)  # type: ignore
-    assert calls == ["init", "download", "main", "upload"]
+
+def test_lambda_handler_reopens_storage_on_download(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+    tmpdir: py.path.local,
+):
+    last_ids: list[int | None] = []
+
+    def main(settings: Settings, deadline: float | None, stage: str, context: Any):
+        storage = context.storage
+        last_ids.append(storage.get_last_post_id(owner_id=1, chat_ids=[2]))
+        storage.add_post(owner_id=1, chat_id=2, id=len(last_ids))
+
+    monkeypatch.setattr(flow.main, "main", main)
+    lambda_handler(None, None)
+
+    # Newer snapshot uploaded by another container
+    other_path = os.path.join(tmpdir, "other.db")
+    with SQLiteStorage(other_path) as storage:
+        storage.add_post(owner_id=1, chat_id=2, id=10)
+    with open(other_path, "rb") as f:
+        s3.put_object(
+            Bucket=lambda_settings.s3_bucket, Key=lambda_settings.s3_key, Body=f.read()
+        )
+    lambda_handler(None, None)
+    assert last_ids == [None, 10]
+
+
+def _make_outbox_item(post_id: int):
+    return OutboxItem(
+        owner_id=1, chat_id=2, post_id=post_id, date=datetime.now(), steps=[]
+    )
+
+
+def _put_db(s3: Any, settings: LambdaSettings, path: str):
+    with open(path, "rb") as f:
+        s3.put_object(Bucket=settings.s3_bucket, Key=settings.s3_key, Body=f.read())
+
+
+def test_lambda_handler_merges_concurrent_upload(
+    monkeypatch: pytest.MonkeyPatch,
+    lambda_settings: LambdaSettings,
+    s3: Any,
+    s3_calls: list[str],
+    tmpdir: py.path.local,
+):
+    other_path = os.path.join(tmpdir, "other.db")
+    with SQLiteStorage(other_path) as storage:
+        storage.enqueue_posts([_make_outbox_item(5)])
+    _put_db(s3, lambda_settings, other_path)
+
+    def main(settings: Settings, deadline: float | None, stage: str, context: Any):
+        # Publish stage finishes while fetch is running
+        with SQLiteStorage(other_path) as storage:
+            storage.remove_outbox_item(_make_outbox_item(5))
+        _put_db(s3, lambda_settings, other_path)
+        context.storage.enqueue_posts([_make_outbox_item(6)])
+
+    monkeypatch.setattr(flow.main, "main", main)
+    flow.main.fetch_lambda_handler(None, None)
+    assert s3_calls == ["GetObject", "PutObject", "GetObject", "PutObject"]
+
+    result_path = os.path.join(tmpdir, "result.db")
+    with open(result_path, "wb") as f:
+        f.write(_get_object(s3, lambda_settings))
+    with SQLiteStorage(result_path) as storage:
+        assert [item.post_id for item in storage.get_outbox()] == [6]
+        assert storage.posts_in_db(owner_id=1, chat_id=2, ids=[5, 6]) == {5, 6}
+    with SQLiteStorage(lambda_settings.db_path) as storage:
+        assert [item.post_id for item in storage.get_outbox()] == [6]
+
+
+def test_heavy_modules_imported_lazily():
+    code = "import sys, flow.main; print(' '.join(sys.modules))"
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    modules = {name.split(".")[0] for name in output.split()}
+    heavy = {
+        "boto3",
+        "botocore",
+        "sentry_sdk",
+        "sqlalchemy",
+        "sqlmodel",
+        "PIL",
+        "httpx",
+        "zstandard",
+    }
+    assert not modules & heavy
+
+
+def test_lambda_handler_with_sentry(
+    monkeypatch: pytest.MonkeyPatch, lambda_settings: LambdaSettings, s3: Any
+):
+    init = Mock()
+    monkeypatch.setattr(sentry_sdk, "init", init)
+    monkeypatch.setenv("SENTRY_DSN", "mydsn")
+    _mock_main(monkeypatch, b"db")
+    lambda_handler(None, None)
+    assert init.call_args[0][0] == "mydsn"
+    assert init.call_args.kwargs["traces_sample_rate"] == 1.0
+    assert _get_object(s3, lambda_settings) == b"db"
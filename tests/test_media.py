@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import os
+from pathlib import Path
+from typing import Any
+
+import httpx
+import pytest
+
+from flow.media import PhotoProcessor, recompress
+from flow.tg import AsyncBot
+
+Image: Any = pytest.importorskip("PIL.Image")
+
+
+def _make_image(size: tuple[int, int], format: str = "PNG", mode: str = "RGB"):
+    buffer = io.BytesIO()
+    # Noise doesn't compress, so output size depends on quality and sides
+    Image.frombytes(mode, size, os.urandom(size[0] * size[1] * len(mode))).save(
+        buffer, format
+    )
+    return buffer.getvalue()
+
+
+def _open(data: bytes):
+    return Image.open(io.BytesIO(data))
+
+
+def test_recompress_downscales():
+    data = recompress(
+        _make_image((1000, 500)), max_side=200, max_bytes=10 * 1024 * 1024
+    )
+    with _open(data) as image:
+        assert image.format == "JPEG"
+        assert image.size == (200, 100)
+
+
+def test_recompress_keeps_small_jpeg():
+    source = _make_image((100, 100), "JPEG")
+    assert recompress(source, max_side=200, max_bytes=len(source)) is source
+
+
+def test_recompress_converts_mode():
+    data = recompress(
+        _make_image((100, 100), mode="RGBA"), max_side=200, max_bytes=1024 * 1024
+    )
+    with _open(data) as image:
+        assert image.mode == "RGB"
+        assert image.size == (100, 100)
+
+
+def test_recompress_fits_max_bytes():
+    source = _make_image((1000, 1000), "JPEG")
+    data = recompress(source, max_side=1000, max_bytes=len(source) // 4)
+    assert len(data) <= len(source) // 4
+    with _open(data) as image:
+        assert max(image.size) < 1000
+
+
+@pytest.fixture
+def processor(tmp_path: Path):
+    with PhotoProcessor(
+        max_side=200, max_bytes=1024 * 1024, cache_dir=str(tmp_path), max_workers=1
+    ) as processor:
+        yield processor
+
+
+def test_photo_processor_caches_output(processor: PhotoProcessor):
+    downloads: list[str] = []
+
+    async def download():
+        downloads.append("download")
+        return _make_image((400, 400))
+
+    async def run():
+        first = await processor.get("https://example.com/1.jpg", download)
+        second = await processor.get("https://example.com/1.jpg", download)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second
+    assert downloads == ["download"]
+    with _open(first) as image:
+        assert image.size == (200, 200)
+
+
+def test_photo_processor_cache_key_includes_limits(
+    processor: PhotoProcessor, tmp_path: Path
+):
+    other = PhotoProcessor(max_side=100, max_bytes=1024, cache_dir=str(tmp_path))
+    other.close()
+    assert other._cache_path("url") != processor._cache_path("url")
+
+
+def test_photo_processor_prunes_cache(tmp_path: Path):
+    old, new = tmp_path / "old.jpg", tmp_path / "new.jpg"
+    old.write_bytes(b"")
+    new.write_bytes(b"")
+    os.utime(old, (0, 0))
+    PhotoProcessor(max_side=100, max_bytes=1024, cache_dir=str(tmp_path)).close()
+    assert not old.exists()
+    assert new.exists()
+
+
+def test_async_bot_uploads_recompressed(processor: PhotoProcessor):
+    uploaded: list[bytes] = []
+
+    def handler(request: httpx.Request):
+        if request.url.host == "example.com":
+            return httpx.Response(200, content=_make_image((1000, 1000)))
+        uploaded.append(request.read())
+        return httpx.Response(200, json={"ok": True, "result": []})
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            bot = AsyncBot(
+                "tg_token", client=client, upload_photos=True, media=processor
+            )
+            await bot.send_photos(
+                chat_id=1, photo_urls=["https://example.com/1.png"]  # type: ignore
+            )
+
+    asyncio.run(run())
+    (content,) = uploaded
+    assert b"image/jpeg" in content
+    assert len(content) < 200 * 1024
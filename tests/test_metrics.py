@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import json
+from unittest.mock import Mock
+
+import pytest
+import sentry_sdk
+
+from flow import metrics
+from flow.metrics import Metrics, collect_metrics
+
+
+def test_noop_outside_collect():
+    metrics.incr("posts.published")
+    with metrics.span("vk.request"):
+        pass
+
+
+def test_collect_metrics(capsys: pytest.CaptureFixture[str]):
+    with collect_metrics(emit=True) as collected:
+        metrics.incr("posts.published")
+        metrics.incr("posts.published", 2)
+        metrics.incr("vk.bytes_received", 100, unit="Bytes")
+        with metrics.span("vk.request"):
+            pass
+        with metrics.span("vk.request"):
+            pass
+
+    assert collected.values["posts.published"] == 3
+    assert collected.values["vk.bytes_received"] == 100
+    line = json.loads(capsys.readouterr().out)
+    assert line["posts.published"] == 3
+    assert line["Service"] == "flow"
+    assert line["vk.request"] >= 0
+    assert line["run"] >= line["vk.request"]
+    directive = line["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == "flow"
+    assert directive["Dimensions"] == [["Service"]]
+    assert {m["Name"]: m["Unit"] for m in directive["Metrics"]} == {
+        "posts.published": "Count",
+        "vk.bytes_received": "Bytes",
+        "vk.request": "Milliseconds",
+        "run": "Milliseconds",
+    }
+
+
+def test_collect_metrics_not_emitted(capsys: pytest.CaptureFixture[str]):
+    with collect_metrics():
+        metrics.incr("posts.published")
+    assert capsys.readouterr().out == ""
+
+
+def test_collect_metrics_nested(capsys: pytest.CaptureFixture[str]):
+    with collect_metrics(emit=True) as outer:
+        with collect_metrics(emit=True) as inner:
+            metrics.incr("posts.published")
+        assert inner is outer
+    assert len(capsys.readouterr().out.splitlines()) == 1
+    assert outer.values["posts.published"] == 1
+
+
+def test_collect_metrics_in_tasks():
+    async def publish():
+        metrics.incr("posts.published")
+
+    async def main():
+        await asyncio.gather(publish(), publish())
+
+    with collect_metrics() as collected:
+        asyncio.run(main())
+    assert collected.values["posts.published"] == 2
+
+
+def test_collect_metrics_emitted_on_error(capsys: pytest.CaptureFixture[str]):
+    with pytest.raises(RuntimeError):
+        with collect_metrics(emit=True):
+            metrics.incr("posts.published")
+            raise RuntimeError
+    assert json.loads(capsys.readouterr().out)["posts.published"] == 1
+
+
+@pytest.mark.parametrize(("fail", "status"), ((False, "ok"), (True, "internal_error")))
+def test_collect_metrics_sentry(
+    monkeypatch: pytest.MonkeyPatch, fail: bool, status: str
+):
+    transaction = Mock()
+    monkeypatch.setattr(sentry_sdk, "start_transaction", Mock(return_value=transaction))
+
+    with pytest.raises(RuntimeError) if fail else contextlib.nullcontext():
+        with collect_metrics(sentry=True):
+            with metrics.span("vk.request"):
+                pass
+            if fail:
+                raise RuntimeError
+
+    ops = [call.kwargs["op"] for call in transaction.start_child.call_args_list]
+    assert ops == ["run", "vk.request"]
+    transaction.set_status.assert_called_once_with(status)
+    transaction.finish.assert_called_once()
+
+
+def test_metrics_without_sentry_doesnt_import_it(monkeypatch: pytest.MonkeyPatch):
+    start_transaction = Mock()
+    monkeypatch.setattr(sentry_sdk, "start_transaction", start_transaction)
+    Metrics().finish()
+    start_transaction.assert_not_called()
@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import gzip
+import io
+import os
+
+import pytest
+
+from flow.snapshot import Compression, compress_file, decompress_chunks
+
+
+def _chunks(data: bytes, size: int):
+    return [data[idx : idx + size] for idx in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("compression", ("none", "gzip", "zstd"))
+@pytest.mark.parametrize("chunk_size", (1, 1024))
+def test_roundtrip(compression: Compression, chunk_size: int):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    data = os.urandom(1000) + b"\0" * 100_000
+    dst = io.BytesIO()
+    compress_file(io.BytesIO(data), dst, compression)
+    if compression != "none":
+        assert len(dst.getvalue()) < len(data)
+
+    res = io.BytesIO()
+    decompress_chunks(_chunks(dst.getvalue(), chunk_size), res)
+    assert res.getvalue() == data
+
+
+def test_gzip_compatible():
+    dst = io.BytesIO()
+    compress_file(io.BytesIO(b"data"), dst, "gzip")
+    assert gzip.decompress(dst.getvalue()) == b"data"
+
+
+@pytest.mark.parametrize("data", (b"", b"a", b"SQLite format 3\x00"))
+def test_raw_snapshot(data: bytes):
+    # Written by older versions
+    res = io.BytesIO()
+    decompress_chunks(_chunks(data, 1), res)
+    assert res.getvalue() == data
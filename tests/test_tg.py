@@ -1,14 +1,35 @@
-from copy import copy, deepcopy
+from __future__ import annotations
+
+import asyncio
+import json
+from collections.abc import Awaitable, Callable
+from copy import deepcopy
 from datetime import datetime
 from types import SimpleNamespace
-from typing import Any
+from typing import Any, TypeVar
 
+import httpx
 import pytest
 from base_telegram_bot import TelegramBotError
 
 import flow.tg
-from flow.models import Post
-from flow.tg import Bot, _format_internal_vk_links, _strip_html_tags, publish_post
+from flow.models import OutboxItem, Post
+from flow.tg import (
+    AsyncBot,
+    Bot,
+    MessageStep,
+    PhotosStep,
+    PhotoTooLargeError,
+    PublishStep,
+    RateLimiter,
+    TokenBucket,
+    _render_message,
+    fingerprint_post,
+    plan_post,
+    publish_item_async,
+    publish_post,
+    publish_post_async,
+)
 
 
 @pytest.mark.parametrize(
@@ -24,21 +45,50 @@ from flow.tg import Bot, _format_internal_vk_links, _strip_html_tags, publish_po
             '<a href="https://vk.com/id1">Pavel Durov</a>',
         ),
         ("https://vk.com/id1 — Pavel Durov", "https://vk.com/id1 — Pavel Durov"),
-    ),
-)
-def test_format_internal_vk_links(v: str, expected: str):
-    assert _format_internal_vk_links(v) == expected
-
-
-@pytest.mark.parametrize(
-    ("v", "expected"),
-    (
         ("Some text here <...> woah! <html> </html>", "Some text here woah!"),
         ("Just text", "Just text"),
+        ("Line\n\nbreaks  and\tspaces", "Line breaks and spaces"),
+        (
+            "a &amp; b < c [id1|P&D]",
+            'a &amp; b &lt; c <a href="https://vk.com/id1">P&amp;D</a>',
+        ),
+        ("x[id1|y]z", 'x<a href="https://vk.com/id1">y</a>z'),
     ),
 )
-def test_strip_html_tags(v: str, expected: str):
-    assert _strip_html_tags(v) == expected
+def test_render_message(v: str, expected: str):
+    assert _render_message(v) == [expected]
+
+
+def test_render_message_empty():
+    assert _render_message("<b></b>  ") == []
+
+
+def test_render_message_breaks_at_spaces():
+    assert _render_message("aa bb cc dd", limit=5) == ["aa bb", "cc dd"]
+
+
+def test_render_message_long_word():
+    assert _render_message("a abcdefghij b", limit=4) == ["a", "abcd", "efgh", "ij b"]
+
+
+def test_render_message_never_splits_link():
+    link = '<a href="https://vk.com/id1">Pavel Durov</a>'
+    assert _render_message("a [id1|Pavel Durov] b", limit=len(link) + 1) == [
+        "a",
+        link,
+        "b",
+    ]
+
+
+def test_render_message_never_splits_entity():
+    assert _render_message("&&&", limit=6) == ["&amp;", "&amp;", "&amp;"]
+
+
+def test_render_message_counts_rendered_length():
+    text = " ".join(["[id1|x]"] * 200)
+    chunks = _render_message(text, limit=1000)
+    assert all(len(chunk) <= 1000 for chunk in chunks)
+    assert " ".join(chunks) == " ".join(['<a href="https://vk.com/id1">x</a>'] * 200)
 
 
 @pytest.fixture
@@ -46,113 +96,530 @@ def bot():
     return Bot("tg_token")
 
 
-def test_bot_send_message(monkeypatch: pytest.MonkeyPatch, bot: Bot):
-    count = 0
+def test_bot_send_message(bot: Bot):
+    texts: list[str] = []
 
     def make_request(method: str, json: Any = None, model: Any = None) -> Any:
         assert method == "/sendMessage"
         assert json["parse_mode"] == "HTML"
         assert json["chat_id"] == 1
+        texts.append(json["text"])
 
-        nonlocal count
-        if count == 0:
-            assert len(json["text"]) == 4096
-        else:
-            assert len(json["text"]) == 1
-        count += 1
-
-    called_strip = False
-    called_format = False
-
-    def mock_strip_html_tags(text: str):
-        nonlocal called_strip
-        called_strip = True
-        return text
-
-    def mock_format_internal_vk_links(text: str):
-        nonlocal called_format
-        called_format = True
-        return text
-
-    monkeypatch.setattr(flow.tg, "_strip_html_tags", mock_strip_html_tags)
-    monkeypatch.setattr(
-        flow.tg, "_format_internal_vk_links", mock_format_internal_vk_links
+    bot.make_request = make_request
+    bot.send_message(chat_id=1, text="<p>" + "t" * 4097 + "</p>")
+    assert [len(text) for text in texts] == [4096, 1]
+
+
+def _make_post(text: str | None, photo_count: int):
+    return Post(
+        id=25,
+        text=text,
+        photos=[f"https://example.com/{idx}.jpg" for idx in range(photo_count)],  # type: ignore
+        date=datetime.now(),
     )
 
-    bot.make_request = make_request
-    bot.send_message(chat_id=1, text="t" * 4097)
-    assert called_strip
-    assert called_format
 
+def _urls(*idxs: int):
+    return [f"https://example.com/{idx}.jpg" for idx in idxs]
 
-def test_bot_send_media_group_200_ok(bot: Bot):
-    photo_urls = ["https://example.com/image1.jpg", "https://example.com/image2.jpg"]
+
+def test_fingerprint_post():
+    post = _make_post("Some  <b>Text</b>", 2)
+    same = post.copy(
+        update={
+            "id": 26,
+            "text": "some text",
+            "photos": [
+                f"https://cdn.example.com/{idx}.jpg?sign=abc" for idx in range(2)
+            ],
+        }
+    )
+    fingerprint = fingerprint_post(post)
+    assert fingerprint is not None
+    assert -(2**63) <= fingerprint < 2**63
+    assert fingerprint_post(same) == fingerprint
+    assert fingerprint_post(_make_post("Some text", 1)) != fingerprint
+    assert fingerprint_post(_make_post("Other text", 2)) != fingerprint
+    assert fingerprint_post(_make_post(None, 0)) is None
+
+
+def test_plan_post_text_only():
+    assert plan_post(_make_post("a" * 4097, 0)) == [
+        MessageStep(text="a" * 4096),
+        MessageStep(text="a"),
+    ]
+
+
+def test_plan_post_caption():
+    assert plan_post(_make_post("my & text", 2)) == [
+        PhotosStep(photo_urls=_urls(0, 1), caption="my &amp; text")  # type: ignore
+    ]
+
+
+def test_plan_post_text_too_long_for_caption():
+    assert plan_post(_make_post("a" * 1025, 1)) == [
+        MessageStep(text="a" * 1025),
+        PhotosStep(photo_urls=_urls(0), caption=None),  # type: ignore
+    ]
+
+
+def test_plan_post_split_albums():
+    assert plan_post(_make_post(None, 21)) == [
+        PhotosStep(photo_urls=_urls(*range(10)), caption=None),  # type: ignore
+        PhotosStep(photo_urls=_urls(*range(10, 20)), caption=None),  # type: ignore
+        PhotosStep(photo_urls=_urls(20), caption=None),  # type: ignore
+    ]
+
+
+def test_plan_post_caption_goes_to_first_album():
+    steps = plan_post(_make_post("text", 11))
+    assert [step.caption for step in steps] == ["text", None]  # type: ignore
+
+
+def test_plan_post_empty():
+    assert plan_post(_make_post("", 0)) == []
+
+
+def test_bot_send_photos_group(bot: Bot):
+    photo_urls = _urls(1, 2)
 
     def make_request(method: str, json: Any = None, model: Any = None) -> Any:
         assert method == "/sendMediaGroup"
         assert json["chat_id"] == 1
-        assert json["media"] == [{"type": "photo", "media": url} for url in photo_urls]
+        assert json["media"] == [
+            {
+                "type": "photo",
+                "media": photo_urls[0],
+                "caption": "text",
+                "parse_mode": "HTML",
+            },
+            {"type": "photo", "media": photo_urls[1]},
+        ]
 
     bot.make_request = make_request
-    bot.send_photo_group(chat_id=1, photo_urls=deepcopy(photo_urls))  # type: ignore
+    bot.send_photos(chat_id=1, photo_urls=deepcopy(photo_urls), caption="text")  # type: ignore
 
 
-@pytest.mark.parametrize("return_on", (1, 2, 3, 4))
-def test_bot_send_media_group_400_ok(bot: Bot, return_on: int):
-    count = 0
-
+def test_bot_send_photos_single(bot: Bot):
     def make_request(method: str, json: Any = None, model: Any = None) -> Any:
-        nonlocal count
-        count += 1
+        assert method == "/sendPhoto"
+        assert json == {"chat_id": 1, "photo": "https://example.com/1.jpg"}
+
+    bot.make_request = make_request
+    bot.send_photos(chat_id=1, photo_urls=_urls(1))  # type: ignore
+
 
-        if count == return_on:
-            return
+@pytest.mark.parametrize("upload_photos", (True, False))
+def test_bot_send_photos_400_uploads(bot: Bot, upload_photos: bool):
+    urls = _urls(1, 2)
+    calls: list[str] = []
+
+    def make_request(method: str, json: Any = None, model: Any = None) -> Any:
+        calls.append("url")
         raise TelegramBotError(response=SimpleNamespace(status_code=400))  # type: ignore
 
-    bot.make_request = make_request
-    bot.send_photo_group(chat_id=1, photo_urls=[])
+    def send_uploaded_photos(
+        *, chat_id: int, photo_urls: list[str], caption: str | None
+    ):
+        assert chat_id == 1
+        assert photo_urls == urls
+        assert caption == "text"
+        calls.append("upload")
 
-    if return_on == 4:
-        assert count == 3
-    else:
-        assert count == return_on
+    bot.upload_photos = upload_photos
+    bot.make_request = make_request
+    bot.send_uploaded_photos = send_uploaded_photos  # type: ignore
+    bot.send_photos(chat_id=1, photo_urls=urls, caption="text")  # type: ignore
+    assert calls == (["upload"] if upload_photos else ["url", "upload"])
 
 
-def test_bot_send_media_group_400_not_ok(bot: Bot):
+def test_bot_send_photos_not_400(bot: Bot):
     def make_request(method: str, json: Any = None, model: Any = None) -> Any:
         raise TelegramBotError(response=SimpleNamespace(status_code=401))  # type: ignore
 
     bot.make_request = make_request
     with pytest.raises(TelegramBotError):
-        bot.send_photo_group(chat_id=1, photo_urls=[])
+        bot.send_photos(chat_id=1, photo_urls=_urls(1))  # type: ignore
 
 
-def test_publish_post(monkeypatch: pytest.MonkeyPatch):
-    exp_token = "my_token"
-    exp_text = "my_text"
-    exp_photo_urls = [
-        "https://example.com/image1.jpg",
-        "https://example.com/image2.jpg",
+@pytest.mark.parametrize(
+    ("urls", "method", "exp_data", "exp_files"),
+    (
+        (
+            _urls(1, 3, 2),
+            "/sendMediaGroup",
+            {
+                "chat_id": "1",
+                "media": json.dumps(
+                    [
+                        {
+                            "type": "photo",
+                            "media": "attach://photo0",
+                            "caption": "text",
+                            "parse_mode": "HTML",
+                        },
+                        {"type": "photo", "media": "attach://photo2"},
+                    ]
+                ),
+            },
+            {
+                "photo0": ("photo0.jpg", b"https://example.com/1.jpg", "image/jpeg"),
+                "photo2": ("photo2.jpg", b"https://example.com/2.jpg", "image/jpeg"),
+            },
+        ),
+        (
+            _urls(3, 1),
+            "/sendPhoto",
+            {"chat_id": "1", "caption": "text", "parse_mode": "HTML"},
+            {"photo": ("photo1.jpg", b"https://example.com/1.jpg", "image/jpeg")},
+        ),
+    ),
+)
+def test_bot_send_uploaded_photos(
+    monkeypatch: pytest.MonkeyPatch,
+    bot: Bot,
+    urls: list[str],
+    method: str,
+    exp_data: Any,
+    exp_files: Any,
+):
+    def download_photo(session: Any, url: str, *, max_bytes: int):
+        if url.endswith("3.jpg"):
+            raise PhotoTooLargeError
+        return url.encode()
+
+    def post(url: str, data: Any, files: Any):
+        assert url == f"https://api.telegram.org/bottg_token{method}"
+        assert data == exp_data
+        assert files == exp_files
+        return "response"
+
+    def parse_response(*, response: Any):
+        assert response == "response"
+
+    monkeypatch.setattr(flow.tg, "_download_photo", download_photo)
+    monkeypatch.setattr(bot._session, "post", post)
+    bot.parse_response = parse_response  # type: ignore
+    bot.send_uploaded_photos(chat_id=1, photo_urls=urls, caption="text")  # type: ignore
+
+
+def test_bot_send_uploaded_photos_all_skipped(
+    monkeypatch: pytest.MonkeyPatch, bot: Bot
+):
+    requests: list[tuple[str, Any]] = []
+
+    def download_photo(session: Any, url: str, *, max_bytes: int):
+        raise PhotoTooLargeError
+
+    def make_request(*, method: str, json: Any):
+        requests.append((method, json))
+
+    monkeypatch.setattr(flow.tg, "_download_photo", download_photo)
+    bot.make_request = make_request  # type: ignore
+    bot.send_uploaded_photos(chat_id=1, photo_urls=_urls(1), caption="text")  # type: ignore
+    bot.send_uploaded_photos(chat_id=1, photo_urls=_urls(1))  # type: ignore
+    assert requests == [
+        ("/sendMessage", {"chat_id": 1, "text": "text", "parse_mode": "HTML"})
     ]
 
+
+def test_publish_post(monkeypatch: pytest.MonkeyPatch):
+    post = _make_post("my_text", 1)
+    steps: list[Any] = []
+
     class CustomBot:
         def __init__(self, token: str) -> None:
-            assert token == exp_token
+            assert token == "my_token"
 
-        def send_message(self, chat_id: int, text: str):
+        def execute(self, *, chat_id: int, step: PublishStep):
             assert chat_id == 1
-            assert text == exp_text
+            steps.append(step)
+
+    monkeypatch.setattr(flow.tg, "Bot", CustomBot)
+    flow.tg._get_bot.cache_clear()
+    publish_post(token="my_token", chat_id=1, post=post)
+    assert steps == plan_post(post)
+    flow.tg._get_bot.cache_clear()
 
-        def send_photo_group(self, chat_id: int, photo_urls: list[str]):
-            assert chat_id == 1
-            assert photo_urls == exp_photo_urls
+
+def test_publish_post_reuses_bot(monkeypatch: pytest.MonkeyPatch):
+    bots: list[Any] = []
+
+    class CustomBot:
+        def __init__(self, token: str) -> None:
+            bots.append(self)
+
+        def execute(self, *, chat_id: int, step: PublishStep):
+            pass
 
     monkeypatch.setattr(flow.tg, "Bot", CustomBot)
+    flow.tg._get_bot.cache_clear()
+    publish_post(token="my_token", chat_id=1, post=_make_post("first", 1))
+    publish_post(token="my_token", chat_id=1, post=_make_post("second", 2))
+    assert len(bots) == 1
+    flow.tg._get_bot.cache_clear()
 
-    post = Post(
-        id=25,
-        text=copy(exp_text),
-        photos=deepcopy(exp_photo_urls),  # type: ignore
-        date=datetime.now(),
+
+T = TypeVar("T")
+
+
+def _run_with_client(
+    handler: Any, coro_factory: Callable[[httpx.AsyncClient], Awaitable[T]]
+) -> T:
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await coro_factory(client)
+
+    return asyncio.run(run())
+
+
+def test_async_bot_make_request():
+    def handler(request: httpx.Request):
+        assert request.url == "https://api.telegram.org/bottg_token/sendMessage"
+        assert json.loads(request.content) == {"chat_id": 1}
+        return httpx.Response(200, json={"ok": True, "result": {"message_id": 1}})
+
+    result = _run_with_client(
+        handler,
+        lambda client: AsyncBot("tg_token", client=client).make_request(
+            method="/sendMessage", json={"chat_id": 1}
+        ),
+    )
+    assert result == {"message_id": 1}
+
+
+def test_async_bot_make_request_error():
+    def handler(request: httpx.Request):
+        return httpx.Response(
+            400, json={"ok": False, "description": "Bad Request: chat not found"}
+        )
+
+    with pytest.raises(TelegramBotError, match="chat not found") as exc_info:
+        _run_with_client(
+            handler,
+            lambda client: AsyncBot("tg_token", client=client).make_request(
+                method="/sendMessage"
+            ),
+        )
+    assert exc_info.value.response.status_code == 400
+
+
+def test_async_bot_send_photos_400_uploads():
+    requests: list[str] = []
+
+    def handler(request: httpx.Request):
+        requests.append(f"{request.method} {request.url}")
+        if request.url.host == "example.com":
+            if request.url.path == "/big.jpg":
+                return httpx.Response(200, content=b"x" * 11)
+            return httpx.Response(200, content=request.url.path.encode())
+        if request.headers["content-type"] == "application/json":
+            return httpx.Response(400, json={"ok": False, "description": "Bad Request"})
+
+        assert request.headers["content-type"].startswith("multipart/form-data")
+        content = request.read()
+        assert b'name="photo"' in content
+        assert b"/1.jpg" in content
+        return httpx.Response(200, json={"ok": True, "result": []})
+
+    _run_with_client(
+        handler,
+        lambda client: AsyncBot(
+            "tg_token", client=client, max_photo_bytes=10
+        ).send_photos(
+            chat_id=1,
+            photo_urls=[
+                "https://example.com/1.jpg",
+                "https://example.com/big.jpg",
+            ],  # type: ignore
+        ),
+    )
+    assert requests[0] == "POST https://api.telegram.org/bottg_token/sendMediaGroup"
+    assert sorted(requests[1:3]) == [
+        "GET https://example.com/1.jpg",
+        "GET https://example.com/big.jpg",
+    ]
+    assert requests[3] == "POST https://api.telegram.org/bottg_token/sendPhoto"
+
+
+def test_async_bot_send_uploaded_photos_download_error():
+    def handler(request: httpx.Request):
+        return httpx.Response(404)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        _run_with_client(
+            handler,
+            lambda client: AsyncBot("tg_token", client=client).send_uploaded_photos(
+                chat_id=1, photo_urls=_urls(1)  # type: ignore
+            ),
+        )
+
+
+def test_async_bot_send_uploaded_photos_all_skipped():
+    requests: list[tuple[str, Any]] = []
+
+    def handler(request: httpx.Request):
+        if request.url.host == "example.com":
+            return httpx.Response(200, content=b"x" * 11)
+        requests.append((request.url.path, json.loads(request.content)))
+        return httpx.Response(200, json={"ok": True, "result": {}})
+
+    _run_with_client(
+        handler,
+        lambda client: AsyncBot(
+            "tg_token", client=client, max_photo_bytes=10
+        ).send_uploaded_photos(
+            chat_id=1, photo_urls=_urls(2), caption="text"  # type: ignore
+        ),
+    )
+    assert requests == [
+        (
+            "/bottg_token/sendMessage",
+            {"chat_id": 1, "text": "text", "parse_mode": "HTML"},
+        )
+    ]
+
+
+def test_publish_post_async():
+    requests: list[tuple[str, Any]] = []
+
+    def handler(request: httpx.Request):
+        requests.append((request.url.path, json.loads(request.content)))
+        return httpx.Response(200, json={"ok": True, "result": {}})
+
+    _run_with_client(
+        handler,
+        lambda client: publish_post_async(
+            bot=AsyncBot("tg_token", client=client),
+            chat_id=1,
+            post=_make_post("my_text", 1),
+        ),
     )
-    publish_post(token=copy(exp_token), chat_id=1, post=post)
+    assert requests == [
+        (
+            "/bottg_token/sendPhoto",
+            {
+                "chat_id": 1,
+                "photo": "https://example.com/0.jpg",
+                "caption": "my_text",
+                "parse_mode": "HTML",
+            },
+        ),
+    ]
+
+
+def test_publish_item_async_continues_after_sent_steps():
+    requests: list[tuple[str, Any]] = []
+
+    def handler(request: httpx.Request):
+        requests.append((request.url.path, json.loads(request.content)))
+        return httpx.Response(200, json={"ok": True, "result": {}})
+
+    post = _make_post("my_text " * 200, 1)
+    item = OutboxItem(
+        owner_id=1,
+        chat_id=2,
+        post_id=post.id,
+        date=post.date,
+        steps=[step.dict() for step in plan_post(post)],
+        sent_steps=1,
+    )
+    _run_with_client(
+        handler,
+        lambda client: publish_item_async(
+            bot=AsyncBot("tg_token", client=client), item=item
+        ),
+    )
+    # Message was sent before, so only photo is left
+    assert requests == [
+        (
+            "/bottg_token/sendPhoto",
+            {"chat_id": 2, "photo": "https://example.com/0.jpg"},
+        ),
+    ]
+    assert item.sent_steps == 2
+
+
+def test_token_bucket(monkeypatch: pytest.MonkeyPatch):
+    now = 0.0
+    monkeypatch.setattr(flow.tg.time, "monotonic", lambda: now)
+    bucket = TokenBucket(2, capacity=2)
+    assert [bucket.reserve() for _ in range(4)] == [0, 0, 0.5, 1]
+    now = 1.0
+    assert bucket.reserve() == 0.5
+    now = 10.0
+    bucket.pause(3)
+    assert bucket.reserve() == 3
+
+
+def test_rate_limiter(monkeypatch: pytest.MonkeyPatch):
+    waits: list[float] = []
+
+    async def sleep(seconds: float):
+        waits.append(seconds)
+
+    monkeypatch.setattr(flow.tg.time, "monotonic", lambda: 0.0)
+    monkeypatch.setattr(flow.tg.asyncio, "sleep", sleep)
+    limiter = RateLimiter(rate=10, chat_rate=1)
+
+    async def run():
+        for chat_id in (1, 1, 2, None):
+            await limiter.acquire(chat_id)
+        limiter.pause(2, 5)
+        await limiter.acquire(2)
+
+    asyncio.run(run())
+    # Second request to chat 1 waits for the chat, the rest fit global burst
+    assert waits == [1, 5]
+
+
+def _flood_handler(requests: list[Any], retry_after: int, failures: int = 1):
+    def handler(request: httpx.Request):
+        requests.append(json.loads(request.content))
+        if len(requests) <= failures:
+            return httpx.Response(
+                429,
+                json={
+                    "ok": False,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": retry_after},
+                },
+            )
+        return httpx.Response(200, json={"ok": True, "result": {"message_id": 1}})
+
+    return handler
+
+
+def test_async_bot_retries_after_429(monkeypatch: pytest.MonkeyPatch):
+    waits: list[float] = []
+
+    async def sleep(seconds: float):
+        waits.append(seconds)
+
+    monkeypatch.setattr(flow.tg.asyncio, "sleep", sleep)
+    requests: list[Any] = []
+    result = _run_with_client(
+        _flood_handler(requests, retry_after=3),
+        lambda client: AsyncBot("tg_token", client=client).make_request(
+            method="/sendMessage", json={"chat_id": 1}
+        ),
+    )
+    assert result == {"message_id": 1}
+    assert requests == [{"chat_id": 1}, {"chat_id": 1}]
+    assert waits == [3]
+
+
+@pytest.mark.parametrize(
+    ("retry_after", "failures"), ((flow.tg.MAX_RETRY_AFTER + 1, 1), (0, 10))
+)
+def test_async_bot_gives_up_after_429(retry_after: int, failures: int):
+    requests: list[Any] = []
+    with pytest.raises(TelegramBotError, match="Too Many Requests") as exc_info:
+        _run_with_client(
+            _flood_handler(requests, retry_after=retry_after, failures=failures),
+            lambda client: AsyncBot(
+                "tg_token", client=client, max_retries=2
+            ).make_request(method="/sendMessage", json={"chat_id": 1}),
+        )
+    assert exc_info.value.response.status_code == 429
+    assert len(requests) == (1 if retry_after else 3)
@@ -1,20 +1,36 @@
-from datetime import datetime, timedelta
-from typing import Any
+from __future__ import annotations
 
+import asyncio
+import json
+import re
+from collections.abc import Awaitable, Callable, Mapping
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+from typing import Any, Literal, TypeVar
+
+import httpx
 import pytest
+from base_vk_api import VKAPIError
 
 import flow.vk
-from flow.models import Post
+from flow.models import PhotoSizePolicy, Post
 from flow.vk import (
     VKAPI,
+    AsyncVKAPI,
     WallGetResponse,
     WallItem,
     WallItemAttachment,
     WallItemAttachmentPhoto,
     WallItemAttachmentPhotoSize,
+    _build_wall_execute_code,
     _get_photo_with_highest_quality,
+    _has_new_posts,
+    _load_response,
     _parse_wall,
+    _WallCollector,
     get_wall,
+    get_wall_async,
+    get_walls_async,
 )
 
 
@@ -24,7 +40,7 @@ def test_vk_get_wall(monkeypatch: pytest.MonkeyPatch):
             self, *, method: str, params: dict[str, Any], model: Any = None
         ):
             assert method == "wall.get"
-            assert params == {"owner_id": 1}
+            assert params == {"owner_id": 1, "offset": 0, "count": 20}
             assert model is WallGetResponse
             return {"foo": "bar"}
 
@@ -50,6 +66,54 @@ def test_get_photo_with_highest_quality():
     assert _get_photo_with_highest_quality(photo) == "https://example.com/2"
 
 
+def _make_photo(*sizes: tuple[str, int, int]):
+    return WallItemAttachmentPhoto(
+        sizes=[
+            WallItemAttachmentPhotoSize(
+                type=type,
+                width=width,
+                height=height,
+                url=f"https://example.com/{type}",  # type: ignore
+            )
+            for type, width, height in sizes
+        ]
+    )
+
+
+@pytest.mark.parametrize(
+    ("policy", "expected"),
+    (
+        (PhotoSizePolicy(), "w"),
+        (PhotoSizePolicy(max_pixels=1_000_000), "y"),
+        (PhotoSizePolicy(max_pixels=100), "s"),
+        (PhotoSizePolicy(preferred_types=["x", "y"]), "x"),
+        (PhotoSizePolicy(preferred_types=["q", "y"]), "y"),
+        (PhotoSizePolicy(max_pixels=1_000_000, preferred_types=["w", "x"]), "x"),
+    ),
+)
+def test_get_photo_with_highest_quality_policy(policy: PhotoSizePolicy, expected: str):
+    photo = _make_photo(
+        ("s", 75, 50),
+        ("w", 2560, 1707),
+        ("x", 604, 403),
+        ("y", 807, 538),
+    )
+    assert _get_photo_with_highest_quality(photo, policy) == (
+        f"https://example.com/{expected}"
+    )
+
+
+def test_get_photo_with_highest_quality_skips_too_big_for_telegram():
+    # From real response: "o" size is 10000x173
+    photo = _make_photo(("m", 917, 1509), ("o", 10000, 173), ("p", 1000, 40))
+    assert _get_photo_with_highest_quality(photo) == "https://example.com/m"
+
+
+def test_get_photo_with_highest_quality_no_dimensions():
+    photo = _make_photo(("s", 0, 0), ("m", 0, 0))
+    assert _get_photo_with_highest_quality(photo) == "https://example.com/m"
+
+
 def test_parse_wall():
     exp_datetime_1 = datetime.now()
     exp_datetime_2 = datetime.now() - timedelta(days=10)
@@ -192,18 +256,367 @@ mock_response = {
 
 
 def test_get_wall(monkeypatch: pytest.MonkeyPatch):
+    class MockResponse:
+        content = json.dumps(mock_response).encode()
+
+    def get(url: str, params: dict[str, Any]):
+        assert url == "https://api.vk.com/method/wall.get"
+        assert params["owner_id"] == 1
+        assert params["offset"] == 0
+        assert params["access_token"] == "my_vk_token"
+        return MockResponse()
+
     class CustomVKAPI(VKAPI):
-        def get_wall(self, *, owner_id: int) -> Any:
-            assert owner_id == 1
+        def __init__(self, token: str) -> None:
+            super().__init__(token)
+            monkeypatch.setattr(self._session, "get", get)
+
+    monkeypatch.setattr(flow.vk, "VKAPI", CustomVKAPI)
+    assert get_wall(token="my_vk_token", owner_id=1) == [
+        Post(
+            id=10431,
+            text="my text message",
+            photos=["https://sun9-6.userapi.com/impg/..."],  # type: ignore
+            date=datetime.fromtimestamp(1647921520, timezone.utc),
+        )
+    ]
 
-            class MockResponse:
-                def json(self):
-                    return mock_response
 
-            return self.parse_response(
-                response=MockResponse(),  # type: ignore
-                model=WallGetResponse,  # type: ignore
-            )
+def test_wall_collector_same_as_parse_wall():
+    response: Any = deepcopy(mock_response["response"])
+    ad = deepcopy(response["items"][0])
+    ad["id"], ad["marked_as_ads"] = 1, 1
+    response["items"].append(ad)
+
+    collector = _WallCollector(
+        since_id=None, page_size=20, photo_policy=PhotoSizePolicy()
+    )
+    collector.add(response)
+    assert collector.get_posts() == _parse_wall(WallGetResponse(**response))
+
+
+def test_vk_api_load_response_error():
+    class MockResponse:
+        content = b"not json"
+
+    with pytest.raises(VKAPIError, match="Can't decode json response"):
+        _load_response(MockResponse())
+
+    MockResponse.content = b"{}"
+    with pytest.raises(VKAPIError, match='No "response" key'):
+        _load_response(MockResponse())
+
+
+def _make_wall_item(id: int, is_pinned: Literal[0, 1] = 0):
+    return {
+        "id": id,
+        "owner_id": 1,
+        "marked_as_ads": 0,
+        "is_pinned": is_pinned,
+        "text": str(id),
+        "date": id,
+    }
+
+
+@pytest.fixture
+def paginated_vk(monkeypatch: pytest.MonkeyPatch):
+    # Wall with pinned post 1 and posts 2..30, newest first
+    wall = [_make_wall_item(1, is_pinned=1)] + [
+        _make_wall_item(id) for id in range(30, 1, -1)
+    ]
+    offsets: list[int] = []
+
+    class CustomVKAPI(VKAPI):
+        def get_wall_raw(
+            self, *, owner_id: int, offset: int = 0, count: int = 20
+        ) -> Any:
+            offsets.append(offset)
+            return {"count": len(wall), "items": wall[offset : offset + count]}
 
     monkeypatch.setattr(flow.vk, "VKAPI", CustomVKAPI)
-    get_wall(token="my_vk_token", owner_id=1)
+    return offsets
+
+
+def test_get_wall_first_page_without_since_id(paginated_vk: list[int]):
+    posts = get_wall(token="my_vk_token", owner_id=1, page_size=5)
+    assert paginated_vk == [0]
+    assert [post.id for post in posts] == [1, 27, 28, 29, 30]
+
+
+def test_get_wall_stops_at_since_id(paginated_vk: list[int]):
+    posts = get_wall(token="my_vk_token", owner_id=1, since_id=22, page_size=5)
+    assert paginated_vk == [0, 5]
+    assert [post.id for post in posts] == list(range(23, 31))
+
+
+def test_get_wall_stops_at_first_page(paginated_vk: list[int]):
+    posts = get_wall(token="my_vk_token", owner_id=1, since_id=28, page_size=5)
+    assert paginated_vk == [0]
+    assert [post.id for post in posts] == [29, 30]
+
+
+def test_get_wall_stops_at_max_pages(paginated_vk: list[int]):
+    get_wall(token="my_vk_token", owner_id=1, since_id=2, page_size=5, max_pages=3)
+    assert paginated_vk == [0, 5, 10]
+
+
+def test_get_wall_stops_at_end_of_wall(paginated_vk: list[int]):
+    get_wall(token="my_vk_token", owner_id=1, since_id=0, page_size=20)
+    assert paginated_vk == [0, 20]
+
+
+def test_get_wall_async():
+    offsets: list[str] = []
+
+    def handler(request: httpx.Request):
+        assert request.url.path == "/method/wall.get"
+        assert request.url.params["owner_id"] == "1"
+        assert request.url.params["access_token"] == "my_vk_token"
+        offsets.append(request.url.params["offset"])
+        if request.url.params["offset"] == "0":
+            return httpx.Response(200, json=mock_response)
+        return httpx.Response(200, json={"response": {"count": 10, "items": []}})
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await get_wall_async(
+                client=client, token="my_vk_token", owner_id=1, since_id=1, page_size=1
+            )
+
+    posts = asyncio.run(run())
+    assert offsets == ["0", "1"]
+    assert [post.id for post in posts] == [10431]
+
+
+def test_async_vk_api_error():
+    def handler(request: httpx.Request):
+        return httpx.Response(
+            200,
+            json={"error": {"error_code": 5, "error_msg": "User authorization failed"}},
+        )
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await AsyncVKAPI("my_vk_token", client=client).get_wall(owner_id=1)
+
+    with pytest.raises(VKAPIError) as exc_info:
+        asyncio.run(run())
+    assert exc_info.value.error_code == 5
+
+
+_EXECUTE_CALL_RE = re.compile(r"API\.wall\.get\((\{.*?\})\)")
+T = TypeVar("T")
+
+
+def _execute_handler(
+    requests: list[tuple[str, list[int]]], *, failing_owner_id: int | None = None
+):
+    # Each wall has one page with posts owner_id * 100 + 1..3
+    def get_wall(params: Mapping[str, Any]):
+        owner_id, offset = int(params["owner_id"]), int(params["offset"])
+        items = [_make_wall_item(owner_id * 100 + id) for id in (3, 2, 1)]
+        return {"count": 3, "items": items[offset : offset + int(params["count"])]}
+
+    def handler(request: httpx.Request):
+        method = request.url.path.removeprefix("/method/")
+        if method == "wall.get":
+            requests.append((method, [int(request.url.params["owner_id"])]))
+            return httpx.Response(200, json={"response": get_wall(request.url.params)})
+
+        calls = [
+            json.loads(c) for c in _EXECUTE_CALL_RE.findall(request.url.params["code"])
+        ]
+        requests.append((method, [call["owner_id"] for call in calls]))
+        response: list[Any] = []
+        errors: list[dict[str, Any]] = []
+        for call in calls:
+            if call["owner_id"] == failing_owner_id:
+                response.append(False)
+                errors.append(
+                    {
+                        "method": "wall.get",
+                        "error_code": 15,
+                        "error_msg": "Access denied",
+                    }
+                )
+            else:
+                response.append(get_wall(call))
+        return httpx.Response(
+            200, json={"response": response, "execute_errors": errors}
+        )
+
+    return handler
+
+
+def _run_with_client(
+    handler: Any, func: Callable[[httpx.AsyncClient], Awaitable[T]]
+) -> T:
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await func(client)
+
+    return asyncio.run(run())
+
+
+def test_build_wall_execute_code():
+    code = _build_wall_execute_code(
+        [
+            {"owner_id": 1, "offset": 0, "count": 20},
+            {"owner_id": -2, "offset": 20, "count": 20},
+        ]
+    )
+    assert code == (
+        'return [API.wall.get({"owner_id": 1, "offset": 0, "count": 20}),'
+        'API.wall.get({"owner_id": -2, "offset": 20, "count": 20})];'
+    )
+
+
+def test_execute_wall():
+    requests: list[tuple[str, list[int]]] = []
+    handler = _execute_handler(requests, failing_owner_id=2)
+    calls = [{"owner_id": id, "offset": 0, "count": 20} for id in (1, 2, 3)]
+    results = _run_with_client(
+        handler,
+        lambda client: AsyncVKAPI("my_vk_token", client=client).execute_wall(calls),
+    )
+
+    assert requests == [("execute", [1, 2, 3])]
+    first, failed, last = results
+    assert isinstance(first, WallGetResponse)
+    assert [item.id for item in first.items] == [103, 102, 101]
+    assert isinstance(failed, VKAPIError)
+    assert failed.error_code == 15
+    assert isinstance(last, WallGetResponse)
+    assert [item.id for item in last.items] == [303, 302, 301]
+
+
+@pytest.mark.parametrize("count", (0, 26))
+def test_execute_wall_raw_calls_count(count: int):
+    calls = [{"owner_id": 1, "offset": 0, "count": 20}] * count
+    with pytest.raises(ValueError):
+        _run_with_client(
+            _execute_handler([]),
+            lambda client: AsyncVKAPI("t", client=client).execute_wall_raw(calls),
+        )
+
+
+def test_get_walls_async_batches():
+    requests: list[tuple[str, list[int]]] = []
+    handler = _execute_handler(requests, failing_owner_id=13)
+    since_ids: dict[int, int | None] = {id: id * 100 for id in range(1, 31)}
+    walls = _run_with_client(
+        handler,
+        lambda client: get_walls_async(
+            client=client, token="t", since_ids=since_ids, page_size=2
+        ),
+    )
+
+    # Walls are probed first, then every changed wall is fetched by pages
+    assert requests == [
+        ("execute", list(range(1, 26))),
+        ("execute", list(range(26, 31))),
+        ("execute", [*range(1, 13), *range(14, 27)]),
+        ("execute", list(range(27, 31))),
+        ("execute", [*range(1, 13), *range(14, 27)]),
+        ("execute", list(range(27, 31))),
+    ]
+    assert isinstance(walls.pop(13), VKAPIError)
+    for owner_id, wall in walls.items():
+        assert [post.id for post in wall] == [  # type: ignore
+            owner_id * 100 + 1,
+            owner_id * 100 + 2,
+            owner_id * 100 + 3,
+        ]
+
+
+def test_get_walls_async_single_wall_uses_wall_get():
+    requests: list[tuple[str, list[int]]] = []
+    walls = _run_with_client(
+        _execute_handler(requests),
+        lambda client: get_walls_async(client=client, token="t", since_ids={1: None}),
+    )
+    assert requests == [("wall.get", [1])]
+    assert [post.id for post in walls[1]] == [101, 102, 103]  # type: ignore
+
+
+def test_get_walls_async_request_error():
+    def handler(request: httpx.Request):
+        return httpx.Response(
+            200, json={"error": {"error_code": 6, "error_msg": "Too many requests"}}
+        )
+
+    walls = _run_with_client(
+        handler,
+        lambda client: get_walls_async(
+            client=client, token="t", since_ids={1: None, 2: None}
+        ),
+    )
+    assert all(isinstance(wall, VKAPIError) for wall in walls.values())
+
+
+def test_get_walls_async_skips_unchanged():
+    requests: list[tuple[str, list[int]]] = []
+    # Wall 1 has nothing newer than 103, wall 2 has new posts
+    walls = _run_with_client(
+        _execute_handler(requests),
+        lambda client: get_walls_async(
+            client=client, token="t", since_ids={1: 103, 2: 201}
+        ),
+    )
+    assert requests == [("execute", [1, 2]), ("wall.get", [2])]
+    assert walls == {
+        1: [],
+        2: [
+            Post(
+                id=id,
+                text=str(id),
+                photos=[],
+                date=datetime.fromtimestamp(id, timezone.utc),
+            )
+            for id in (202, 203)
+        ],
+    }
+
+
+def test_get_walls_async_without_probe():
+    requests: list[tuple[str, list[int]]] = []
+    _run_with_client(
+        _execute_handler(requests),
+        lambda client: get_walls_async(
+            client=client, token="t", since_ids={1: 103}, probe=False
+        ),
+    )
+    assert requests == [("wall.get", [1])]
+
+
+@pytest.mark.parametrize(
+    ("items", "expected"),
+    (
+        ([], False),
+        ([_make_wall_item(10)], False),
+        ([_make_wall_item(11)], True),
+        # Old pinned post on top
+        ([_make_wall_item(1, is_pinned=1), _make_wall_item(10)], False),
+        ([_make_wall_item(1, is_pinned=1), _make_wall_item(11)], True),
+        # New post pinned right away
+        ([_make_wall_item(11, is_pinned=1), _make_wall_item(10)], True),
+        ([{**_make_wall_item(11), "marked_as_ads": 1}, _make_wall_item(10)], False),
+        ([{**_make_wall_item(11), "marked_as_ads": 1}], True),
+        # Old pinned post and ad on top, newest post is after them
+        (
+            [
+                _make_wall_item(1, is_pinned=1),
+                {**_make_wall_item(12), "marked_as_ads": 1},
+            ],
+            True,
+        ),
+        ([_make_wall_item(1, is_pinned=1)], True),
+    ),
+)
+def test_has_new_posts(items: list[dict[str, Any]], expected: bool):
+    assert _has_new_posts({"count": 10, "items": items}, since_id=10) is expected
+
+
+def test_has_new_posts_whole_wall():
+    items = [_make_wall_item(1, is_pinned=1)]
+    assert _has_new_posts({"count": 1, "items": items}, since_id=10) is False